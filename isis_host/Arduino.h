@@ -0,0 +1,198 @@
+// Arduino shim for building the Isis Pyramid 1.1 firmware on the host.
+//
+// isis_slave.ino and isis_master.ino compile unchanged against this header (and the
+// one-line EEPROM.h, SPI.h, SD.h, SoftwareSerial.h and digitalWriteFast.h beside it),
+// on Linux with g++. Everything the sketches touch of the Arduino is here, simulated:
+//
+//   millis(), micros(), delay()   a virtual clock, in microseconds, that only moves when
+//                                 the harness moves it, or when the sketch waits or writes
+//   random(), randomSeed()        avr-libc's random() (Park-Miller), bit for bit, so
+//                                 RANDOMIZE and SPARKLE draw what they would on the AVR
+//   analogRead()                  a fixed value the harness sets, for randomSeed()
+//   Serial                        bytes the harness pushes in, each available from the
+//                                 time given with it; bytes written are logged with the
+//                                 time they finish going out at BAUD, and write() blocks
+//                                 once 64 bytes are waiting, as HardwareSerial does
+//   SoftwareSerial                print() and println() go to a text log
+//   EEPROM                        an image the harness loads
+//   SPI, SPDR, SPSR, SPCR         every byte written to SPDR is kept, so the harness can
+//                                 read back what went out to the strand
+//   SD, File                      files in a directory on the host, names matched
+//                                 without regard to case as on a FAT card
+//   pins                          digitalWrite() is dropped, digitalRead() returns what
+//                                 the harness set (HIGH to start with)
+//
+// host.cpp implements all of this; isis_slave_host.cpp and isis_master_host.cpp build a
+// sketch with it and add the C entry points lphost.py calls. Any call into the sketch
+// that runs on for more than HOST_WATCHDOG_US of virtual time (fatal_error()'s blinking,
+// for one) is abandoned, and the entry point returns -1.
+//
+// int is 32 bits here, not 16, and unsigned long is 64: arithmetic that overflows 16 bits
+// on the AVR (the throb ramp with large settings) doesn't wrap the same way here.
+
+#ifndef ARDUINO_H
+#define ARDUINO_H
+
+#include <ctype.h>
+#include <setjmp.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+typedef uint8_t byte;
+typedef bool boolean;
+
+#define HIGH    1
+#define LOW     0
+#define INPUT   0
+#define OUTPUT  1
+#define DEC     10
+#define HEX     16
+#define _BV(bit) (1 << (bit))
+
+#define HOST_PINS           32
+#define HOST_BAUD_DEFAULT   9600
+#define HOST_TX_BUFFER      64              // HardwareSerial's transmit buffer
+#define HOST_RX_BUFFER      64              // and its receive buffer
+#define HOST_WATCHDOG_US    10000000ULL     // 10 seconds of virtual time per call
+
+// ---- time ----
+
+extern uint64_t host_clock_us;              // virtual time since powerup
+extern uint64_t host_call_start_us;         // when the current entry point was called
+extern jmp_buf  host_watchdog;
+
+extern "C" void host_advance_us(uint64_t us);
+unsigned long millis(void);
+unsigned long micros(void);
+void delay(unsigned long ms);
+void delayMicroseconds(unsigned int us);
+
+// ---- pins ----
+
+extern uint8_t host_pin_input[HOST_PINS];
+
+void pinMode(uint8_t pin, uint8_t mode);
+void digitalWrite(uint8_t pin, uint8_t value);
+int  digitalRead(uint8_t pin);
+int  analogRead(uint8_t pin);
+extern int host_analog_value;
+
+#define digitalWriteFast2(pin, value) ((void)(pin), (void)(value))
+
+// ---- random numbers ----
+
+long random(long howbig);
+long random(long howsmall, long howbig);
+void randomSeed(unsigned long seed);
+
+// ---- serial ports ----
+
+class HardwareSerial {
+public:
+  void begin(unsigned long baud);
+  int available(void);
+  int read(void);
+  size_t write(uint8_t b);
+};
+extern HardwareSerial Serial;
+
+class SoftwareSerial {
+public:
+  SoftwareSerial(uint8_t rx, uint8_t tx) { (void)rx; (void)tx; }
+  void begin(long baud) { (void)baud; }
+  size_t write(uint8_t b);
+  size_t print(const char *s);
+  size_t print(char c);
+  size_t print(int n, int base = DEC) { return print((long)n, base); }
+  size_t print(long n, int base = DEC);
+  size_t println(void);
+  size_t println(const char *s);
+  size_t println(int n, int base = DEC) { return println((long)n, base); }
+  size_t println(long n, int base = DEC);
+};
+
+extern "C" {
+void host_serial_push(const uint8_t *data, const uint64_t *times_us, int count);
+uint64_t host_serial_next_us(void);         // when the next byte pushed in arrives, or ~0
+uint32_t host_serial_dropped(void);         // bytes that arrived to a full receive buffer
+int host_serial_output(uint8_t *data, uint64_t *times_us, int max);
+int host_debug_output(char *text, int max);
+}
+
+// ---- EEPROM ----
+
+class EEPROMClass {
+public:
+  uint8_t read(int address);
+  void write(int address, uint8_t value);
+};
+extern EEPROMClass EEPROM;
+
+extern "C" void host_eeprom_load(const uint8_t *image, int count);
+
+// ---- SPI ----
+
+#define MSBFIRST         1
+#define SPI_MODE0        0x00
+#define SPI_CLOCK_DIV16  0x01
+#define SPIF             7
+#define SPE              6
+
+class SPIClass {
+public:
+  void begin(void) {}
+  void end(void) {}
+  void setBitOrder(uint8_t order) { (void)order; }
+  void setDataMode(uint8_t mode) { (void)mode; }
+  void setClockDivider(uint8_t divider) { (void)divider; }
+};
+extern SPIClass SPI;
+
+class HostSPDR {
+public:
+  HostSPDR &operator=(uint8_t value);
+};
+extern HostSPDR SPDR;
+extern uint8_t SPCR;
+#define SPSR  (1 << SPIF)       // every transfer is over as soon as it starts
+
+extern "C" {
+int host_spi_last(uint8_t *data, int count);
+uint64_t host_spi_total(void);
+}
+
+// ---- SD card ----
+
+class File {
+public:
+  File(void *handle = 0) : handle(handle) {}
+  operator bool() const { return handle != 0; }
+  int available(void);
+  int read(void);
+  void close(void);
+private:
+  void *handle;
+};
+
+class SDClass {
+public:
+  bool begin(uint8_t select);
+  File open(const char *name);
+};
+extern SDClass SD;
+
+extern "C" void host_sd_root(const char *path);
+extern uint32_t host_sd_byte_us;            // time to read one byte from the card
+
+// ---- the harness ----
+
+extern "C" void host_reset(void);
+
+// Start of an entry point that runs sketch code: if the watchdog abandons it, the entry
+// point returns -1 from here.
+#define HOST_WATCHDOG() \
+  host_call_start_us = host_clock_us; \
+  if (setjmp(host_watchdog)) return -1
+
+#endif
@@ -0,0 +1,2 @@
+// Part of the Arduino shim for host builds; see Arduino.h.
+#include "Arduino.h"
@@ -0,0 +1,399 @@
+// The Arduino shim for host builds of the Isis Pyramid 1.1 firmware. See Arduino.h.
+
+#include <dirent.h>
+#include <stdio.h>
+#include <strings.h>
+
+#include <string>
+#include <vector>
+
+#include "Arduino.h"
+
+// ---- time ----
+
+uint64_t host_clock_us = 0;
+uint64_t host_call_start_us = 0;
+jmp_buf  host_watchdog;
+
+void host_advance_us(uint64_t us) {
+  host_clock_us += us;
+  if (host_clock_us - host_call_start_us > HOST_WATCHDOG_US) {
+    longjmp(host_watchdog, 1);
+  }
+}
+
+unsigned long millis(void) {
+  return (uint32_t)(host_clock_us / 1000);
+}
+
+// The AVR's micros() counts in steps of 4. Each call moves the clock on by a step, so
+// the sketches' busy waits on micros() come to an end.
+unsigned long micros(void) {
+  host_advance_us(4);
+  return (uint32_t)host_clock_us;
+}
+
+void delay(unsigned long ms) {
+  host_advance_us((uint64_t)ms * 1000);
+}
+
+void delayMicroseconds(unsigned int us) {
+  host_advance_us(us);
+}
+
+// ---- pins ----
+
+uint8_t host_pin_input[HOST_PINS];
+int host_analog_value = 0;
+
+void pinMode(uint8_t pin, uint8_t mode) {
+  (void)pin; (void)mode;
+}
+
+void digitalWrite(uint8_t pin, uint8_t value) {
+  (void)pin; (void)value;
+}
+
+int digitalRead(uint8_t pin) {
+  return pin < HOST_PINS ? host_pin_input[pin] : LOW;
+}
+
+int analogRead(uint8_t pin) {
+  (void)pin;
+  return host_analog_value;
+}
+
+// ---- random numbers: avr-libc's random() and Arduino's wrappers ----
+
+#define RANDOM_MAX 0x7FFFFFFF
+
+static uint32_t random_state = 1;
+
+static long do_random(void) {
+  int32_t hi, lo, x;
+
+  x = (int32_t)random_state;
+  if (x == 0) {
+    x = 123459876L;
+  }
+  hi = x / 127773L;
+  lo = x % 127773L;
+  x = 16807L * lo - 2836L * hi;
+  if (x < 0) {
+    x += RANDOM_MAX;
+  }
+  random_state = x;
+  return x;
+}
+
+long random(long howbig) {
+  if (howbig == 0) {
+    return 0;
+  }
+  return do_random() % howbig;
+}
+
+long random(long howsmall, long howbig) {
+  if (howsmall >= howbig) {
+    return howsmall;
+  }
+  return random(howbig - howsmall) + howsmall;
+}
+
+void randomSeed(unsigned long seed) {
+  if (seed != 0) {
+    random_state = (uint32_t)seed;
+  }
+}
+
+// ---- serial ports ----
+
+HardwareSerial Serial;
+
+static uint64_t byte_ns = 10000000000ULL / HOST_BAUD_DEFAULT;    // start, 8 data, stop
+
+// Received bytes: everything pushed in, and the 64-byte ring the AVR would hold them in.
+static std::vector<uint8_t>  rx_data;
+static std::vector<uint64_t> rx_times;
+static size_t   rx_next = 0;            // next pushed byte still to arrive
+static uint8_t  rx_ring[HOST_RX_BUFFER];
+static int      rx_head = 0, rx_count = 0;
+static uint32_t rx_dropped = 0;
+
+static std::vector<uint8_t>  tx_data;
+static std::vector<uint64_t> tx_times;  // when each byte has finished going out
+static uint64_t tx_free_ns = 0;         // when the transmitter is next idle
+
+static std::string debug_text;
+
+// Move the bytes that have arrived by now into the ring, dropping any it has no room for.
+static void rx_arrive(void) {
+  while (rx_next < rx_data.size() && rx_times[rx_next] <= host_clock_us) {
+    if (rx_count < HOST_RX_BUFFER) {
+      rx_ring[(rx_head + rx_count) % HOST_RX_BUFFER] = rx_data[rx_next];
+      rx_count++;
+    } else {
+      rx_dropped++;
+    }
+    rx_next++;
+  }
+}
+
+void HardwareSerial::begin(unsigned long baud) {
+  byte_ns = 10000000000ULL / baud;
+}
+
+int HardwareSerial::available(void) {
+  rx_arrive();
+  return rx_count;
+}
+
+int HardwareSerial::read(void) {
+  uint8_t b;
+
+  rx_arrive();
+  if (rx_count == 0) {
+    return -1;
+  }
+  b = rx_ring[rx_head];
+  rx_head = (rx_head + 1) % HOST_RX_BUFFER;
+  rx_count--;
+  return b;
+}
+
+size_t HardwareSerial::write(uint8_t b) {
+  uint64_t now_ns = host_clock_us * 1000;
+  uint64_t start_ns = tx_free_ns > now_ns ? tx_free_ns : now_ns;
+
+  tx_free_ns = start_ns + byte_ns;
+  tx_data.push_back(b);
+  tx_times.push_back((tx_free_ns + 999) / 1000);
+
+  // Once the buffer is full, write() waits for room.
+  if (tx_free_ns - now_ns > HOST_TX_BUFFER * byte_ns) {
+    host_advance_us((tx_free_ns - HOST_TX_BUFFER * byte_ns - now_ns + 999) / 1000);
+  }
+  return 1;
+}
+
+void host_serial_push(const uint8_t *data, const uint64_t *times_us, int count) {
+  int i;
+  uint64_t last = rx_times.empty() ? 0 : rx_times.back();
+
+  for (i = 0; i < count; i++) {
+    uint64_t t = times_us ? times_us[i] : host_clock_us;
+    last = t > last ? t : last;         // bytes arrive in order
+    rx_data.push_back(data[i]);
+    rx_times.push_back(last);
+  }
+}
+
+uint64_t host_serial_next_us(void) {
+  return rx_next < rx_data.size() ? rx_times[rx_next] : ~0ULL;
+}
+
+uint32_t host_serial_dropped(void) {
+  return rx_dropped;
+}
+
+int host_serial_output(uint8_t *data, uint64_t *times_us, int max) {
+  int count = (int)tx_data.size() < max ? (int)tx_data.size() : max;
+
+  memcpy(data, &tx_data[0], count);
+  memcpy(times_us, &tx_times[0], count * sizeof(uint64_t));
+  tx_data.erase(tx_data.begin(), tx_data.begin() + count);
+  tx_times.erase(tx_times.begin(), tx_times.begin() + count);
+  return count;
+}
+
+int host_debug_output(char *text, int max) {
+  int count = (int)debug_text.size() < max ? (int)debug_text.size() : max;
+
+  memcpy(text, debug_text.data(), count);
+  debug_text.erase(0, count);
+  return count;
+}
+
+size_t SoftwareSerial::write(uint8_t b) {
+  debug_text += (char)b;
+  return 1;
+}
+
+size_t SoftwareSerial::print(const char *s) {
+  debug_text += s;
+  return strlen(s);
+}
+
+size_t SoftwareSerial::print(char c) {
+  return write(c);
+}
+
+size_t SoftwareSerial::print(long n, int base) {
+  char text[24];
+
+  snprintf(text, sizeof(text), base == HEX ? "%lX" : "%ld", n);
+  return print(text);
+}
+
+size_t SoftwareSerial::println(void) {
+  return print("\r\n");
+}
+
+size_t SoftwareSerial::println(const char *s) {
+  return print(s) + println();
+}
+
+size_t SoftwareSerial::println(long n, int base) {
+  return print(n, base) + println();
+}
+
+// ---- EEPROM ----
+
+EEPROMClass EEPROM;
+
+static uint8_t eeprom[1024];
+
+uint8_t EEPROMClass::read(int address) {
+  return eeprom[address & (sizeof(eeprom) - 1)];
+}
+
+void EEPROMClass::write(int address, uint8_t value) {
+  eeprom[address & (sizeof(eeprom) - 1)] = value;
+}
+
+void host_eeprom_load(const uint8_t *image, int count) {
+  memset(eeprom, 0xFF, sizeof(eeprom));           // as an erased EEPROM reads
+  memcpy(eeprom, image, count < (int)sizeof(eeprom) ? count : sizeof(eeprom));
+}
+
+// ---- SPI ----
+
+SPIClass SPI;
+HostSPDR SPDR;
+uint8_t SPCR;
+
+#define SPI_KEPT  4096          // more than the longest strand update
+
+static uint8_t  spi_out[SPI_KEPT];
+static uint64_t spi_total = 0;
+
+HostSPDR &HostSPDR::operator=(uint8_t value) {
+  spi_out[spi_total++ % SPI_KEPT] = value;
+  return *this;
+}
+
+int host_spi_last(uint8_t *data, int count) {
+  int i;
+
+  if (count > SPI_KEPT) {
+    count = SPI_KEPT;
+  }
+  if ((uint64_t)count > spi_total) {
+    count = (int)spi_total;
+  }
+  for (i = 0; i < count; i++) {
+    data[i] = spi_out[(spi_total - count + i) % SPI_KEPT];
+  }
+  return count;
+}
+
+uint64_t host_spi_total(void) {
+  return spi_total;
+}
+
+// ---- SD card ----
+
+SDClass SD;
+
+static std::string sd_root = ".";
+uint32_t host_sd_byte_us = 4;
+
+struct HostFile {
+  std::vector<uint8_t> data;
+  size_t pos;
+};
+
+void host_sd_root(const char *path) {
+  sd_root = path;
+}
+
+bool SDClass::begin(uint8_t select) {
+  DIR *dir = opendir(sd_root.c_str());
+
+  (void)select;
+  if (dir == NULL) {
+    return false;
+  }
+  closedir(dir);
+  return true;
+}
+
+File SDClass::open(const char *name) {
+  DIR *dir;
+  struct dirent *entry;
+  std::string path;
+  FILE *f;
+  HostFile *file;
+  int c;
+
+  dir = opendir(sd_root.c_str());
+  if (dir == NULL) {
+    return File();
+  }
+  while ((entry = readdir(dir)) != NULL) {
+    if (strcasecmp(entry->d_name, name) == 0) {
+      path = sd_root + "/" + entry->d_name;
+      break;
+    }
+  }
+  closedir(dir);
+  if (path.empty() || (f = fopen(path.c_str(), "rb")) == NULL) {
+    return File();
+  }
+  file = new HostFile();
+  file->pos = 0;
+  while ((c = fgetc(f)) != EOF) {
+    file->data.push_back((uint8_t)c);
+  }
+  fclose(f);
+  return File(file);
+}
+
+int File::available(void) {
+  HostFile *file = (HostFile *)handle;
+  return file ? (int)(file->data.size() - file->pos) : 0;
+}
+
+int File::read(void) {
+  HostFile *file = (HostFile *)handle;
+
+  if (file == NULL || file->pos >= file->data.size()) {
+    return -1;
+  }
+  host_advance_us(host_sd_byte_us);
+  return file->data[file->pos++];
+}
+
+void File::close(void) {
+  delete (HostFile *)handle;
+  handle = 0;
+}
+
+// ---- the harness ----
+
+void host_reset(void) {
+  host_clock_us = 0;
+  host_call_start_us = 0;
+  memset(host_pin_input, HIGH, sizeof(host_pin_input));
+  random_state = 1;
+  rx_data.clear();
+  rx_times.clear();
+  rx_next = 0;
+  rx_head = rx_count = 0;
+  rx_dropped = 0;
+  tx_data.clear();
+  tx_times.clear();
+  tx_free_ns = 0;
+  debug_text.clear();
+  spi_total = 0;
+}
@@ -0,0 +1,76 @@
+// isis_master.ino, built for the host, with the entry points lphost.py calls.
+//
+// The sketch and its user console driver are included as they are, after the
+// prototypes lphost.py writes for them (isis_master_prototypes.h, in the build
+// directory). The SD card is a directory on the host, PLAYLIST.TXT and all; what goes
+// out on Serial is the RS-485 bus, each byte stamped with when it has been sent.
+//
+// The master's own fatal_error() spins without calling anything, so the watchdog can't
+// stop it: lphost.py checks there is a PLAYLIST.TXT with something in it first.
+
+#include "../isis_master/isis_master.ino"
+#include "../isis_master/isis_user_c.ino"
+
+static uint64_t next_tick_us(void) {
+  return ((uint64_t)time_origin + last_tick_millis + TICK_LENGTH) * 1000;
+}
+
+extern "C" {
+
+// Power up with the SD card in a host directory.
+int host_setup(const char *sd_root, int analog) {
+  host_reset();
+  host_sd_root(sd_root);
+  host_analog_value = analog;
+  HOST_WATCHDOG();
+  setup();
+  return 0;
+}
+
+// Run loop() until the clock reaches until_us. Reading the card and writing to the bus
+// take time; while the master waits for a tick, the clock skips to it.
+int host_run(uint64_t until_us) {
+  uint64_t next;
+
+  HOST_WATCHDOG();
+  while (host_clock_us < until_us) {
+    host_call_start_us = host_clock_us;
+    loop();
+    if (current_tick < waitfor_tick) {
+      next = next_tick_us();
+      if (next > until_us) {
+        break;
+      }
+      if (next > host_clock_us) {
+        host_clock_us = next;
+      }
+    }
+  }
+  if (host_clock_us < until_us) {
+    host_clock_us = until_us;
+  }
+  return 0;
+}
+
+uint16_t host_current_tick(void) {
+  return current_tick;
+}
+
+uint16_t host_waitfor_tick(void) {
+  return waitfor_tick;
+}
+
+// The lighting program being played, and where the playlist has got to.
+const char *host_filename(int *index) {
+  *index = playlist_index;
+  return filename;
+}
+
+// Hold a console button down (level LOW) or let it go (HIGH).
+void host_pin(int pin, int level) {
+  if (pin >= 0 && pin < HOST_PINS) {
+    host_pin_input[pin] = level;
+  }
+}
+
+}
@@ -0,0 +1,103 @@
+// isis_slave.ino, built for the host, with the entry points lphost.py calls.
+//
+// The sketch is included as it is. The Arduino IDE would have written prototypes for
+// its functions; lphost.py does the same (isis_slave_prototypes.h, in the build
+// directory) and has g++ include them first.
+//
+// One library is one slave: its state is the sketch's globals. lphost.py loads a
+// separate copy of the library for each slave it runs.
+
+#include "../isis_slave/isis_slave.ino"
+
+// When loop() will next run tick(), in host microseconds.
+static uint64_t next_tick_us(void) {
+  return ((uint64_t)time_origin + last_tick_millis + TICK_LENGTH) * 1000;
+}
+
+extern "C" {
+
+// Power up with an EEPROM image and a reading for analogRead(0) to seed random() with.
+int host_setup(const uint8_t *image, int count, int analog) {
+  host_reset();
+  host_eeprom_load(image, count);
+  host_analog_value = analog;
+  HOST_WATCHDOG();
+  setup();
+  return 0;
+}
+
+// Run loop() until the clock reaches until_us, taking the serial bytes that arrive on
+// the way. Between bytes and ticks there's nothing for loop() to do, so the clock
+// skips straight to the next of them.
+int host_run(uint64_t until_us) {
+  uint64_t next, byte_us;
+
+  HOST_WATCHDOG();
+  for (;;) {
+    host_call_start_us = host_clock_us;
+    loop();
+    if (Serial.available() > 0) {
+      continue;
+    }
+    next = next_tick_us();
+    byte_us = host_serial_next_us();
+    if (byte_us < next) {
+      next = byte_us;
+    }
+    if (next > until_us) {
+      break;
+    }
+    if (next > host_clock_us) {
+      host_clock_us = next;
+    }
+  }
+  if (host_clock_us < until_us) {
+    host_clock_us = until_us;
+  }
+  return 0;
+}
+
+uint64_t host_next_tick_us(void) {
+  return next_tick_us();
+}
+
+// Hand bytes straight to handle_serial_byte(), as if loop() had read them, with no time
+// passing. For fuzzing the packet handling.
+int host_handle_bytes(const uint8_t *data, int count) {
+  int i;
+
+  HOST_WATCHDOG();
+  for (i = 0; i < count; i++) {
+    handle_serial_byte(data[i]);
+  }
+  return 0;
+}
+
+uint16_t host_current_tick(void) {
+  return current_tick;
+}
+
+// The strand buffer, RGBD, including the spare pixel at the end.
+uint8_t *host_strand(int *pixels) {
+  *pixels = pixels_in_strand + 1;
+  return strand;
+}
+
+int host_entity_count(void) {
+  return num_entities;
+}
+
+// Entity table entry n: its RGBD buffer, with its address and size.
+uint8_t *host_entity(int n, int *address, int *pixels) {
+  *address = entities[n].address;
+  *pixels = entities[n].pixel_count;
+  return entities[n].buffer;
+}
+
+uint8_t *host_queue(int *slots, int *size) {
+  *slots = QUEUE_MAX;
+  *size = PACKET_MAX;
+  return &deferred_queue[0][0];
+}
+
+}
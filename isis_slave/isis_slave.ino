@@ -68,41 +68,9 @@ time. Dynamics computations are strictly local to each pixel. Each pixel has an
 
 SoftwareSerial debug(UNUSED_PIN, SERIAL_PIN);
 
-// Packet command codes for slave commands
-#define  CMD_S_RESET_CLOCK  0x00
-#define  CMD_S_DYN_BLINK    0x01
-#define  CMD_S_DYN_THROB    0x02
-#define  CMD_S_DYN_SPARKLE  0x03
-#define	 CMD_S_COMMENT		0x04
-
-
-// Packet command codes for entity commands
-#define  CMD_E_FILL_RGB    0x40
-#define  CMD_E_FILL_D      0x41
-#define  CMD_E_SHIFT_UP    0x42
-#define  CMD_E_SHIFT_DOWN  0x43
-#define  CMD_E_ROTATE      0x44
-#define  CMD_E_RANDOMIZE   0x45
-#define  CMD_E_LOADONE     0x46
-#define  CMD_E_RAINBOW     0x47
-
-
-// Offsets into the packet format for parsing all packets.
-#define  PKT_COMMAND_OFFSET          0
-#define  PKT_ADDRESS_OFFSET          1    // uint16_t
-
-// Offsets into the packet format for parsing slave packets.
-#define  PKT_S_DATA_OFFSET            3    // any number of packet-specific arguments
-
-// Offsets into the packet format for parsing entity packets.
-// All entity packets share a common header.
-#define  PKT_REPEAT_COUNT_OFFSET     3
-#define  PKT_EFFECTIVE_TIME_OFFSET   4    // uint16_t
-#define  PKT_REPEAT_INTERVAL_OFFSET  6    // uint16_t
-#define  PKT_E_DATA_OFFSET           8    // any number of packet-specific arguments
-
-#define  PACKET_MAX                 15    // number of bytes in longest valid packet
-                                          // applies to slave or entity packets
+// Packet command codes, packet offsets, dynamics bits and SLIP codes, generated
+// from the protocol spec (lighting programs/isis_protocol.json) by lpprotocol.py.
+#include "isis_packets.h"
 
 // Deferred execution queue. For any packet that comes in with entity addressing
 // (for one of our entities) that is not for one-shot immediate execution, we'll
@@ -231,11 +199,8 @@ void start_starfish_strand(void) {
 // preserve all the visual effects to some extent, but exact interactions
 // between the effects are left unspecified.
 //
-// The following types of dynamics are defined:
-#define DYNAMICS_BLINK    0x01    // hard on/dim at some duty cycle and rate
-#define DYNAMICS_THROB    0x02    // soft brightness modulation at some duty cycle and rate
-#define DYNAMICS_SPARKLE  0x04    // full-on for one tick with probability P
-//etc. TBD
+// The types of dynamics (DYNAMICS_BLINK, DYNAMICS_THROB and DYNAMICS_SPARKLE)
+// are defined in isis_packets.h.
 
 
 // These are the parameters for all of the dynamic effects. They are global
@@ -612,11 +577,7 @@ uint32_t Wheel(byte WheelPos)
 #define	RECV	1			// putting bytes into the buffer
 #define	STUF	2			// next byte is a stuffed byte
 
-// Special codes for byte stuffing. Per KISS or SLIP protocol standards.
-#define	FEND	0xC0
-#define FESC	0xDB
-#define TFEND	0xDC
-#define	TFESC	0xDD
+// The special codes for byte stuffing (FEND, FESC, TFEND, TFESC) are in isis_packets.h.
 
 byte state = IDLE;
 byte rcv_buffer[PACKET_MAX];
@@ -678,7 +639,7 @@ void handle_serial_byte(byte bytein) {
 // Check addressing type and see if it's for us.
 //
 void handle_packet(void) {
-  bool entity_addressed = !!(rcv_buffer[PKT_COMMAND_OFFSET] & 0x80);
+  bool entity_addressed = !!(rcv_buffer[PKT_COMMAND_OFFSET] & ENTITY_ADDRESSED);
   uint16_t address = * (uint16_t *)(rcv_buffer + PKT_ADDRESS_OFFSET);
   
   if ((! entity_addressed) && ((address & slave_address_bitmap) != 0)) {
@@ -702,7 +663,7 @@ void handle_packet(void) {
 // A slave-addressed packet that's for us is in the receive buffer.
 // Process it.
 void handle_slave_packet(void) {
-  uint8_t command_code = rcv_buffer[PKT_COMMAND_OFFSET] & 0x7F;
+  uint8_t command_code = rcv_buffer[PKT_COMMAND_OFFSET] & COMMAND_MASK;
   uint8_t *p = rcv_buffer+PKT_S_DATA_OFFSET;
   
   switch(command_code) {
@@ -854,7 +815,7 @@ void execute_entity_packet(uint8_t *buf) {
 // which may be the receive buffer or one of the buffers in the deferred queue.
 // Process it.
 void execute_packet_for_entity(uint8_t entity, uint8_t *buf) {
-  uint8_t command_code = buf[PKT_COMMAND_OFFSET] & 0x7F;
+  uint8_t command_code = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK;
   uint8_t  *p;                 // pointer into the entity's buffer
   uint8_t  pixel;              // counter for stepping through pixels
   uint8_t  r, g, b, d, n;      // data fields that may be in the packet
@@ -990,7 +951,7 @@ void execute_packet_for_entity(uint8_t entity, uint8_t *buf) {
 }
 
 void execute_packet_wrapup(uint8_t *buf) {
-  uint8_t command_code = buf[PKT_COMMAND_OFFSET] & 0x7F;
+  uint8_t command_code = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK;
   uint8_t  start, incr, dir;
 
   switch (command_code) {
@@ -0,0 +1,210 @@
+# Entity and slave configuration of the Isis Pyramid 1.1, for host-side tools.
+#
+# isis_config/isis_config.ino holds the one authoritative copy of the slave
+# configuration tables, as C arrays that get written into each slave's EEPROM.
+# Rather than keep a second copy here, we read that file and evaluate the
+# slave_NN[] tables (and the #defines they're built from) ourselves, so the
+# host tools always see the same layout the slaves do.
+#
+# strand_gather() turns those tables into one index array that does what every slave's
+# refresh_segments() does each tick, all at once: gather_strands() takes a stack of
+# entity buffers (or a whole run of ticks of them) to every slave's physical strand
+# buffer with a single NumPy fancy index.
+
+import os
+import re
+
+import numpy as np
+
+CONFIG_INO = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'isis_config', 'isis_config.ino')
+
+NUM_ENTITIES = 12           # diagonals 0-7, then left, back, right and front edges
+MAX_SEGMENTS = 4            # per slave, as in isis_slave.ino
+
+STRAND_CAROUSHELL = 0       # based on WS2801 chip in each pixel
+STRAND_STARFISH   = 1       # based on SM16716 chip in each pixel
+
+ENTITY_NAMES = ['E_DIAG_0', 'E_DIAG_1', 'E_DIAG_2', 'E_DIAG_3',
+                'E_DIAG_4', 'E_DIAG_5', 'E_DIAG_6', 'E_DIAG_7',
+                'E_LEFT', 'E_BACK', 'E_RIGHT', 'E_FRONT']
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Segment(object):
+    """One run of an entity's pixels on one slave's strand (one EEPROM descriptor).
+    """
+    def __init__(self, address, pixels_in_entity, first_entity_index,
+                 pixels_in_segment, first_strand_index, reverse_index):
+        self.address = address
+        self.pixels_in_entity = pixels_in_entity
+        self.first_entity_index = first_entity_index
+        self.pixels_in_segment = pixels_in_segment
+        self.first_strand_index = first_strand_index
+        self.reverse_index = reverse_index
+
+    def __repr__(self):
+        return 'Segment(entity=%d, entity[%d:%d] -> strand[%d]%s)' % (
+            self.address, self.first_entity_index,
+            self.first_entity_index + self.pixels_in_segment,
+            self.first_strand_index, ' reversed' if self.reverse_index else '')
+
+
+class Slave(object):
+    """Configuration of one slave, as read_EEPROM() and init_entities() see it.
+    """
+    def __init__(self, address, version, strand_type, pixels_in_strand, segments):
+        self.address = address
+        self.version = version
+        self.strand_type = strand_type
+        self.pixels_in_strand = pixels_in_strand
+        self.segments = segments
+
+        # init_entities(): one entity table entry per distinct entity address,
+        # in the order the segments first mention them.
+        self.entities = []
+        self.entity_pixels = {}
+        for seg in segments:
+            if seg.address not in self.entity_pixels:
+                self.entities.append(seg.address)
+                self.entity_pixels[seg.address] = seg.pixels_in_entity
+
+        self.slave_address_bitmap = 1 << address
+        self.entity_address_bitmap = 0
+        for addr in self.entities:
+            self.entity_address_bitmap |= 1 << addr
+
+    def __repr__(self):
+        return 'Slave(%d, %d pixels, entities=%r)' % (self.address, self.pixels_in_strand, self.entities)
+
+    def eeprom(self):
+        """The slave's EEPROM contents, as isis_config.ino writes them and read_EEPROM() reads them.
+        """
+        image = [self.address, self.version & 0xFF, self.version >> 8, self.strand_type,
+                 self.pixels_in_strand, len(self.segments)]
+        for seg in self.segments:
+            image += [seg.address, seg.pixels_in_entity, seg.first_entity_index,
+                      seg.pixels_in_segment, seg.first_strand_index, seg.reverse_index]
+        return bytes(image)
+
+    def strand_map(self):
+        """Where refresh_segments() gets each pixel of the strand: arrays of entity address
+        and index into the entity buffer, one entry per strand pixel, -1 where no segment
+        reaches. A reversed segment runs down the strand from first_strand_index, and a
+        later segment overwrites an earlier one, as in the firmware.
+        """
+        entities = np.full(self.pixels_in_strand, -1, dtype=np.intp)
+        pixels = np.full(self.pixels_in_strand, -1, dtype=np.intp)
+        for seg in self.segments:
+            count = seg.pixels_in_segment
+            strand = seg.first_strand_index + (-1 if seg.reverse_index else 1) * np.arange(count)
+            if count and (strand.min() < 0 or strand.max() >= self.pixels_in_strand or
+                          seg.first_entity_index + count > seg.pixels_in_entity):
+                raise ConfigError('slave %d: %r runs off the end of its buffer' % (self.address, seg))
+            entities[strand] = seg.address
+            pixels[strand] = seg.first_entity_index + np.arange(count)
+        return entities, pixels
+
+
+def _strip_comments(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    return re.sub(r'//[^\n]*', '', text)
+
+
+def _evaluate(expr, defines):
+    """Evaluate one C constant expression made of integers, #defined names and arithmetic.
+    """
+    names = re.findall(r'\b[A-Za-z_]\w*', expr)
+    for name in names:
+        if name not in defines:
+            raise ConfigError('unknown name %s in %r' % (name, expr))
+    if not re.match(r'^[\w\s+\-*/()]*$', expr):
+        raise ConfigError('unexpected expression %r' % expr)
+    expr = re.sub(r'\b[A-Za-z_]\w*', lambda m: '(%d)' % defines[m.group(0)], expr)
+    return int(eval(expr.strip().replace('/', '//'), {'__builtins__': {}}, {}))
+
+
+def parse_config(text):
+    """Parse the source of isis_config.ino and return the list of Slaves, by address.
+    """
+    text = _strip_comments(text)
+    defines = {}
+    for name, expr in re.findall(r'^\s*#define\s+(\w+)\s+(.+?)\s*$', text, flags=re.M):
+        defines[name] = _evaluate(expr, defines)
+
+    tables = {}
+    for name, body in re.findall(r'uint8_t\s+(slave_\d+)\s*\[\]\s*=\s*\{(.*?)\};', text, flags=re.S):
+        tables[name] = [_evaluate(item, defines) for item in body.split(',') if item.strip()]
+
+    order = re.search(r'slave_config\s*\[\s*\w+\s*\]\s*=\s*\{(.*?)\};', text, flags=re.S)
+    if order is None:
+        raise ConfigError('no slave_config[] table found')
+    names = [n.strip() for n in order.group(1).split(',') if n.strip()]
+
+    slaves = []
+    for name in names:
+        table = tables[name]
+        address, version_lo, version_hi, strand_type, pixels_in_strand, num_segments = table[:6]
+        if num_segments > MAX_SEGMENTS or len(table) != 6 + 6*num_segments:
+            raise ConfigError('%s has a malformed segment table' % name)
+        segments = [Segment(*table[6+6*i:12+6*i]) for i in range(num_segments)]
+        slaves.append(Slave(address, version_lo + 256*version_hi, strand_type, pixels_in_strand, segments))
+    return slaves
+
+
+def load_config(path=CONFIG_INO):
+    """Read the slave tables from isis_config.ino.
+    """
+    with open(path) as f:
+        return parse_config(f.read())
+
+
+def entity_pixel_counts(slaves):
+    """Number of pixels in each entity's buffer, indexed by entity address.
+    """
+    counts = [0] * NUM_ENTITIES
+    for slave in slaves:
+        for addr in slave.entities:
+            counts[addr] = max(counts[addr], slave.entity_pixels[addr])
+    return counts
+
+
+def strand_gather(slaves, width, rows=None):
+    """Index array for gather_strands(), shape (slaves, longest strand + 1): for each
+    strand pixel, its place in a stack of entity buffers, width pixels each, flattened.
+    By default the stack is one buffer per entity address; rows can instead give, per
+    slave, a dict of entity address -> row, for stacks holding each slave's own copies.
+    Pixels no segment reaches, and the spare pixel at the end of every strand buffer
+    (calloc()ed, and never written), index one past the end of the stack, which
+    gather_strands() keeps black.
+    """
+    if rows is None:
+        rows = [dict((addr, addr) for addr in slave.entities) for slave in slaves]
+        black = NUM_ENTITIES * width
+    else:
+        black = (max(max(r.values()) for r in rows if r) + 1) * width
+    length = max(slave.pixels_in_strand for slave in slaves) + 1
+    index = np.full((len(slaves), length), black, dtype=np.intp)
+    for i, slave in enumerate(slaves):
+        entities, pixels = slave.strand_map()
+        shown = np.flatnonzero(entities >= 0)
+        if np.any(pixels[shown] >= width):
+            raise ConfigError('slave %d: entity buffers are wider than %d pixels' % (slave.address, width))
+        index[i, shown] = [rows[i][e] * width + p for e, p in zip(entities[shown], pixels[shown])]
+    return index
+
+
+def gather_strands(buffers, index):
+    """Every slave's strand buffer, as refresh_segments() fills it, from a stack of entity
+    buffers of shape (..., entities, width, channels): shape (..., slaves, length,
+    channels). Leading axes (ticks, say) come along, so a whole run of frames goes in one
+    operation. Strands shorter than the longest are padded out with black.
+    """
+    buffers = np.asarray(buffers)
+    flat = buffers.reshape(buffers.shape[:-3] + (-1, buffers.shape[-1]))
+    if index.max() >= flat.shape[-2]:
+        flat = np.concatenate([flat, np.zeros(flat.shape[:-2] + (1, flat.shape[-1]), dtype=flat.dtype)], axis=-2)
+    return flat[..., index, :]
@@ -0,0 +1,108 @@
+# Isis Pyramid 1.1 Packet Definitions, for host-side tools.
+#
+# The command codes, packet layouts, meta commands, dynamics bits and SLIP codes come
+# from isis_protocol.py, which lpprotocol.py generates from isis_protocol.json along
+# with isis_packets.h for the master and the slave, so they can't get out of step. This
+# adds what host tools need to pick apart compiled .PKT files without having to know
+# about the compiler.
+
+from isis_protocol import *
+
+# Constants of the firmware that aren't in the header but that host tools
+# need in order to model it.
+TICK_LENGTH = 10           # milliseconds per tick, master and slaves
+QUEUE_MAX   = 10           # slots in each slave's deferred_queue
+BAUD_RATE   = 9600         # Serial.begin() on the RS-485 bus
+
+
+def is_meta(packet):
+    """True if a packet from a .PKT file is for the master rather than the slaves.
+    """
+    return len(packet) > 0 and packet[PKT_COMMAND_OFFSET] == CMD_META
+
+
+def is_entity_packet(packet):
+    """True if the slaves will treat this packet as entity-addressed.
+    """
+    return len(packet) > 0 and bool(packet[PKT_COMMAND_OFFSET] & ENTITY_ADDRESSED)
+
+
+def packet_fields(packet):
+    """The (name, offset, width) of each field of a packet, header included, or None
+    for a command the protocol doesn't define.
+    """
+    if len(packet) == 0:
+        return None
+    code = packet[PKT_COMMAND_OFFSET]
+    if code == CMD_META:
+        return META_FIELDS.get(packet[PKT_META_CMD_OFFSET]) if len(packet) > PKT_META_CMD_OFFSET else None
+    if code & ENTITY_ADDRESSED:
+        return ENTITY_FIELDS.get(code & COMMAND_MASK)
+    return SLAVE_FIELDS.get(code & COMMAND_MASK)
+
+
+def u16(packet, offset):
+    """Fetch a little-endian uint16_t field the way the AVR does.
+    """
+    return packet[offset] | (packet[offset+1] << 8)
+
+
+def command_name(packet):
+    """Short readable name for the command in a packet.
+    """
+    code = packet[PKT_COMMAND_OFFSET]
+    if code == CMD_META:
+        return 'META_' + META_NAMES.get(packet[PKT_META_CMD_OFFSET], '0x%02X' % packet[PKT_META_CMD_OFFSET])
+    if code & ENTITY_ADDRESSED:
+        return ENTITY_COMMAND_NAMES.get(code & COMMAND_MASK, 'E_0x%02X' % code)
+    return SLAVE_COMMAND_NAMES.get(code & COMMAND_MASK, 'S_0x%02X' % code)
+
+
+def slip_encode(packet):
+    """Frame one packet with SLIP flags and byte stuffing, exactly as send_packet()
+    puts it on the wire.
+    """
+    data = bytes(packet)
+    if FEND in data or FESC in data:
+        data = data.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')
+    return bytearray(b'\xc0' + data + b'\xc0')
+
+
+def read_packets(data):
+    """Break the contents of a .PKT file into packets, yielding each one as bytes.
+
+    This follows handle_file_byte() in isis_master.ino step for step, including
+    what it does with bad escapes (drop the packet and wait for the next flag)
+    and with packets that reach PACKET_MAX bytes (drop them the same way).
+    Note that the firmware only checks for overflow on ordinary data bytes; a
+    de-stuffed byte puts the state machine back in RECV regardless, so we do too.
+    """
+    IDLE, RECV, STUF = 0, 1, 2
+    state = IDLE
+    buf = bytearray()
+    for b in bytearray(data):
+        if state == IDLE:
+            if b == FEND:
+                state = RECV
+                del buf[:]
+        elif state == RECV:
+            if b == FEND and len(buf) == 0:
+                pass                        # back-to-back FENDs, no action
+            elif b == FEND:
+                yield bytes(buf)
+                state = IDLE
+            elif b == FESC:
+                state = STUF
+            else:
+                buf.append(b)
+                if len(buf) >= PACKET_MAX:  # overflow! Shouldn't happen.
+                    state = IDLE
+        else:
+            if b == TFESC:
+                buf.append(FESC)
+                state = RECV
+            elif b == TFEND:
+                buf.append(FEND)
+                state = RECV
+            else:                           # byte stuffing error
+                state = IDLE
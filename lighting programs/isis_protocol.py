@@ -0,0 +1,115 @@
+# Isis Pyramid 1.1 Packet Definitions, for host-side tools.
+#
+# Generated by lpprotocol.py from isis_protocol.json, like isis_packets.h. Don't
+# edit it here: change the spec and run lpprotocol.py. isis_packets.py brings these
+# names in, along with the helpers for picking packets apart.
+
+# Packet command codes for slave commands
+CMD_S_RESET_CLOCK          = 0x00
+CMD_S_DYN_BLINK            = 0x01
+CMD_S_DYN_THROB            = 0x02
+CMD_S_DYN_SPARKLE          = 0x03
+CMD_S_COMMENT              = 0x04
+
+# Packet command codes for entity commands, as the slave sees them after
+# masking off the entity-addressing bit.
+CMD_E_FILL_RGB             = 0x48
+CMD_E_FILL_D               = 0x41
+CMD_E_SHIFT_UP             = 0x42
+CMD_E_SHIFT_DOWN           = 0x43
+CMD_E_ROTATE               = 0x44
+CMD_E_RANDOMIZE            = 0x45
+CMD_E_LOADONE              = 0x46
+CMD_E_RAINBOW              = 0x47
+
+ENTITY_ADDRESSED           = 0x80    # set in the command byte of every entity packet
+COMMAND_MASK               = 0x7F    # what the slave keeps of the command byte
+
+# Packet command code reserved for use in the canned packet file format.
+CMD_META                   = 0xFF
+
+# Offsets into the packets, as in isis_packets.h.
+PKT_COMMAND_OFFSET         = 0
+PKT_ADDRESS_OFFSET         = 1
+PKT_S_DATA_OFFSET          = 3
+PKT_REPEAT_COUNT_OFFSET    = 3
+PKT_EFFECTIVE_TIME_OFFSET  = 4
+PKT_REPEAT_INTERVAL_OFFSET = 6
+PKT_E_DATA_OFFSET          = 8
+PKT_META_CMD_OFFSET        = 1
+PKT_META_DATA_OFFSET       = 2
+
+PACKET_MAX                 = 15    # number of bytes in longest valid packet
+PKT_ADDRESS_ALL_CALL       = 0xFFFF    # address all slaves or all entities
+
+# The following meta commands are defined:
+META_CONSOLE               = 0x00
+META_WAIT                  = 0x01
+META_ENDS                  = 0x02
+META_RESET_TIME            = 0x03
+
+# The following types of dynamics are defined:
+DYNAMICS_BLINK             = 0x01    # hard on/dim at some duty cycle and rate
+DYNAMICS_THROB             = 0x02    # soft brightness modulation at some duty cycle and rate
+DYNAMICS_SPARKLE           = 0x04    # full-on for one tick with probability P
+
+# Special codes for byte stuffing. Per KISS or SLIP protocol standards.
+FEND                       = 0xC0
+FESC                       = 0xDB
+TFEND                      = 0xDC
+TFESC                      = 0xDD
+
+# Human-readable names, for reports.
+SLAVE_COMMAND_NAMES = {
+    CMD_S_RESET_CLOCK: 'RESET_CLOCK',
+    CMD_S_DYN_BLINK: 'DYN_BLINK',
+    CMD_S_DYN_THROB: 'DYN_THROB',
+    CMD_S_DYN_SPARKLE: 'DYN_SPARKLE',
+    CMD_S_COMMENT: 'COMMENT',
+}
+
+ENTITY_COMMAND_NAMES = {
+    CMD_E_FILL_RGB: 'FILL_RGB',
+    CMD_E_FILL_D: 'FILL_D',
+    CMD_E_SHIFT_UP: 'SHIFT_UP',
+    CMD_E_SHIFT_DOWN: 'SHIFT_DOWN',
+    CMD_E_ROTATE: 'ROTATE',
+    CMD_E_RANDOMIZE: 'RANDOMIZE',
+    CMD_E_LOADONE: 'LOADONE',
+    CMD_E_RAINBOW: 'RAINBOW',
+}
+
+META_NAMES = {
+    META_CONSOLE: 'CONSOLE',
+    META_WAIT: 'WAIT',
+    META_ENDS: 'ENDS',
+    META_RESET_TIME: 'RESET_TIME',
+}
+
+# The fields of each kind of packet, header included, as (name, offset, width).
+# Widths are in bytes; two-byte fields are little-endian, as the AVR has them.
+SLAVE_FIELDS = {
+    CMD_S_RESET_CLOCK: (('command', 0, 1), ('address', 1, 2)),
+    CMD_S_DYN_BLINK: (('command', 0, 1), ('address', 1, 2), ('period', 3, 2), ('ontime', 5, 2), ('dimming', 7, 1)),
+    CMD_S_DYN_THROB: (('command', 0, 1), ('address', 1, 2), ('period', 3, 2), ('ramptime', 5, 2), ('bright', 7, 1), ('dim', 8, 1)),
+    CMD_S_DYN_SPARKLE: (('command', 0, 1), ('address', 1, 2), ('probability', 3, 2)),
+    CMD_S_COMMENT: (('command', 0, 1), ('address', 1, 2), ('text', 3, 11)),
+}
+
+ENTITY_FIELDS = {
+    CMD_E_FILL_RGB: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('red', 8, 1), ('green', 9, 1), ('blue', 10, 1)),
+    CMD_E_FILL_D: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('dynamics', 8, 1)),
+    CMD_E_SHIFT_UP: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('count', 8, 1), ('red', 9, 1), ('green', 10, 1), ('blue', 11, 1), ('dynamics', 12, 1)),
+    CMD_E_SHIFT_DOWN: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('count', 8, 1), ('red', 9, 1), ('green', 10, 1), ('blue', 11, 1), ('dynamics', 12, 1)),
+    CMD_E_ROTATE: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('count', 8, 1), ('down', 9, 1)),
+    CMD_E_RANDOMIZE: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2)),
+    CMD_E_LOADONE: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('index', 8, 1), ('red', 9, 1), ('green', 10, 1), ('blue', 11, 1), ('dynamics', 12, 1)),
+    CMD_E_RAINBOW: (('command', 0, 1), ('address', 1, 2), ('repeat_count', 3, 1), ('effective_time', 4, 2), ('repeat_interval', 6, 2), ('start', 8, 1), ('incr', 9, 1), ('dir', 10, 1)),
+}
+
+META_FIELDS = {
+    META_CONSOLE: (('command', 0, 1), ('meta_cmd', 1, 1), ('value', 2, 2)),
+    META_WAIT: (('command', 0, 1), ('meta_cmd', 1, 1), ('tick', 2, 2)),
+    META_ENDS: (('command', 0, 1), ('meta_cmd', 1, 1), ('tick', 2, 2)),
+    META_RESET_TIME: (('command', 0, 1), ('meta_cmd', 1, 1)),
+}
@@ -0,0 +1,318 @@
+#! /usr/bin/env python3
+
+# Benchmark suite for the Isis Pyramid 1.1 host tools, over the real show.
+#
+# The corpus is every lighting program in this directory, the ones lpbuild would
+# compile, and the show is PLAYLIST.TXT as they make it. One run measures:
+#   - compile time: each program run through the Compiler into memory, best of --repeat
+#     runs, and all of them one after another, which is what a full rebuild costs on one
+#     core; a full lpbuild --force of a copy of the directory is timed too, for the wall
+#     clock time with the process pool;
+#   - SLIP throughput: every compiled packet framed by lpcompiler.slip_frame_all() and
+#     the result read back with read_packets(), in MB/s (the corpus over and over, to a
+#     megabyte or so, as the show alone goes by too quickly to time);
+#   - simulation speed: the whole show through lpsim, in simulated ticks per second;
+#   - bytes on the wire per minute of show, for each program and for the whole show,
+#     SLIP framing included, META packets (which never leave the master) not.
+# --profile N also runs the compile of the whole corpus under cProfile and lists the N
+# functions that take the most time, for when a number goes the wrong way.
+#
+# --json writes the results to a file; --compare reads a file written earlier and shows
+# every number against it, flagging anything more than --threshold percent worse (and,
+# for compile times, at least half a millisecond worse, as the small programs compile in
+# a fraction of one), and exits with status 1 if anything is. Timings are best-of, but
+# still depend on the machine: compare runs made on the same one.
+#
+# Usage: lpbench [-O] [-S] [-R] [--repeat N] [--json OUT] [--compare BASELINE]
+#                [--threshold PCT] [--no-rebuild] [--profile N] [DIR]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from isis_packets import *
+import lpbuild
+from lpcompiler import Compiler, MemorySink, slip_frame_all
+from lpcompiler.bench import best_of
+
+VERSION = 1
+THRESHOLD = 10.0            # percent worse before --compare calls it a regression
+NOISE_MS = 0.5              # but a compile time has to be this much worse as well
+SLIP_BYTES = 1000000        # SLIP throughput is timed over about this much
+
+
+def compile_source(folder, source, flags):
+    """Compile one source into memory. Returns the sink's files, or raises.
+    """
+    compiler = Compiler(MemorySink(), '-O' in flags, '-S' in flags, '-R' in flags)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.run_file(os.path.join(folder, source))
+        compiler.close()
+    return compiler.sink.files
+
+
+def bench_compile(folder, sources, flags, repeat):
+    """Compile times per source, and the PKT files they make, by name.
+    """
+    results = {}
+    outputs = {}
+    for source, names in sources:
+        try:
+            outputs.update(compile_source(folder, source, flags))
+        except (Exception, SystemExit) as e:
+            results[source] = {'failed': '%s: %s' % (type(e).__name__, e)}
+            continue
+        seconds = best_of(repeat, compile_source, folder, source, flags)
+        results[source] = {
+            'ms': seconds * 1000,
+            'packets': sum(len(list(read_packets(outputs[name]))) for name in names if name in outputs),
+            'bytes': sum(len(outputs[name]) for name in names if name in outputs),
+        }
+    return results, outputs
+
+
+def bench_rebuild(folder, flags):
+    """Seconds for lpbuild --force on a copy of the directory (and of isis_config beside
+    it, which the passes read).
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        copy = os.path.join(scratch, os.path.basename(os.path.abspath(folder)))
+        shutil.copytree(folder, copy, ignore=shutil.ignore_patterns('__pycache__', '*.npy', '*.frames'))
+        config = os.path.join(folder, os.pardir, 'isis_config')
+        if os.path.isdir(config):
+            shutil.copytree(config, os.path.join(scratch, 'isis_config'))
+        started = time.perf_counter()
+        lpbuild.build(copy, flags, force=True, log=lambda line: None)
+        return time.perf_counter() - started
+
+
+def bench_slip(packets, repeat):
+    """SLIP encode and decode throughput over a list of packets, repeated to SLIP_BYTES.
+    """
+    packets = packets * max(1, SLIP_BYTES // max(len(slip_frame_all(packets)), 1))
+    data = slip_frame_all(packets)
+    encode = best_of(repeat, slip_frame_all, packets)
+    decode = best_of(repeat, lambda: list(read_packets(data)))
+    return {
+        'bytes': len(data),
+        'packets': len(packets),
+        'encode_mb_s': len(data) / encode / 1e6,
+        'decode_mb_s': len(data) / decode / 1e6,
+    }
+
+
+def bench_sim(programs, repeat):
+    """Simulated ticks per second over a show of (name, contents) programs.
+    """
+    from lpsim import Simulator
+    ticks = []
+
+    def run():
+        sim = Simulator()
+        for span in sim.play(programs):
+            pass
+        ticks.append(sim.tick)
+    seconds = best_of(repeat, run)
+    return {'ticks': ticks[-1], 'seconds': seconds, 'ticks_per_s': ticks[-1] / seconds}
+
+
+def wire_profile(name, data):
+    """Bytes on the wire, ticks and bytes per show-minute of one program.
+    """
+    from lpsim import playout
+    wire = sum(len(slip_encode(packet)) for packet in read_packets(data) if not is_meta(packet))
+    ticks = 0
+    for tick, _, index, packet in playout([(name, data)]):
+        ticks = tick
+    minutes = ticks * TICK_LENGTH / 60000.0
+    return {'wire_bytes': wire, 'ticks': ticks, 'bytes_per_minute': wire / minutes if minutes else None}
+
+
+def show_programs(folder, outputs):
+    """The show as (name, contents) pairs: PLAYLIST.TXT's programs, as just compiled
+    where they come from a source, or else from the directory.
+    """
+    from lpsim import read_playlist
+    path = os.path.join(folder, lpbuild.PLAYLIST)
+    names = read_playlist(path) if os.path.exists(path) else sorted(outputs)
+    programs = []
+    for name in names:
+        if name not in outputs:
+            with open(os.path.join(folder, name), 'rb') as f:
+                outputs[name] = f.read()
+        programs.append((name, outputs[name]))
+    return programs
+
+
+def profile(folder, sources, flags, count):
+    """Compile the whole corpus under cProfile and print the functions it spends the most time in.
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    for source, names in sources:
+        profiler.enable()
+        try:
+            compile_source(folder, source, flags)
+        except (Exception, SystemExit):
+            pass
+        profiler.disable()
+    pstats.Stats(profiler).sort_stats('tottime').print_stats(count)
+
+
+def run(folder, flags=(), repeat=5, rebuild=True, log=print):
+    """The whole suite. Returns the results, as they go in the JSON file.
+    """
+    flags = list(flags)
+    sources = lpbuild.find_sources(folder)
+    log('compiling %d programs%s, best of %d' % (len(sources), ' ' + ' '.join(flags) if flags else '', repeat))
+    compiled, outputs = bench_compile(folder, sources, flags, repeat)
+    total = sum(r['ms'] for r in compiled.values() if 'ms' in r)
+
+    packets = [packet for data in outputs.values() for packet in read_packets(data)]
+    log('SLIP over %d packets' % len(packets))
+    slip = bench_slip(packets, repeat)
+
+    programs = show_programs(folder, dict(outputs))
+    log('simulating the show, %d programs' % len(programs))
+    sim = bench_sim(programs, repeat)
+
+    wire = dict((name, wire_profile(name, data)) for name, data in sorted(dict(programs).items()))
+    show_wire = sum(wire[name]['wire_bytes'] for name, data in programs)
+    show_minutes = sum(wire[name]['ticks'] for name, data in programs) * TICK_LENGTH / 60000.0
+
+    results = {
+        'version': VERSION,
+        'when': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'flags': flags,
+        'repeat': repeat,
+        'compile': compiled,
+        'compile_total_ms': total,
+        'slip': slip,
+        'sim': sim,
+        'wire': wire,
+        'show_bytes_per_minute': show_wire / show_minutes if show_minutes else None,
+    }
+    if rebuild:
+        log('rebuilding a copy of the directory with lpbuild --force')
+        results['rebuild_seconds'] = bench_rebuild(folder, flags)
+    return results
+
+
+def metrics(results):
+    """The numbers worth comparing: (name, value, True if bigger is better), in order.
+    """
+    found = [('compile_total_ms', results.get('compile_total_ms'), False),
+             ('rebuild_seconds', results.get('rebuild_seconds'), False),
+             ('slip.encode_mb_s', results['slip']['encode_mb_s'], True),
+             ('slip.decode_mb_s', results['slip']['decode_mb_s'], True),
+             ('sim.ticks_per_s', results['sim']['ticks_per_s'], True),
+             ('show_bytes_per_minute', results.get('show_bytes_per_minute'), False)]
+    for source, record in sorted(results['compile'].items()):
+        found.append(('compile.%s.ms' % source, record.get('ms'), False))
+    for name, record in sorted(results['wire'].items()):
+        found.append(('wire.%s.bytes_per_minute' % name, record.get('bytes_per_minute'), False))
+    return [(name, value, higher) for name, value, higher in found if value is not None]
+
+
+def report(results, log=print):
+    log('%-12s %9s %8s %8s' % ('source', 'compile', 'packets', 'bytes'))
+    for source, record in sorted(results['compile'].items(), key=lambda item: -item[1].get('ms', 0)):
+        if 'failed' in record:
+            log('%-12s FAILED: %s' % (source, record['failed']))
+        else:
+            log('%-12s %7.1fms %8d %8d' % (source, record['ms'], record['packets'], record['bytes']))
+    log('all programs, one after another: %.1f ms' % results['compile_total_ms'])
+    if 'rebuild_seconds' in results:
+        log('lpbuild --force, with the process pool: %.2f s' % results['rebuild_seconds'])
+    slip = results['slip']
+    log('SLIP: %d bytes in %d packets, encode %.1f MB/s, decode %.1f MB/s' % (
+        slip['bytes'], slip['packets'], slip['encode_mb_s'], slip['decode_mb_s']))
+    sim = results['sim']
+    log('lpsim: %d ticks in %.3f s, %.0f ticks/s (%.0fx real time)' % (
+        sim['ticks'], sim['seconds'], sim['ticks_per_s'], sim['ticks_per_s'] * TICK_LENGTH / 1000.0))
+    log('%-12s %9s %8s %10s' % ('program', 'wire', 'ticks', 'bytes/min'))
+    for name, record in sorted(results['wire'].items()):
+        log('%-12s %9d %8d %10s' % (name, record['wire_bytes'], record['ticks'],
+                                    '%.0f' % record['bytes_per_minute'] if record['bytes_per_minute'] else '-'))
+    if results['show_bytes_per_minute']:
+        log('the show: %.0f bytes on the wire per minute (the bus carries %d at %d baud)' % (
+            results['show_bytes_per_minute'], BAUD_RATE * 6, BAUD_RATE))
+
+
+def compare(results, baseline, threshold=THRESHOLD, log=print):
+    """Show every number against the baseline. Returns the names of those more than
+    threshold percent worse.
+    """
+    old = dict((name, value) for name, value, higher in metrics(baseline))
+    regressions = []
+    log('%-40s %12s %12s %8s' % ('', 'baseline', 'now', 'change'))
+    for name, value, higher in metrics(results):
+        if name not in old:
+            log('%-40s %12s %12.4g %8s' % (name, '-', value, 'new'))
+            continue
+        change = 100.0 * (value - old[name]) / old[name] if old[name] else 0.0
+        worse = -change if higher else change
+        flag = ''
+        if worse > threshold and not (name.endswith('ms') and abs(value - old[name]) < NOISE_MS):
+            flag = '  REGRESSION'
+            regressions.append(name)
+        log('%-40s %12.4g %12.4g %+7.1f%%%s' % (name, old[name], value, change, flag))
+    if baseline.get('flags') != results.get('flags'):
+        log('note: the baseline was compiled with flags %r, this run with %r' % (baseline.get('flags'), results['flags']))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid host tool benchmark suite')
+    parser.add_argument('folder', nargs='?', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory of lighting programs (default: this one)')
+    parser.add_argument('-O', dest='optimize', action='store_true', help='compile with lpcompile -O')
+    parser.add_argument('-S', dest='schedule', action='store_true', help='compile with lpcompile -S')
+    parser.add_argument('-R', dest='repeat_fold', action='store_true', help='compile with lpcompile -R')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of (default 5)')
+    parser.add_argument('--json', metavar='OUT', help='write the results to a JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with results saved by --json')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='percent worse that counts as a regression (default %g)' % THRESHOLD)
+    parser.add_argument('--no-rebuild', action='store_true', help='skip timing lpbuild --force')
+    parser.add_argument('--profile', type=int, metavar='N', help='list the N functions compiling spends most time in')
+    args = parser.parse_args(argv)
+
+    folder = os.path.abspath(args.folder)
+    sys.path.insert(0, folder)
+    flags = ((['-O'] if args.optimize else []) + (['-S'] if args.schedule else []) +
+             (['-R'] if args.repeat_fold else []))
+    cwd = os.getcwd()
+    os.chdir(folder)                # programs open their data files by relative path
+    try:
+        results = run(folder, flags, args.repeat, not args.no_rebuild)
+        if args.profile:
+            profile(folder, lpbuild.find_sources(folder), flags, args.profile)
+    finally:
+        os.chdir(cwd)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regressions: %s' % (len(regressions), ' '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,276 @@
+#! /usr/bin/env python3
+
+# Batch builder for the Isis Pyramid 1.1 lighting programs.
+#
+# Compiles every lighting program source in this directory (every *.py that calls
+# filename()) with the lpcompiler package, spread over a pool of worker processes, and regenerates
+# PLAYLIST.TXT from playlist.in. It remembers in a build manifest (lpbuild.json) the
+# hash of each source, the hash of the compiler that built it and the hashes of the
+# PKT files that came out, and only recompiles a source when one of those has changed
+# or an output has gone missing. So rebuilding the show before copying it to the SD card
+# is nearly instant when little has changed. The manifest also lists the size, the
+# ends_at_tick() value and the actual running time of every program.
+#
+# playlist.in lists the show in order, one program per line, by source (rot2.py) or by
+# PKT file (SONNET.PKT), optionally followed by "x N" to play it N times in a row.
+# Blank lines and #comments are ignored.
+#
+# Usage: lpbuild [-O] [-S] [-R] [-N TOLERANCE] [-j JOBS] [--force] [DIR]
+
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import time
+
+from isis_packets import *
+
+MANIFEST = 'lpbuild.json'
+PLAYLIST_SOURCE = 'playlist.in'
+PLAYLIST = 'PLAYLIST.TXT'
+
+COMPILER = 'lpcompile.py'
+COMPILER_PACKAGE = 'lpcompiler'
+# What else the compiler depends on when optimizing (-O), scheduling (-S), folding repeats (-R)
+# or nudging escapes (-N).
+COMPILER_EXTRAS = ['lprepeat.py', 'lpnudge.py', 'lpoptimize.py', 'lpschedule.py', 'lpsim.py', 'lpqueue.py', 'lpbus.py',
+                   'isis_config.py',
+                   os.path.join(os.pardir, 'isis_config', 'isis_config.ino')]
+
+_FILENAME = re.compile(r'''^\s*filename\(\s*["']([^"']+)["']''', re.M)
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compiler_hash(folder, flags):
+    """Hash of the compiler, and of everything it imports for the given flags.
+    """
+    h = hashlib.sha256(' '.join(flags).encode())
+    package = sorted(os.path.join(COMPILER_PACKAGE, name)
+                     for name in os.listdir(os.path.join(folder, COMPILER_PACKAGE)) if name.endswith('.py'))
+    for name in ([COMPILER, 'isis_packets.py', 'isis_protocol.py', 'lpcolor.py'] + package +
+                 (COMPILER_EXTRAS if flags else [])):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            h.update(name.encode())
+            h.update(open(path, 'rb').read())
+    return h.hexdigest()
+
+
+def find_sources(folder):
+    """Lighting program sources in a folder: (source, [PKT files it names]) pairs.
+    """
+    sources = []
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.py') or name == COMPILER:
+            continue
+        with open(os.path.join(folder, name), errors='replace') as f:
+            outputs = _FILENAME.findall(f.read())
+        if outputs:
+            sources.append((name, outputs))
+    return sources
+
+
+def program_info(path):
+    """Size, packet count, ends_at_tick() value and running time of a PKT file.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    packets = list(read_packets(data))
+    ends = None
+    for packet in packets:
+        if is_meta(packet) and len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_ENDS:
+            ends = u16(packet + bytes(4), PKT_META_DATA_OFFSET)
+            break
+    from lpsim import playout       # only when something has changed; it brings in numpy
+    ticks = 0
+    for tick, name, index, packet in playout([(path, data)]):
+        ticks = tick
+    return {
+        'bytes': len(data),
+        'packets': len(packets),
+        'ends_at_tick': ends,
+        'ticks': ticks,
+        'seconds': ticks * TICK_LENGTH / 1000.0,
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def _worker_init(folder):
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+
+
+def _compile(source, flags):
+    """Compile one source, in a worker. Returns (source, error, output text, seconds).
+    """
+    from lpcompiler import Compiler, FileSink
+    started = time.time()
+    out = io.StringIO()
+    error = None
+    try:
+        with contextlib.redirect_stdout(out):
+            nudge = int(flags[flags.index('-N') + 1]) if '-N' in flags else None
+            compiler = Compiler(FileSink(), '-O' in flags, '-S' in flags, '-R' in flags, nudge=nudge)
+            compiler.run_file(source)
+            compiler.close()
+    except SystemExit as e:
+        if e.code:
+            error = 'exited with status %s' % e.code
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return source, error, out.getvalue(), time.time() - started
+
+
+def read_playlist_source(path):
+    """The entries of playlist.in, as (name, times) pairs.
+    """
+    entries = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            m = re.match(r'^(\S+)(?:\s+x\s*(\d+))?$', line)
+            if m is None:
+                raise ValueError('%s line %d: expected "program [x N]", got %r' % (path, number, line))
+            entries.append((m.group(1), int(m.group(2) or 1)))
+    return entries
+
+
+def build_playlist(folder, entries, sources):
+    """The PKT file names for PLAYLIST.TXT, one per play.
+    """
+    produced = dict((source, outputs) for source, outputs in sources)
+    names = []
+    for name, times in entries:
+        if name in produced:
+            if len(produced[name]) != 1:
+                raise ValueError('%s makes %d PKT files; name the one you want' % (name, len(produced[name])))
+            name = produced[name][0]
+        if not os.path.exists(os.path.join(folder, name)):
+            raise ValueError('%s: no such program' % name)
+        names += [name] * times
+    return names
+
+
+def build(folder, flags=(), jobs=None, force=False, log=print):
+    """Bring the PKT files, the manifest and PLAYLIST.TXT up to date. Returns the manifest
+    and the list of sources that failed to compile.
+    """
+    flags = list(flags)
+    manifest_path = os.path.join(folder, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            old = json.load(f)
+    except (IOError, ValueError):
+        old = {}
+    compiler = compiler_hash(folder, flags)
+    sources = find_sources(folder)
+
+    stale = []
+    failed = []
+    records = {}
+    for source, outputs in sources:
+        digest = file_hash(os.path.join(folder, source))
+        record = old.get('sources', {}).get(source)
+        records[source] = {'sha256': digest, 'outputs': outputs}
+        if not force and record is not None and record['sha256'] == digest and \
+                old.get('compiler') == compiler and record.get('failed'):
+            records[source]['failed'] = record['failed']
+            failed.append(source)       # no use trying again until something changes
+            log('%-12s FAILED (unchanged): %s' % (source, record['failed']))
+            continue
+        if (force or record is None or record['sha256'] != digest or
+                old.get('compiler') != compiler or
+                any(not os.path.exists(os.path.join(folder, name)) or
+                    old.get('programs', {}).get(name, {}).get('sha256') != file_hash(os.path.join(folder, name))
+                    for name in outputs)):
+            stale.append(source)
+
+    if stale:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_worker_init,
+                                                    initargs=(folder,)) as pool:
+            futures = [pool.submit(_compile, source, flags) for source in stale]
+            for future in concurrent.futures.as_completed(futures):
+                source, error, text, seconds = future.result()
+                for line in text.splitlines():
+                    log('    ' + line)
+                if error:
+                    failed.append(source)
+                    records[source]['failed'] = error
+                    log('%-12s FAILED: %s' % (source, error))
+                else:
+                    log('%-12s compiled in %.0f ms' % (source, seconds * 1000))
+
+    programs = {}
+    for source, outputs in sources:
+        for name in outputs:
+            path = os.path.join(folder, name)
+            if source in stale or name not in old.get('programs', {}):
+                if not os.path.exists(path):
+                    continue
+                info = program_info(path)
+            else:
+                info = old['programs'][name]
+            info['source'] = source
+            programs[name] = info
+
+    manifest = {'compiler': compiler, 'flags': flags, 'sources': records, 'programs': programs}
+
+    playlist_source = os.path.join(folder, PLAYLIST_SOURCE)
+    if os.path.exists(playlist_source):
+        playlist = build_playlist(folder, read_playlist_source(playlist_source), sources)
+        for name in playlist:
+            if name not in programs:
+                info = program_info(os.path.join(folder, name))
+                info['source'] = None
+                programs[name] = info
+        text = ''.join(name + '\n' for name in playlist)
+        path = os.path.join(folder, PLAYLIST)
+        if not os.path.exists(path) or open(path).read() != text:
+            with open(path, 'w', newline='\n') as f:
+                f.write(text)
+            log('%s rewritten with %d entries' % (PLAYLIST, len(playlist)))
+        manifest['playlist'] = playlist
+        manifest['show_seconds'] = sum(programs[name]['seconds'] for name in playlist)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest, failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid lighting program batch builder')
+    parser.add_argument('folder', nargs='?', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory of lighting programs (default: this one)')
+    parser.add_argument('-O', dest='optimize', action='store_true', help='compile with lpcompile -O')
+    parser.add_argument('-S', dest='schedule', action='store_true', help='compile with lpcompile -S')
+    parser.add_argument('-R', dest='repeat', action='store_true', help='compile with lpcompile -R')
+    parser.add_argument('-N', dest='nudge', type=int, metavar='TOLERANCE', help='compile with lpcompile -N')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='rebuild everything')
+    args = parser.parse_args(argv)
+
+    flags = ((['-O'] if args.optimize else []) + (['-S'] if args.schedule else []) +
+             (['-R'] if args.repeat else []) + (['-N', str(args.nudge)] if args.nudge is not None else []))
+    started = time.time()
+    manifest, failed = build(os.path.abspath(args.folder), flags, args.jobs, args.force)
+    elapsed = time.time() - started
+    print('%d programs, %d bytes%s; built in %.3f s%s' % (
+        len(manifest['programs']), sum(p['bytes'] for p in manifest['programs'].values()),
+        ', show runs %.1f s' % manifest['show_seconds'] if 'show_seconds' in manifest else '',
+        elapsed, ', %d failed: %s' % (len(failed), ' '.join(sorted(failed))) if failed else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,295 @@
+#! /usr/bin/env python3
+
+# RS-485 bus bandwidth and packet lateness profiler for Isis Pyramid 1.1 lighting programs.
+#
+# The master sends packets with send_packet(), which SLIP-frames them and pushes them out
+# through Serial.write(). The serial driver has a small transmit buffer; once that's full,
+# Serial.write() blocks until there's room, and the master isn't reading its file or
+# looking at the clock while it waits. At 9600 baud a byte takes a bit over a millisecond
+# on the wire, so a tick (10ms) holds fewer than ten bytes, and a burst of entity packets
+# between wait_for_tick() calls can take many ticks to get out.
+#
+# The slaves don't care how late a packet is. A deferred packet whose effective time has
+# already passed is simply executed at the next tick, and its repeats are scheduled from
+# the (old) effective time, so the whole effect comes out bunched up. This tool replays
+# a program's packet stream against a model of the master, the serial driver and the
+# slaves' clocks, and reports:
+#   - bytes on the wire, including SLIP flags and escape bytes,
+#   - how busy the wire is in each tick window, and how far behind the master gets,
+#   - for every entity packet, when it reaches the slaves compared to its start tick,
+#     flagging the ones that arrive after their effective time.
+#
+# With several baud rates (--baud 9600,19200,38400 or --what-if) it runs the same
+# program at each one and reports the slowest rate at which nothing arrives late.
+#
+# Usage: lpbus [--baud RATES | --what-if] [--window TICKS] [-v] PLAYLIST.TXT | file.PKT ...
+
+import argparse
+import collections
+import sys
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+from lpsim import load_programs
+
+BITS_PER_BYTE = 10          # 8N1: start bit, 8 data bits, stop bit
+TX_BUFFER = 64              # bytes the Arduino serial driver can hold before Serial.write() blocks
+
+STANDARD_BAUDS = [2400, 4800, 9600, 14400, 19200, 28800, 38400, 57600, 76800, 115200, 250000]
+
+
+class PacketTiming(object):
+    """The trip of one packet from the file to the slaves. Times are in milliseconds
+    since the simulation started; ticks are the slaves' (or master's) current_tick.
+    """
+    def __init__(self, program, index, packet, wire_bytes, release, sent, arrival, master_tick):
+        self.program = program          # name of the program the packet is in
+        self.index = index              # position among the program's packets, counting META
+        self.packet = packet
+        self.wire_bytes = wire_bytes    # bytes on the wire, with flags and escapes
+        self.release = release          # when the master got to it in the file
+        self.sent = sent                # when send_packet() returned
+        self.arrival = arrival          # when the closing FEND reached the slaves
+        self.master_tick = master_tick  # master's current_tick at release
+        self.arrival_tick = None        # slaves' current_tick on arrival (worst of those addressed)
+        self.start_tick = None          # effective time, for deferred entity packets
+        self.lateness = None            # arrival_tick - start_tick, for deferred entity packets
+
+    @property
+    def late(self):
+        return self.lateness is not None and self.lateness > 0
+
+    @property
+    def escapes(self):
+        return self.wire_bytes - len(self.packet) - 2
+
+
+class BusModel(object):
+    """Model of the master's file playout onto a serial line of the given baud rate.
+    """
+    def __init__(self, baud=BAUD_RATE, slaves=None, tx_buffer=TX_BUFFER):
+        if slaves is None:
+            slaves = isis_config.load_config()
+        self.slaves = slaves
+        self.byte_ms = 1000.0 * BITS_PER_BYTE / baud
+        self.tx_buffer = tx_buffer
+
+        self.now = 0.0                  # master's time
+        self.master_origin = 0.0
+        self.waitfor_tick = 0
+        self.slave_origin = [0.0] * len(slaves)
+        self.in_flight = collections.deque()   # finish times of the bytes the driver is holding
+        self.line_free = 0.0            # when the UART finishes everything queued so far
+        self.bursts = []                # (first byte start, byte count) runs of back-to-back bytes
+        self.timings = []
+        self.programs = []              # (name, start ms, end ms, its slice of timings), in playing order
+
+    def master_tick(self, when=None):
+        if when is None:
+            when = self.now
+        return int((when - self.master_origin) // TICK_LENGTH)
+
+    def slave_tick(self, slave, when):
+        return int((when - self.slave_origin[slave]) // TICK_LENGTH)
+
+    def write(self, count):
+        """Serial.write() of count bytes from the master, blocking whenever the driver's
+        buffer is full. Returns the time the last byte finishes on the wire.
+        """
+        for i in range(count):
+            while self.in_flight and self.in_flight[0] <= self.now:
+                self.in_flight.popleft()
+            if len(self.in_flight) >= self.tx_buffer:
+                self.now = self.in_flight.popleft()
+            start = max(self.now, self.line_free)
+            if self.bursts and start == self.line_free:
+                self.bursts[-1][1] += 1
+            else:
+                self.bursts.append([start, 1])
+            self.line_free = start + self.byte_ms
+            self.in_flight.append(self.line_free)
+        return self.line_free
+
+    def send_packet(self, program, index, packet):
+        wire = len(slip_encode(packet))
+        release = self.now
+        master_tick = self.master_tick()
+        arrival = self.write(wire)
+        timing = PacketTiming(program, index, packet, wire, release, self.now, arrival, master_tick)
+        self.timings.append(timing)
+        self._arrive(timing)
+        return timing
+
+    def _arrive(self, timing):
+        """What the slaves make of the packet when it gets there.
+        """
+        packet = timing.packet
+        if len(packet) < 3:
+            return
+        address = u16(packet, PKT_ADDRESS_OFFSET)
+        if not is_entity_packet(packet):
+            if packet[PKT_COMMAND_OFFSET] == CMD_S_RESET_CLOCK:
+                for i, slave in enumerate(self.slaves):
+                    if address & slave.slave_address_bitmap:
+                        self.slave_origin[i] = timing.arrival
+            return
+
+        addressed = [i for i, slave in enumerate(self.slaves) if address & slave.entity_address_bitmap]
+        if not addressed or len(packet) < PKT_E_DATA_OFFSET:
+            return
+        timing.arrival_tick = max(self.slave_tick(i, timing.arrival) for i in addressed)
+        repeat_count = packet[PKT_REPEAT_COUNT_OFFSET]
+        effective_time = u16(packet, PKT_EFFECTIVE_TIME_OFFSET)
+        if effective_time != 0 and repeat_count != 0:
+            timing.start_tick = effective_time
+            timing.lateness = timing.arrival_tick - effective_time
+
+    def wait(self):
+        """Let the master's clock run until current_tick reaches waitfor_tick.
+        """
+        if self.master_tick() < self.waitfor_tick:
+            self.now = self.master_origin + self.waitfor_tick * TICK_LENGTH
+
+    def play(self, programs):
+        """Play (name, contents) programs in order, as the master works through its playlist.
+        """
+        self.send_packet('(setup)', 0, bytes([CMD_S_RESET_CLOCK, 0xFF, 0xFF]))  # reset_time_origin()
+        self.master_origin = self.now
+        for name, data in programs:
+            start = self.now
+            first = len(self.timings)
+            for index, packet in enumerate(read_packets(data)):
+                self.wait()
+                if not is_meta(packet):
+                    self.send_packet(name, index, packet)
+                    continue
+                command = packet[PKT_META_CMD_OFFSET] if len(packet) > 1 else None
+                value = u16(packet + bytes(4), PKT_META_DATA_OFFSET)
+                if command == META_WAIT:
+                    self.waitfor_tick = value
+                elif command == META_ENDS:
+                    self.waitfor_tick = value
+                    break
+                elif command == META_RESET_TIME:
+                    self.master_origin = self.now
+                    self.waitfor_tick = 0
+            self.wait()
+            self.programs.append((name, start, self.now, slice(first, len(self.timings))))
+        return self.timings
+
+    def occupancy(self, window_ticks=1, end=None):
+        """Fraction of each window of window_ticks ticks that the wire spends busy,
+        counted from the start of the simulation.
+        """
+        window = window_ticks * TICK_LENGTH
+        if end is None:
+            end = max(self.now, self.line_free)
+        bins = int(np.ceil(end / window)) + 1
+        busy = np.zeros(bins)
+        for start, count in self.bursts:
+            stop = start + count * self.byte_ms
+            first, last = int(start // window), int(stop // window)
+            if first == last:
+                busy[first] += stop - start
+            else:
+                busy[first] += (first + 1) * window - start
+                busy[first+1:last] += window
+                busy[last] += stop - last * window
+        return busy / window
+
+
+def profile(programs, baud):
+    model = BusModel(baud)
+    model.play(programs)
+    return model
+
+
+def summarize(model, packets):
+    """Figures for one program's turn in the playlist, given its slice of the timings (a
+    program that plays twice has a turn, and a row, for each).
+    """
+    timings = model.timings[packets]
+    wire = sum(t.wire_bytes for t in timings)
+    escapes = sum(t.escapes for t in timings)
+    late = [t for t in timings if t.late]
+    backlog = max([t.arrival - t.release for t in timings] or [0.0])
+    return timings, wire, escapes, late, backlog
+
+
+def report(model, window, verbose, show):
+    print('%-12s %7s %7s %6s %7s %7s %8s %5s %7s' % ('program', 'ticks', 'packets', 'bytes', 'escapes',
+                                                  'wire %', 'backlog', 'late', 'worst'))
+    busy = model.occupancy(window)
+    for name, start, end, packets in model.programs:
+        timings, wire, escapes, late, backlog = summarize(model, packets)
+        ticks = int((end - start) // TICK_LENGTH)
+        load = 100.0 * wire * model.byte_ms / max(end - start, 1e-9)
+        worst = max([t.lateness for t in late] or [0])
+        print('%-12s %7d %7d %6d %7d %6.1f%% %6.0fms %5d %7s' % (name, ticks, len(timings), wire, escapes,
+                                                            load, backlog, len(late),
+                                                            ('+%d' % worst) if late else '-'))
+        for t in late[:show]:
+            print('    %-10s bitmap %04X start %5d arrived %5d (+%d ticks), sent at master tick %d' % (
+                command_name(t.packet), u16(t.packet, PKT_ADDRESS_OFFSET), t.start_tick,
+                t.arrival_tick, t.lateness, t.master_tick))
+        if len(late) > show:
+            print('    ... and %d more late' % (len(late) - show))
+        if verbose:
+            first, last = int(start // (window * TICK_LENGTH)), int(end // (window * TICK_LENGTH))
+            hot = [(i, busy[i]) for i in range(first, min(last + 1, len(busy))) if busy[i] >= 0.999]
+            for i, frac in hot[:show]:
+                print('    window at tick %5d of the program: wire busy %3.0f%%' % (
+                    int((i * window * TICK_LENGTH - start) // TICK_LENGTH), 100 * frac))
+            if len(hot) > show:
+                print('    ... and %d more saturated windows' % (len(hot) - show))
+    print('%d bytes at %d baud; wire busy %.1f%% of %.1f s overall, %d late packets' % (
+        sum(t.wire_bytes for t in model.timings), round(1000.0 * BITS_PER_BYTE / model.byte_ms),
+        100.0 * busy.mean(), model.now / 1000.0, sum(1 for t in model.timings if t.late)))
+
+
+def what_if(programs, bauds):
+    """Run the programs at each baud rate and return the slowest that makes no packet late.
+    """
+    print('%8s %8s %6s %8s %9s' % ('baud', 'peak %', 'late', 'worst', 'backlog'))
+    viable = None
+    for baud in sorted(bauds):
+        model = profile(programs, baud)
+        late = [t for t in model.timings if t.late]
+        busy = model.occupancy(1)
+        backlog = max([t.arrival - t.release for t in model.timings] or [0.0])
+        print('%8d %7.0f%% %6d %8s %7.0fms' % (baud, 100 * busy.max(), len(late),
+                                              ('+%d' % max(t.lateness for t in late)) if late else '-',
+                                              backlog))
+        if not late and viable is None:
+            viable = baud
+    if viable is None:
+        print('no baud rate tried gets every packet there on time')
+    else:
+        print('minimum viable baud rate: %d' % viable)
+    return viable
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid RS-485 bus profiler')
+    parser.add_argument('files', nargs='+', help='.PKT files and/or PLAYLIST.TXT files, played in order')
+    parser.add_argument('--baud', default=str(BAUD_RATE), help='baud rate, or a comma-separated list to compare')
+    parser.add_argument('--what-if', action='store_true', help='try the standard baud rates %s' %
+                        ','.join(str(b) for b in STANDARD_BAUDS))
+    parser.add_argument('--window', type=int, default=1, metavar='TICKS', help='occupancy window, in ticks')
+    parser.add_argument('--show', type=int, default=5, metavar='N', help='list at most N late packets per program')
+    parser.add_argument('-v', '--verbose', action='store_true', help='also list saturated windows')
+    args = parser.parse_args(argv)
+
+    programs = load_programs(args.files)
+    bauds = STANDARD_BAUDS if args.what_if else [int(b) for b in args.baud.split(',')]
+    if len(bauds) > 1:
+        what_if(programs, bauds)
+    else:
+        report(profile(programs, bauds[0]), args.window, args.verbose, args.show)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+
+# Color arithmetic for Isis Pyramid 1.1 lighting programs.
+#
+# Lighting programs kept their own copies of the firmware's Wheel() (cRed(), cGreen() and
+# cBlue() in the rain programs) and their own brightness ramps (the doubling table in the
+# rot programs), one branchy Python call per color. Generative programs that sweep their
+# parameters work out colors by the million, so here they are once, as 256-entry lookup
+# tables and NumPy arithmetic that take a whole array of ramp steps at a time.
+#
+# Everything takes a plain number or an array. A number gives back ints (a tuple of
+# three for a color), ready to go into a packet; an array gives back a uint8 array, with
+# a last axis of 3 for colors. Bytes are bytes: wheel positions and hues wrap at 256,
+# levels and channels are clipped to 0..255.
+#
+#   WHEEL, RED, GREEN, BLUE   Wheel() as it is in the slave firmware, bit for bit
+#   cRed(), cGreen(), cBlue() one channel of Wheel()
+#   wheel()                   all three
+#   gamma()                   a channel value through a gamma curve (GAMMA by default)
+#   perceptual()              a brightness level on a scale of levels, evenly spaced to
+#                             the eye (CIE 1931 lightness)
+#   exponential()             the same, doubling from level to level, as the rot programs do
+#   hsv()                     hue, saturation and value, each 0..255, to RGB
+#   blend()                   a palette of colors at t from 0 to 1, linearly interpolated
+#
+# The compiler hands all of these to lighting programs (see LANGUAGE), so a program just
+# calls them; lpsim and lpsynth use the same WHEEL.
+#
+# Usage: lpcolor            prints the tables
+
+import functools
+import sys
+
+import numpy as np
+
+GAMMA = 2.8                 # a usual gamma for WS2811 strands
+
+
+def _wheel_table():
+    """The firmware's Wheel() color wheel, as a 256x3 lookup table.
+    """
+    pos = np.arange(256)
+    third = np.minimum(pos // 85, 2)[:, None]      # 255 is the end of the last third
+    up = (pos - 85 * third[:, 0]) * 3
+    down = 255 - up
+    zero = np.zeros(256, dtype=np.int64)
+    table = np.where(third == 0, np.stack([up, down, zero], axis=1),
+                     np.where(third == 1, np.stack([down, zero, up], axis=1),
+                              np.stack([zero, up, down], axis=1)))
+    return table.astype(np.uint8)
+
+WHEEL = _wheel_table()
+WHEEL.flags.writeable = False
+RED, GREEN, BLUE = WHEEL[:, 0], WHEEL[:, 1], WHEEL[:, 2]
+
+
+_RED, _GREEN, _BLUE = RED.tolist(), GREEN.tolist(), BLUE.tolist()     # for one value at a time
+
+
+def _lookup(table, values, val):
+    if isinstance(val, int):        # the common case, without NumPy's overhead on one value
+        return values[val & 0xFF]
+    if np.ndim(val) == 0:
+        return int(table[int(val) & 0xFF])
+    return table[np.asarray(val, dtype=np.int64) & 0xFF]
+
+
+def _color(rgb):
+    """A (..., 3) array as it goes back to the caller: a tuple of ints if it's one color.
+    """
+    if rgb.ndim == 1:
+        return tuple(int(c) for c in rgb)
+    return rgb
+
+
+def _byte(values):
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+def cRed(val):
+    """The red of Wheel(val).
+    """
+    return _lookup(RED, _RED, val)
+
+
+def cGreen(val):
+    """The green of Wheel(val).
+    """
+    return _lookup(GREEN, _GREEN, val)
+
+
+def cBlue(val):
+    """The blue of Wheel(val).
+    """
+    return _lookup(BLUE, _BLUE, val)
+
+
+def wheel(val):
+    """Wheel(val) as (red, green, blue).
+    """
+    return _color(WHEEL[np.asarray(val, dtype=np.int64) & 0xFF])
+
+
+@functools.lru_cache(maxsize=16)
+def gamma_table(exponent=GAMMA):
+    """256-entry table of 255 * (value / 255) ** exponent, rounded.
+    """
+    table = _byte(255.0 * (np.arange(256) / 255.0) ** exponent)
+    table.flags.writeable = False
+    return table
+
+
+def gamma(value, exponent=GAMMA):
+    """A channel value (or a color, or an array of them) through a gamma curve.
+    """
+    table = gamma_table(exponent)
+    if np.ndim(value) == 0:
+        return int(table[min(max(int(value), 0), 255)])
+    return _color(table[np.clip(np.asarray(value, dtype=np.int64), 0, 255)])
+
+
+def perceptual(level, levels=255):
+    """The channel value that looks level/levels as bright, by CIE 1931 lightness.
+    """
+    lightness = 100.0 * np.clip(np.asarray(level, dtype=np.float64), 0, levels) / levels
+    luminance = np.where(lightness > 8, ((lightness + 16) / 116.0) ** 3, lightness / 903.3)
+    value = _byte(255.0 * luminance)
+    return int(value) if value.ndim == 0 else value
+
+
+def exponential(level, levels=9):
+    """A brightness ramp that doubles at every level: 0 at level 0, then 1, 2, 4 and up to
+    255 at the top level. With levels=9 it's the table the rot programs started with.
+    """
+    level = np.clip(np.asarray(level, dtype=np.float64), 0, levels)
+    value = np.where(level > 0, np.minimum(np.rint(256.0 ** ((level - 1) / (levels - 1))), 255), 0)
+    value = value.astype(np.uint8)
+    return int(value) if value.ndim == 0 else value
+
+
+def hsv(hue, saturation=255, value=255):
+    """Hue, saturation and value, each 0..255 (hue wrapping around), as (red, green, blue).
+    Any of them can be an array; they broadcast.
+    """
+    h = (np.asarray(hue, dtype=np.int64) & 0xFF) * (6.0 / 256.0)
+    s = np.clip(np.asarray(saturation, dtype=np.float64), 0, 255) / 255.0
+    v = np.clip(np.asarray(value, dtype=np.float64), 0, 255)
+    h, s, v = np.broadcast_arrays(h, s, v)
+    sector = h.astype(np.int64)
+    f = h - sector
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    rgb = np.choose(sector[..., None], [np.stack(c, axis=-1) for c in
+                                         ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))])
+    return _color(_byte(rgb))
+
+
+def blend(palette, t):
+    """The color at t (0 to 1, or an array of them) along a palette: a list of colors,
+    evenly spaced, with straight lines between them.
+    """
+    palette = np.asarray(palette, dtype=np.float64)
+    last = len(palette) - 1
+    where = np.clip(np.asarray(t, dtype=np.float64), 0, 1) * last
+    first = np.clip(where.astype(np.int64), 0, max(last - 1, 0))
+    f = (where - first)[..., None]
+    return _color(_byte(palette[first] * (1 - f) + palette[np.minimum(first + 1, last)] * f))
+
+
+# What the compiler gives lighting programs.
+LANGUAGE = ['WHEEL', 'RED', 'GREEN', 'BLUE', 'GAMMA', 'cRed', 'cGreen', 'cBlue', 'wheel',
+            'gamma', 'perceptual', 'exponential', 'hsv', 'blend']
+
+
+def main(argv):
+    np.set_printoptions(linewidth=100)
+    print('Wheel() red, green, blue:')
+    for channel in (RED, GREEN, BLUE):
+        print(channel)
+    print('gamma %.1f:' % GAMMA)
+    print(gamma_table())
+    print('perceptual, 10 levels:', perceptual(np.arange(10), 9))
+    print('exponential, 9 levels:', exponential(np.arange(10)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,14 @@
+# The Isis Pyramid 1.1 lighting program compiler, as a package.
+#
+#     from lpcompiler import Compiler, MemorySink
+#     compiler = Compiler(MemorySink())
+#     compiler.run_file('rot3.py')
+#     compiler.close()
+#     compiler.sink.files['ROT3.PKT']
+#
+# lpcompile.py is the command line front end.
+
+from .compiler import Compiler, compile_file, CONSTANTS, LANGUAGE
+from .sinks import FileSink, MemorySink, StreamSink
+from .stats import CompileStats
+from .slip import slip_escape, slip_frame, slip_frame_all
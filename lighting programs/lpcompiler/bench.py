@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+# Micro-benchmark of the compiler's SLIP encoding, old against new.
+#
+# The old encoder is the one lpcompile used to have: a Python list built up a byte at
+# a time with a test for FEND and FESC on every byte. The new one is lpcompiler.slip,
+# which leaves the scanning to bytes.replace(). Both are run over the packets of a
+# synthetic lighting program with every kind of packet and a realistic sprinkling of
+# escapes, and then the whole Compiler is timed on the same program end to end.
+#
+# Usage: python3 -m lpcompiler.bench [--packets N] [--repeat N]
+
+import argparse
+import random
+import sys
+import time
+
+from isis_packets import read_packets, FEND, FESC, TFEND, TFESC
+from .compiler import Compiler
+from .sinks import MemorySink
+from .slip import slip_frame, slip_frame_all
+
+
+def old_slip_frame(bytes):
+    """The per-byte encoder, as it was in lpcompile.
+    """
+    pkt = [FEND]
+    for b in bytes:
+        if b == FEND:
+            pkt.append(FESC)
+            pkt.append(TFEND)
+        elif b == FESC:
+            pkt.append(FESC)
+            pkt.append(TFESC)
+        else:
+            pkt.append(b)
+    pkt.append(FEND)
+    return bytearray(pkt)
+
+
+def synthetic_program(count, seed=1):
+    """Source text of a lighting program with count packets of assorted kinds.
+    """
+    rng = random.Random(seed)
+    lines = ['filename("BENCH.PKT")', 'cmd_s_reset_clock(ALL)', 'reset_master_clock()']
+    for i in range(count - 3):
+        tick = i // 4
+        kind = rng.randrange(6)
+        color = ', '.join(str(rng.randrange(256)) for _ in range(3))
+        bitmap = rng.choice(['ALL', 'DIAGS', 'SIDES', 'E_DIAG_0|E_DIAG_1', 'E_FRONT'])
+        if kind == 0:
+            lines.append('wait_for_tick(%d)' % tick)
+        elif kind == 1:
+            lines.append('cmd_e_fill_rgb(%s, 1, %d, 0, %s)' % (bitmap, tick, color))
+        elif kind == 2:
+            lines.append('cmd_e_shift_up(%s, 10, %d, 3, 1, %s, 0)' % (bitmap, tick, color))
+        elif kind == 3:
+            lines.append('cmd_e_loadone(%s, 1, %d, 0, %d, %s, 0)' % (bitmap, tick, rng.randrange(60), color))
+        elif kind == 4:
+            lines.append('cmd_e_rainbow(%s, 1, %d, 0, %d, 4, 0)' % (bitmap, tick, rng.randrange(256)))
+        else:
+            lines.append('cmd_e_rotate(%s, 50, %d, 2, 1, 0)' % (bitmap, tick))
+    return '\n'.join(lines) + '\n'
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the lighting program compiler')
+    parser.add_argument('--packets', type=int, default=50000, help='packets in the synthetic program')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+    args = parser.parse_args(argv)
+
+    source = synthetic_program(args.packets)
+    compiler = Compiler(MemorySink())
+    compiler.run_source(source, '<bench>')
+    compiler.close()
+    data = compiler.sink.files['BENCH.PKT']
+    packets = [list(p) for p in read_packets(data)]
+    if b''.join(old_slip_frame(p) for p in packets) != data:
+        print('old and new encoders disagree!')
+        return 1
+    escaped = sum(1 for p in packets if FEND in p or FESC in p)
+    print('%d packets, %d bytes framed, %d packets (%.1f%%) need escapes' % (
+        len(packets), len(data), escaped, 100.0 * escaped / len(packets)))
+
+    old = best_of(args.repeat, lambda: [old_slip_frame(p) for p in packets])
+    new = best_of(args.repeat, lambda: [slip_frame(p) for p in packets])
+    bulk = best_of(args.repeat, slip_frame_all, packets)
+    print('SLIP encoding:  old %7.1f ms  %6.2f MB/s' % (old * 1000, len(data) / old / 1e6))
+    print('                new %7.1f ms  %6.2f MB/s  (%.1fx)' % (new * 1000, len(data) / new / 1e6, old / new))
+    print('     whole file new %7.1f ms  %6.2f MB/s  (%.1fx)' % (bulk * 1000, len(data) / bulk / 1e6, old / bulk))
+
+    code = compile(source, '<bench>', 'exec')
+
+    def run():
+        c = Compiler(MemorySink())
+        exec(code, c.namespace())
+        c.close()
+    whole = best_of(args.repeat, run)
+    print('Compiler:           %7.1f ms  %6.0f packets/s' % (whole * 1000, len(packets) / whole))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,347 @@
+# The lighting program compiler proper.
+#
+# A lighting program is Python source that calls the functions of the little language
+# below (filename(), cmd_e_fill_rgb(), wait_for_tick() and so on). A Compiler supplies
+# those functions, bound to itself, runs the program, and hands the SLIP-framed packets
+# of each PKT file to a sink, passing them through whichever optional passes it was
+# asked for (see lpcompile) on the way.
+#
+# The command codes and the rest of the protocol come from isis_protocol (see lpprotocol),
+# the same definitions the firmware is built with.
+
+import isis_protocol
+from .slip import slip_escape, slip_frame_all
+from .sinks import FileSink
+
+ALL = 0xFFFF        # all-call address for either slaves or entities
+DIAGS = 0x00FF      # address for all the diagonals
+SIDES = 0x0F00      # address for all the bottom edges
+
+# Entity names
+E_DIAG_0 = 0x0001
+E_DIAG_1 = 0x0002
+E_DIAG_2 = 0x0004
+E_DIAG_3 = 0x0008
+E_DIAG_4 = 0x0010
+E_DIAG_5 = 0x0020
+E_DIAG_6 = 0x0040
+E_DIAG_7 = 0x0080
+E_LEFT   = 0x0100
+E_BACK   = 0x0200
+E_RIGHT  = 0x0400
+E_FRONT  = 0x0800
+
+# Slave packet command codes
+CMD_S_RESET_CLOCK = isis_protocol.CMD_S_RESET_CLOCK
+CMD_S_DYN_BLINK   = isis_protocol.CMD_S_DYN_BLINK
+CMD_S_DYN_THROB   = isis_protocol.CMD_S_DYN_THROB
+CMD_S_DYN_SPARKLE = isis_protocol.CMD_S_DYN_SPARKLE
+CMD_S_COMMENT     = isis_protocol.CMD_S_COMMENT
+
+# Entity packet command codes, as sent (with the entity-addressing bit set)
+CMD_E_FILL_RGB      = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_FILL_RGB
+CMD_E_FILL_D        = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_FILL_D
+CMD_E_SHIFT_UP      = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_SHIFT_UP
+CMD_E_SHIFT_DOWN    = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_SHIFT_DOWN
+CMD_E_ROTATE        = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_ROTATE
+CMD_E_RANDOMIZE     = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_RANDOMIZE
+CMD_E_LOADONE       = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_LOADONE
+CMD_E_RAINBOW       = isis_protocol.ENTITY_ADDRESSED | isis_protocol.CMD_E_RAINBOW
+
+META = isis_protocol.CMD_META   # special command code that is interpreted locally and not sent
+META_CONSOLE = isis_protocol.META_CONSOLE   # subcommands of the META command code
+META_WAIT    = isis_protocol.META_WAIT
+META_ENDS    = isis_protocol.META_ENDS
+META_RESET_TIME = isis_protocol.META_RESET_TIME
+
+# Dynamic effect codes
+DYN_BLINK =   isis_protocol.DYNAMICS_BLINK
+DYN_THROB =   isis_protocol.DYNAMICS_THROB
+DYN_SPARKLE = isis_protocol.DYNAMICS_SPARKLE
+
+# special codes for byte stuffing, per KISS or SLIP protocol standards.
+FEND = isis_protocol.FEND
+FESC = isis_protocol.FESC
+TFEND = isis_protocol.TFEND
+TFESC = isis_protocol.TFESC
+
+# The names above, for lighting programs to use.
+CONSTANTS = dict((name, value) for name, value in list(globals().items())
+                 if name.isupper() and isinstance(value, int))
+
+# Lighting programs were written for Python 2, where 5/2 == 2. Under Python 3 the
+# same division gives 2.5, so times and counts are truncated back to integers here.
+
+def LO(val):
+    return int(val) & 0xff
+
+def HI(val):
+    return (int(val) >> 8) & 0xff
+
+
+# The functions a lighting program can call, all methods of Compiler.
+LANGUAGE = ['filename', 'console', 'wait_for_tick', 'ends_at_tick', 'reset_master_clock',
+            'write_packet', 'write_raw', 'cmd_s_reset_clock', 'cmd_s_dyn_blink', 'cmd_s_dyn_throb',
+            'cmd_s_dyn_sparkle', 'comment', 'cmd_e_fill_rgb', 'cmd_e_fill_d', 'cmd_e_shift_up',
+            'cmd_e_shift_down', 'cmd_e_rotate', 'cmd_e_randomize', 'cmd_e_loadone', 'cmd_e_rainbow',
+            'play_frames', 'flexible_timing']
+
+
+class Compiler(object):
+    """Compiles lighting programs into PKT files, handing each one to a sink.
+    """
+    def __init__(self, sink=None, optimize=False, schedule=False, repeat=False, stats=None, nudge=None):
+        if sink is None:
+            sink = FileSink()
+        self.sink = sink
+        self.optimize = optimize        # run the peephole optimizer before writing
+        self.schedule = schedule        # work out the META_WAITs for queued packets
+        self.repeat = repeat            # fold runs of repeats into repeating packets
+        self.stats = stats              # a CompileStats to note the finished files in
+        self.nudge = nudge              # lpnudge's tolerance, or None to leave escapes be
+        self.outname = None             # PKT file being compiled
+        self.data = bytearray()         # its packets so far, SLIP framed
+        self.stream = []                # and one by one, for the passes below
+        self.long_ticks = {}            # index in stream -> tick, for ticks that don't fit in 16 bits
+        self.flexible = set()           # contents of the packets whose timing lpnudge may move
+        self.flexible_on = False        # whether flexible_timing() is in force
+        self.packets = 0
+
+    def namespace(self):
+        """Globals for running a lighting program: the constants, the language and lpcolor's
+        color arithmetic.
+        """
+        import lpcolor              # beside lpcompile, with the passes
+        names = dict(CONSTANTS)
+        names['LO'] = LO
+        names['HI'] = HI
+        for name in lpcolor.LANGUAGE:
+            names[name] = getattr(lpcolor, name)
+        for name in LANGUAGE:
+            names[name] = getattr(self, name)
+        return names
+
+    def run_source(self, source, path='<lighting program>'):
+        """Run the text of a lighting program.
+        """
+        namespace = self.namespace()
+        namespace['__name__'] = '__lighting__'
+        namespace['__file__'] = path
+        exec(compile(source, path, 'exec'), namespace)
+
+    def run_file(self, path):
+        """Run a lighting program source file.
+        """
+        with open(path) as f:
+            self.run_source(f.read(), path)
+
+    def finish(self):
+        """Hand the PKT file compiled so far, if any, to the sink.
+        """
+        if self.outname is None:
+            return
+        data = bytes(self.data)
+        if self.long_ticks or self.repeat or self.optimize or self.schedule or self.nudge is not None:
+            stream = self.stream
+            if self.long_ticks:
+                import lpsegment
+                stream = lpsegment.segment_and_check(stream, self.outname, self.long_ticks)
+            if self.repeat:
+                import lprepeat
+                stream = lprepeat.fold_and_check(stream, self.outname)
+            if self.optimize:
+                import lpoptimize
+                stream = lpoptimize.optimize_and_check(stream, self.outname)
+            if self.schedule:
+                import lpschedule
+                stream = lpschedule.schedule_and_check(stream, self.outname)
+            if self.nudge is not None:
+                import lpnudge
+                stream = lpnudge.nudge_and_check(stream, self.outname, self.nudge, self.flexible)
+            data = slip_frame_all(stream)
+        if self.stats is not None:
+            self.stats.record(self.outname, data)
+        self.sink.write(self.outname, data)
+        self.outname = None
+        self.data = bytearray()
+        self.stream = []
+        self.long_ticks = {}
+        self.flexible = set()
+        self.flexible_on = False
+        self.packets = 0
+
+    close = finish
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.finish()
+
+    # ---- the lighting program language ----
+
+    def filename(self, name):
+        """Create a PKT file with the specified 8.3 filename
+        """
+        self.finish()
+        self.outname = name
+
+    def write_packet(self, bytes):
+        """Add a packet, given as a sequence of byte values, to the output file.
+        """
+        data = self.data
+        data.append(FEND)
+        data += slip_escape(bytes)
+        data.append(FEND)
+        self.stream.append(list(bytes))
+        if self.flexible_on:
+            self.flexible.add(tuple(self.stream[-1]))
+        self.packets += 1
+
+    def _tick(self, tick):
+        """A tick for the next packet, noted for lpsegment if it doesn't fit in 16 bits.
+        """
+        tick = int(tick)
+        if tick > 0xFFFF:
+            self.long_ticks[self.packets] = tick
+        return tick
+
+    def write_raw(self, data):
+        """Add bytes to the output file just as they are, without framing. lpdecompile uses
+        this to reproduce the parts of a PKT file that aren't packets. -O, -S, -R and -N, and
+        ticks past 65535, rebuild the file from its packets, so they leave these bytes out.
+        """
+        self.data += bytes(data)
+
+    def console(self, value):
+        """Insert a meta packet instructing the master to display a value on the console.
+        """
+        self.write_packet((META, META_CONSOLE, LO(value), HI(value)))
+
+    def wait_for_tick(self, tick):
+        """Insert a meta packet instructing the master to wait for a certain tick number
+        to come around before proceeding to send the following packets.
+        """
+        tick = self._tick(tick)
+        self.write_packet((META, META_WAIT, LO(tick), HI(tick)))
+
+    def ends_at_tick(self, tick):
+        """Insert a meta packet instructing the master that the current program, if run to
+        completion, will end when the tick number reaches a certain value.
+        """
+        tick = self._tick(tick)
+        self.write_packet((META, META_ENDS, LO(tick), HI(tick)))
+
+    def reset_master_clock(self):
+        """Insert a meta packet instructing the master to reset its own version of time
+        at this point in the program.
+        """
+        self.write_packet((META, META_RESET_TIME))
+
+    def cmd_s_reset_clock(self, bitmap):
+        """Insert a RESET_CLOCK packet addressed to the slaves shown in bitmap.
+        """
+        self.write_packet((CMD_S_RESET_CLOCK, LO(bitmap), HI(bitmap)))
+
+    def cmd_s_dyn_blink(self, bitmap, period, ontime, dimming):
+        """Insert a DYN_BLINK packet addressed to the slaves shown in bitmap.
+        """
+        self.write_packet((CMD_S_DYN_BLINK, LO(bitmap), HI(bitmap), LO(period), HI(period),
+                           LO(ontime), HI(ontime), dimming))
+
+    def cmd_s_dyn_throb(self, bitmap, period, ramptime, bright, dim):
+        """Insert a DYN_THROB packet addressed to the slaves shown in bitmap.
+        """
+        self.write_packet((CMD_S_DYN_THROB, LO(bitmap), HI(bitmap), LO(period), HI(period),
+                           LO(ramptime), HI(ramptime), bright, dim))
+
+    def cmd_s_dyn_sparkle(self, bitmap, probability):
+        """Insert a DYN_SPARKLE packet addressed to the slaves shown in bitmap.
+        """
+        self.write_packet((CMD_S_DYN_SPARKLE, LO(bitmap), HI(bitmap), LO(probability), HI(probability)))
+
+    def comment(self, string):
+        """Insert a comment packet, nominally addressed to all slaves. This does nothing
+        at the slave, but inserts some readable text into the bitstream for debug.
+        """
+        self.write_packet((CMD_S_COMMENT, 255, 255) + tuple(ord(c) for c in string[:11]))
+
+    def cmd_e_fill_rgb(self, bitmap, repeat_count, start_tick, repeat_interval, red, green, blue):
+        """Insert a CMD_E_FILL_RGB packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_FILL_RGB, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), red, green, blue))
+
+    def cmd_e_fill_d(self, bitmap, repeat_count, start_tick, repeat_interval, dynamics):
+        """Insert a CMD_E_FILL_D packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_FILL_D, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), dynamics))
+
+    def cmd_e_shift_up(self, bitmap, repeat_count, start_tick, repeat_interval, count, red, green, blue, dynamics):
+        """Insert a CMD_E_SHIFT_UP packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_SHIFT_UP, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), count, red, green, blue, dynamics))
+
+    def cmd_e_shift_down(self, bitmap, repeat_count, start_tick, repeat_interval, count, red, green, blue, dynamics):
+        """Insert a CMD_E_SHIFT_DOWN packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_SHIFT_DOWN, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), count, red, green, blue, dynamics))
+
+    def cmd_e_rotate(self, bitmap, repeat_count, start_tick, repeat_interval, count, down):
+        """Insert a CMD_E_ROTATE packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_ROTATE, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), count, down))
+
+    def cmd_e_randomize(self, bitmap, repeat_count, start_tick, repeat_interval):
+        """Insert a CMD_E_RANDOMIZE packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_RANDOMIZE, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval)))
+
+    def cmd_e_loadone(self, bitmap, repeat_count, start_tick, repeat_interval, index, red, green, blue, dynamics):
+        """Insert a CMD_E_LOADONE packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_LOADONE, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), index, red, green, blue, dynamics))
+
+    def cmd_e_rainbow(self, bitmap, repeat_count, start_tick, repeat_interval, start, incr, dir):
+        """Insert a CMD_E_RAINBOW packet with the specified contents.
+        """
+        start_tick = self._tick(start_tick)
+        self.write_packet((CMD_E_RAINBOW, LO(bitmap), HI(bitmap), repeat_count, LO(start_tick), HI(start_tick),
+                           LO(repeat_interval), HI(repeat_interval), start, incr, dir))
+
+    def play_frames(self, frames, start_tick=0):
+        """Insert the packets (and META_WAITs) that show a NumPy array of frames, one per tick
+        from start_tick, shape (ticks, 12, 96, 3). lpsynth works out the packets.
+        """
+        import lpsynth
+        for packet in lpsynth.synthesize(frames, start_tick).packets:
+            self.write_packet(packet)
+
+    def flexible_timing(self, flexible=True):
+        """Say whether the start ticks and repeat intervals of the packets that follow have
+        to be exact. Where they don't, -N may move one a tick later to save an escape.
+        """
+        self.flexible_on = bool(flexible)
+
+
+def compile_file(path, sink=None, optimize=False, schedule=False, repeat=False, stats=None, nudge=None):
+    """Compile one lighting program source file, start to finish.
+    """
+    compiler = Compiler(sink, optimize, schedule, repeat, stats, nudge)
+    compiler.run_file(path)
+    compiler.finish()
+    return compiler.sink
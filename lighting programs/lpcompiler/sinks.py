@@ -0,0 +1,40 @@
+# Where compiled PKT files go.
+#
+# A Compiler hands each finished PKT file to its sink as a name and the framed bytes.
+# Anything with a write(name, data) method will do; these three cover the usual cases.
+
+import os
+
+
+class FileSink(object):
+    """Write each PKT file into a directory, under the name the program gave it.
+    """
+    def __init__(self, folder='.'):
+        self.folder = folder
+        self.written = []
+
+    def write(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.written.append(path)
+
+
+class MemorySink(object):
+    """Keep the PKT files in memory, in a dict of name -> bytes, in the order made.
+    """
+    def __init__(self):
+        self.files = {}
+
+    def write(self, name, data):
+        self.files[name] = bytes(data)
+
+
+class StreamSink(object):
+    """Write the bytes of every PKT file, one after another, to a binary stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, name, data):
+        self.stream.write(data)
@@ -0,0 +1,38 @@
+# Bulk SLIP framing for the lighting program compiler.
+#
+# The original compiler built every packet as a Python list one byte at a time, checking
+# each byte for FEND and FESC on the way. Escapes are rare (a few percent of packets have
+# one at all), so it is much quicker to hand the whole packet to bytes.replace(), which
+# does the scanning in C and returns the very same object when there's nothing to do.
+
+from isis_packets import FEND, FESC, TFEND, TFESC
+
+_FEND = bytes([FEND])
+_FESC = bytes([FESC])
+_ESCAPED_FEND = bytes([FESC, TFEND])
+_ESCAPED_FESC = bytes([FESC, TFESC])
+
+
+def slip_escape(data):
+    """Byte-stuff a packet body, without the framing FENDs. FESC has to go first, or the
+    FESCs put in for FENDs would be stuffed a second time.
+    """
+    data = bytes(data)
+    if FEND in data or FESC in data:        # an int search is quicker than a bytes one
+        data = data.replace(_FESC, _ESCAPED_FESC).replace(_FEND, _ESCAPED_FEND)
+    return data
+
+
+def slip_frame(packet):
+    """One packet, stuffed and framed with FENDs, as it goes in a PKT file.
+    """
+    return _FEND + slip_escape(packet) + _FEND
+
+
+def slip_frame_all(packets):
+    """A whole sequence of packets framed back to back, as one bytes object.
+    """
+    bodies = [slip_escape(packet) for packet in packets]
+    if not bodies:
+        return b''
+    return _FEND + (_FEND + _FEND).join(bodies) + _FEND
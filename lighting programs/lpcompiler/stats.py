@@ -0,0 +1,221 @@
+# Packet statistics for the lighting program compiler (lpcompile -I).
+#
+# A CompileStats records every packet of every PKT file as it finally goes out, after
+# whatever passes ran: its command, address bitmap, start tick, repeat count, SLIP
+# framed size and the escape bytes in that, and the tick the master sends it (from
+# lpsim's playout, with a bus that takes no time). From those it works out where the
+# bytes go:
+#   - by command;
+#   - by entity, each entity packet's bytes shared evenly among the entities it
+#     addresses, with the diagonals and the bottom edges totalled up;
+#   - by window of WINDOW ticks of each file, to find the busy stretches;
+#   - escape bytes, overall and by command;
+#   - a heatmap of how many times each pixel of each entity gets written: every
+#     execution of a packet (repeat_count of them) counts once for each pixel it paints.
+# META packets are counted in the file but never go on the wire, so they're left out of
+# the bus totals.
+#
+# write() saves the records and the aggregates as one JSON file, or, for a .csv path,
+# as a set of CSV files beside it (name_packets.csv, name_commands.csv and so on).
+
+import csv
+import json
+import os
+
+from isis_packets import *
+
+WINDOW = 100                # ticks per window
+GROUPS = [('diagonals', range(8)), ('sides', range(8, 12))]
+SHADES = ' .:-=+*#%@'       # for the heatmap in the report
+
+
+class PacketRecord(object):
+    """One packet of a PKT file, as the statistics see it.
+    """
+    FIELDS = ['file', 'index', 'tick', 'command', 'bitmap', 'start', 'count', 'interval', 'size', 'escapes']
+
+    def __init__(self, file, index, tick, packet):
+        packet = bytes(packet)
+        self.file = file
+        self.index = index
+        self.tick = tick                # master tick it's sent on, None if never sent
+        self.command = command_name(packet)
+        self.meta = is_meta(packet)
+        self.entity = is_entity_packet(packet)
+        self.bitmap = u16(packet, PKT_ADDRESS_OFFSET) if len(packet) >= PKT_S_DATA_OFFSET and not self.meta else None
+        timed = self.entity and len(packet) >= PKT_E_DATA_OFFSET
+        self.start = u16(packet, PKT_EFFECTIVE_TIME_OFFSET) if timed else None
+        self.count = packet[PKT_REPEAT_COUNT_OFFSET] if timed else None
+        self.interval = u16(packet, PKT_REPEAT_INTERVAL_OFFSET) if timed else None
+        self.size = len(slip_encode(packet))
+        self.escapes = packet.count(FEND) + packet.count(FESC)
+        self.packet = packet
+
+    def row(self):
+        return [getattr(self, name) for name in self.FIELDS]
+
+
+def _painted(packet, pixels):
+    """The entity pixels one execution of an entity packet writes, as a slice or an index.
+    """
+    command = packet[PKT_COMMAND_OFFSET] & COMMAND_MASK
+    data = PKT_E_DATA_OFFSET
+    if command in (CMD_E_SHIFT_UP, CMD_E_SHIFT_DOWN, CMD_E_ROTATE):
+        n = packet[data] if len(packet) > data else 0
+        return slice(0, pixels) if 0 < n <= pixels else None
+    if command == CMD_E_LOADONE:
+        n = packet[data] if len(packet) > data else pixels
+        return n if n < pixels else None
+    if command in (CMD_E_FILL_RGB, CMD_E_FILL_D, CMD_E_RANDOMIZE, CMD_E_RAINBOW):
+        return slice(0, pixels)
+    return None
+
+
+class CompileStats(object):
+    """Collects PacketRecords from a Compiler (pass it as stats=) and sums them up.
+    """
+    def __init__(self, window=WINDOW, slaves=None):
+        import isis_config
+        if slaves is None:
+            slaves = isis_config.load_config()
+        self.window = window
+        self.pixel_counts = isis_config.entity_pixel_counts(slaves)
+        self.records = []
+        self.heatmap = [[0] * max(self.pixel_counts) for e in range(isis_config.NUM_ENTITIES)]
+
+    def record(self, name, data):
+        """Note the packets of a finished PKT file, given as its SLIP framed bytes.
+        """
+        from lpsim import playout
+        sent = {}
+        for tick, program, index, packet in playout([(name, data)]):
+            if program == name and index is not None:
+                sent[index] = tick
+        for index, packet in enumerate(read_packets(data)):
+            record = PacketRecord(name, index, sent.get(index), packet)
+            self.records.append(record)
+            if record.tick is not None and record.entity and record.count:
+                self._paint(record)
+
+    def _paint(self, record):
+        for entity, pixels in enumerate(self.pixel_counts):
+            if not record.bitmap & (1 << entity) or not pixels:
+                continue
+            where = _painted(record.packet, pixels)
+            if isinstance(where, slice):
+                row = self.heatmap[entity]
+                for pixel in range(where.start, where.stop):
+                    row[pixel] += record.count
+            elif where is not None:
+                self.heatmap[entity][where] += record.count
+
+    def _sent(self):
+        return [r for r in self.records if not r.meta and r.tick is not None]
+
+    def by_command(self):
+        totals = {}
+        for r in self._sent():
+            t = totals.setdefault(r.command, {'packets': 0, 'bytes': 0, 'escapes': 0})
+            t['packets'] += 1
+            t['bytes'] += r.size
+            t['escapes'] += r.escapes
+        return totals
+
+    def by_entity(self):
+        """Bus bytes per entity address, each packet's shared among the entities it addresses.
+        """
+        totals = [{'packets': 0, 'bytes': 0.0} for e in self.pixel_counts]
+        for r in self._sent():
+            if not r.entity or r.bitmap is None:
+                continue
+            addressed = [e for e in range(len(totals)) if r.bitmap & (1 << e)]
+            for e in addressed:
+                totals[e]['packets'] += 1
+                totals[e]['bytes'] += float(r.size) / len(addressed)
+        return totals
+
+    def by_group(self):
+        entities = self.by_entity()
+        return dict((name, sum(entities[e]['bytes'] for e in members)) for name, members in GROUPS)
+
+    def by_window(self):
+        """Bus bytes per file per window of ticks, as (file, first tick, packets, bytes, escapes).
+        """
+        windows = {}
+        for r in self._sent():
+            key = (r.file, r.tick // self.window * self.window)
+            w = windows.setdefault(key, [0, 0, 0])
+            w[0] += 1
+            w[1] += r.size
+            w[2] += r.escapes
+        return [key + tuple(value) for key, value in sorted(windows.items())]
+
+    def escape_overhead(self):
+        sent = self._sent()
+        wire = sum(r.size for r in sent)
+        escapes = sum(r.escapes for r in sent)
+        return {'wire_bytes': wire, 'escape_bytes': escapes,
+                'percent': 100.0 * escapes / wire if wire else 0.0,
+                'packets_escaped': sum(1 for r in sent if r.escapes)}
+
+    def aggregates(self):
+        return {
+            'window': self.window,
+            'files': sorted(set(r.file for r in self.records)),
+            'by_command': self.by_command(),
+            'by_entity': self.by_entity(),
+            'by_group': self.by_group(),
+            'by_window': [dict(zip(['file', 'tick', 'packets', 'bytes', 'escapes'], w)) for w in self.by_window()],
+            'escapes': self.escape_overhead(),
+            'heatmap': [row[:count] for row, count in zip(self.heatmap, self.pixel_counts)],
+        }
+
+    def write(self, path):
+        """Save everything: one JSON file, or CSV files named after a .csv path.
+        """
+        if not path.lower().endswith('.csv'):
+            results = self.aggregates()
+            results['packets'] = [dict(zip(PacketRecord.FIELDS, r.row())) for r in self.records]
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+            return [path]
+
+        base = os.path.splitext(path)[0]
+        tables = {
+            'packets': (PacketRecord.FIELDS, [r.row() for r in self.records]),
+            'commands': (['command', 'packets', 'bytes', 'escapes'],
+                         [[name, t['packets'], t['bytes'], t['escapes']] for name, t in sorted(self.by_command().items())]),
+            'entities': (['entity', 'packets', 'bytes'],
+                         [[e, t['packets'], round(t['bytes'], 2)] for e, t in enumerate(self.by_entity())]),
+            'windows': (['file', 'tick', 'packets', 'bytes', 'escapes'], self.by_window()),
+            'heatmap': (['entity'] + ['pixel_%d' % p for p in range(max(self.pixel_counts))],
+                        [[e] + row for e, row in enumerate(self.heatmap)]),
+        }
+        written = []
+        for name, (header, rows) in tables.items():
+            written.append('%s_%s.csv' % (base, name))
+            with open(written[-1], 'w', newline='') as f:
+                out = csv.writer(f)
+                out.writerow(header)
+                out.writerows(rows)
+        return written
+
+    def report(self, log=print, hot=5):
+        escapes = self.escape_overhead()
+        log('%d bytes on the wire, %d of them escapes (%.1f%%, in %d packets)' % (
+            escapes['wire_bytes'], escapes['escape_bytes'], escapes['percent'], escapes['packets_escaped']))
+        for name, t in sorted(self.by_command().items(), key=lambda item: -item[1]['bytes']):
+            log('  %-14s %6d packets %7d bytes %5d escapes' % (name, t['packets'], t['bytes'], t['escapes']))
+        groups = self.by_group()
+        total = sum(groups.values())
+        log('entity packets: ' + ', '.join('%s %.0f bytes (%.0f%%)' % (name, value, 100.0 * value / total if total else 0)
+                                           for name, value in sorted(groups.items())))
+        windows = sorted(self.by_window(), key=lambda w: -w[3])[:hot]
+        if windows:
+            log('busiest %d-tick windows: ' % self.window +
+                ', '.join('%s@%d %d bytes' % (w[0], w[1], w[3]) for w in windows))
+        peak = max(max(row) for row in self.heatmap) or 1
+        log('pixel writes per entity (darker is busier, peak %d):' % peak)
+        for entity, (row, count) in enumerate(zip(self.heatmap, self.pixel_counts)):
+            log('  %2d |%s|' % (entity, ''.join(SHADES[min(len(SHADES) - 1, v * len(SHADES) // (peak + 1))]
+                                                for v in row[:count])))
@@ -0,0 +1,417 @@
+#! /usr/bin/env python3
+
+# Per-tick CPU budget estimator for the Isis Pyramid 1.1 slaves.
+#
+# Every TICK_LENGTH (10) ms a slave's loop() calls tick(), which runs
+# dynamics_precalc_tick(), refresh_segments(), update_strand() and scan_deferred_queue(),
+# executing whatever packets have come due; and between ticks loop() takes in bus bytes
+# and executes the one-shot packets as they arrive. If all that takes more than 10 ms,
+# last_tick_millis falls behind: the next tick() comes straight after, and the show
+# stutters while the slave catches up.
+#
+# This works out how long each of those takes, tick by tick, on every slave. The program
+# plays through lpsim, which keeps each slave's entity buffers and deferred queue as the
+# firmware does; every packet executed, every change to the D bytes (which decide how
+# much work the dynamics pipeline in update_strand() does for each pixel) and every
+# change in queue occupancy is priced with a cost model in CPU cycles at 16 MHz:
+#
+#   precalc     dynamics_precalc_tick(): a few 16-bit divisions, every tick;
+#   refresh     refresh_segments(): copying each segment into the strand buffer;
+#   strand      update_strand(): for Starfish strands the 50 zero bits, a bit-banged
+#               start bit and three SPI bytes per pixel and the blank pixel at the end;
+#               for Caroushell, three SPI bytes per pixel. At SPI_CLOCK_DIV16 a byte is
+#               128 cycles on the wire, and the dynamics calculations for the next byte
+#               run while it goes: they only cost extra when they take longer than that
+#               (SPARKLE's random() always does);
+#   scan        scan_deferred_queue(): looking at each of the QUEUE_MAX slots;
+#   receive     the USART interrupt, Serial.read() and handle_serial_byte() for every bus
+#               byte (every slave hears all of them), at most BAUD_RATE/10 bytes a second,
+#               and handle_packet() for each packet;
+#   interrupts  the timer0 interrupt behind millis(), every 1.024 ms;
+#
+# plus each command executed, on each entity it addresses, under its own name (FILL_RGB,
+# RANDOMIZE, ...). RANDOMIZE is the one to watch: random(256) is a 32-bit division or two
+# for every pixel, and a RANDOMIZE of a 96-pixel edge is most of a tick by itself.
+#
+# The cycle counts in CYCLES were counted from the AVR instruction timings of the code
+# avr-gcc -Os makes of these routines and of the avr-libc and Arduino core routines they
+# call. They're estimates; --cycles FILE reads a JSON object of replacements for any of
+# them, e.g. strand times measured on a slave with a scope on DEBUG1_PIN, which
+# update_starfish_strand() holds high while it runs. As in lpsim, a packet executes in
+# the tick the master sends it; lpbus says how much later the bus really gets it there.
+#
+# It reports, for every program, the heaviest tick on any slave and how many ticks overran
+# on each slave; --show lists the worst overruns with where the time went, and --slaves
+# lists each slave's idle tick, with no dynamics and with all of them on every pixel.
+#
+# Usage: lpcpu [--show N] [--slaves] [--cycles FILE] [--budget MS] [--seed N] PLAYLIST.TXT | file.PKT ...
+
+import argparse
+import bisect
+import json
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+from lpsim import MAX_PIXELS, Simulator, load_programs
+
+CPU_HZ = 16000000
+BYTES_PER_PIXEL = 4                                     # as in isis_slave.ino
+BUS_BYTES = BAUD_RATE // 10 * TICK_LENGTH // 1000      # bytes the bus can bring in one tick
+
+# Cycles for each piece of work, at 16 MHz.
+CYCLES = {
+    'precalc_tick': 760,        # dynamics_precalc_tick(): 3 16-bit modulos and a division
+    'refresh': 50,              # refresh_segments(), per segment
+    'refresh_pixel': 36,        # ... and per pixel: 4 byte copies and the loops
+    'strand': 330,              # update_strand() call, digitalWrite() of DEBUG1_PIN twice
+    'starfish': 1020,           # update_starfish_strand(): 6 zero bytes, 2 bits, SPI.begin()/end()
+    'starfish_blank': 430,      # ... the blank pixel at the end
+    'caroushell': 240,          # update_caroushell_strand(): three micros() checks
+    'start_bit': 22,            # Starfish, per pixel: the start bit, SPCR on and off
+    'pixel': 12,                # per pixel loop overhead, both strand types
+    'spi_byte': 134,            # one SPI byte at SPI_CLOCK_DIV16, with the SPIF poll
+    'calc': 18,                 # dynamics_calc_component() with no dynamics
+    'blink': 28,                # ... with BLINK: add_with_limit()
+    'throb': 28,                # ... with THROB: add_with_limit()
+    'sparkle': 4,               # ... with SPARKLE
+    'precalc_pixel': 14,        # dynamics_precalc_pixel() with no SPARKLE
+    'random': 1540,             # random(howbig): avr-libc random() and a 32-bit modulo
+    'scan': 30,                 # scan_deferred_queue() call
+    'slot': 12,                 # ... per empty slot
+    'slot_busy': 26,            # ... per slot in use, not due
+    'slot_due': 70,             # ... per slot executed, rescheduling included
+    'execute': 40,              # execute_entity_packet() and execute_packet_wrapup()
+    'entity': 22,               # ... per entity on the slave, checking the address
+    'for_entity': 34,           # execute_packet_for_entity() for an addressed entity
+    'fill_rgb': 14,             # CMD_E_FILL_RGB, per pixel
+    'fill_d': 10,               # CMD_E_FILL_D, per pixel
+    'memmove': 7,               # memmove(), per byte
+    'shift_fill': 16,           # CMD_E_SHIFT_UP/DOWN, per pixel filled
+    'rotate': 60,               # rotate_up()/rotate_down(), per pixel rotated, plus the memmove()
+    'wheel': 55,                # Wheel() and Color()
+    'set_pixel': 48,            # setPixelColor()
+    'pixel_loop': 10,           # execute_packet_for_entity() pixel loop overhead
+    'loadone': 40,              # CMD_E_LOADONE
+    'byte': 170,                # per bus byte: USART interrupt, Serial.read(), handle_serial_byte()
+    'packet': 60,               # per packet: handle_packet()
+    'queue_copy': 8,            # ... per byte copied into the deferred queue
+    'timer0': 76,               # timer0 overflow interrupt, every 1.024 ms
+}
+
+STEADY = ('precalc', 'refresh', 'strand', 'scan', 'interrupts')
+
+# Commands that leave the D bytes alone, so can't change what update_strand() costs.
+RGB_ONLY = (CMD_E_FILL_RGB, CMD_E_RANDOMIZE, CMD_E_RAINBOW)
+
+
+def ms(cycles):
+    return 1000.0 * cycles / CPU_HZ
+
+
+class CostModel(object):
+    """Prices the slave's work in cycles, from a table like CYCLES.
+    """
+    def __init__(self, cycles=None):
+        self.cycles = dict(CYCLES)
+        if cycles:
+            unknown = set(cycles) - set(CYCLES)
+            if unknown:
+                raise KeyError('unknown cycle counts: %s' % ', '.join(sorted(unknown)))
+            self.cycles.update(cycles)
+
+    def strand(self, config, d):
+        """update_strand() for a slave whose strand buffer has the given D bytes (one per
+        pixel, plus the dummy pixel at the end).
+        """
+        c = self.cycles
+        d = np.asarray(d, dtype=np.int32)
+        calc = (c['calc'] + c['blink'] * ((d & DYNAMICS_BLINK) != 0) + c['throb'] * ((d & DYNAMICS_THROB) != 0) +
+                c['sparkle'] * ((d & DYNAMICS_SPARKLE) != 0))
+        precalc = c['precalc_pixel'] + c['random'] * ((d & DYNAMICS_SPARKLE) != 0)
+        spi = c['spi_byte']
+        n = config.pixels_in_strand
+        # The first two bytes of pixel i go out while its next component is worked out;
+        # the third while pixel i+1 is set up and its first component worked out.
+        cycles = (c['strand'] + precalc[0] + calc[0] + n * c['pixel'] +
+                  int(2 * np.maximum(spi, calc[:n]).sum() + np.maximum(spi, precalc[1:n+1] + calc[1:n+1]).sum()))
+        if config.strand_type == isis_config.STRAND_STARFISH:
+            cycles += c['starfish'] + c['starfish_blank'] + n * c['start_bit']
+        else:
+            cycles += c['caroushell']
+        return cycles
+
+    def steady(self, config, d, occupied):
+        """The work in every tick, whatever arrives or comes due: parts named as in STEADY.
+        """
+        c = self.cycles
+        return {
+            'precalc': c['precalc_tick'],
+            'refresh': sum(c['refresh'] + seg.pixels_in_segment * c['refresh_pixel'] for seg in config.segments),
+            'strand': self.strand(config, d),
+            'scan': c['scan'] + occupied * c['slot_busy'] + (QUEUE_MAX - occupied) * c['slot'],
+            'interrupts': c['timer0'] * TICK_LENGTH * 1000 // 1024,
+        }
+
+    def execute(self, entity_buffers, buf):
+        """execute_entity_packet() on a slave with the given (address bit, pixels, pixel
+        count) entity buffers.
+        """
+        c = self.cycles
+        command = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        address = buf[PKT_ADDRESS_OFFSET] | (buf[PKT_ADDRESS_OFFSET+1] << 8)
+        data = PKT_E_DATA_OFFSET
+        cycles = c['execute'] + len(entity_buffers) * c['entity']
+        for bit, pixels, count in entity_buffers:
+            if not address & bit:
+                continue
+            cycles += c['for_entity']
+            if command == CMD_E_FILL_RGB:
+                cycles += count * c['fill_rgb']
+            elif command == CMD_E_FILL_D:
+                cycles += count * c['fill_d']
+            elif command in (CMD_E_SHIFT_UP, CMD_E_SHIFT_DOWN):
+                n = buf[data]
+                if 0 < n <= count:
+                    cycles += (count - n) * BYTES_PER_PIXEL * c['memmove'] + n * c['shift_fill']
+            elif command == CMD_E_ROTATE:
+                n = buf[data]
+                if 0 < n <= count:
+                    cycles += n * (c['rotate'] + (count - 1) * BYTES_PER_PIXEL * c['memmove'])
+            elif command == CMD_E_RANDOMIZE:
+                cycles += count * (c['random'] + c['wheel'] + c['set_pixel'] + c['pixel_loop'])
+            elif command == CMD_E_LOADONE:
+                cycles += c['loadone']
+            elif command == CMD_E_RAINBOW:
+                cycles += count * (c['wheel'] + c['set_pixel'] + c['pixel_loop'])
+        return cycles
+
+    def receive(self, count):
+        return count * self.cycles['byte']
+
+
+class CpuSimulator(Simulator):
+    """lpsim's Simulator, keeping the books on what every slave's CPU does in every tick.
+    """
+    def __init__(self, slaves=None, seed=0, model=None):
+        Simulator.__init__(self, slaves, seed)
+        self.model = model or CostModel()
+        self.index = dict((slave.address, i) for i, slave in enumerate(self.slaves))
+        self.extra = [{} for slave in self.slaves]      # tick -> Counter of cycles by part, per slave
+        self.steady = [[] for slave in self.slaves]     # (first tick, cycles, parts) changes, per slave
+        self.received = {}                              # tick -> bus bytes received (by every slave)
+        self.bus_tick = 0
+        self._scanning = False
+        self._busy = None
+
+        # Where each slave's strand buffer gets the D byte of each pixel, dummy pixel included.
+        flat = self.black_row * MAX_PIXELS
+        self.strand_d = []
+        for slave in self.slaves:
+            entities, pixels = slave.config.strand_map()
+            index = np.full(slave.config.pixels_in_strand + 1, flat, dtype=np.intp)
+            for i, (entity, pixel) in enumerate(zip(entities, pixels)):
+                if entity >= 0:
+                    index[i] = slave.copies[entity] * MAX_PIXELS + pixel
+            self.strand_d.append(index)
+        for i in range(len(self.slaves)):
+            self._price(i, 0)
+
+    def _price(self, i, tick):
+        """Work out slave i's steady cost from the given tick on.
+        """
+        slave = self.slaves[i]
+        d = self.buffers.reshape(-1, 4)[self.strand_d[i], 3]
+        parts = self.model.steady(slave.config, d, slave.occupancy())
+        cycles = sum(parts.values())
+        changes = self.steady[i]
+        if changes and changes[-1][0] == tick:
+            changes.pop()
+        if not changes or changes[-1][1:] != (cycles, parts):
+            changes.append((tick, cycles, parts))
+
+    def _charge(self, i, part, cycles):
+        self._busy = None
+        extra = self.extra[i].get(self.tick)
+        if extra is None:
+            extra = self.extra[i][self.tick] = Counter()
+        extra[part] += cycles
+
+    def deliver(self, packet):
+        count = len(slip_encode(packet))
+        tick = max(self.tick, self.bus_tick)
+        while count:
+            room = BUS_BYTES - self.received.get(tick, 0)
+            if room <= 0:
+                tick += 1
+                continue
+            self.received[tick] = self.received.get(tick, 0) + min(room, count)
+            count -= min(room, count)
+        self.bus_tick = tick
+        occupied = [slave.occupancy() for slave in self.slaves]
+        Simulator.deliver(self, packet)
+        c = self.model.cycles
+        for i, slave in enumerate(self.slaves):
+            self._charge(i, 'receive', c['packet'])
+            if slave.occupancy() != occupied[i]:
+                self._charge(i, 'receive', len(packet) * c['queue_copy'])
+                self._price(i, self.tick)
+
+    def _scan(self, slave):
+        occupied = slave.occupancy()
+        self._scanning = True
+        Simulator._scan(self, slave)
+        self._scanning = False
+        if slave.occupancy() != occupied:
+            self._price(self.index[slave.address], self.tick + 1)
+
+    def _execute(self, slave, buf):
+        i = self.index[slave.address]
+        command = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        self._charge(i, command_name(buf), self.model.execute(slave.entity_buffers, buf))
+        if self._scanning:
+            self._charge(i, 'scan', self.model.cycles['slot_due'] - self.model.cycles['slot_busy'])
+        Simulator._execute(self, slave, buf)
+        if command not in RGB_ONLY:
+            self._price(i, self.tick + 1)
+
+    def ticks(self, i, start, stop):
+        """Slave i's ticks from start to stop that did more than the steady work, as
+        (tick, cycles, parts), and the steady work over the same ticks, as (first tick,
+        tick count, cycles, parts) spans.
+        """
+        if self._busy is None:
+            received = set(self.received)
+            self._busy = [sorted(received.union(extra)) for extra in self.extra]
+        busy = self._busy[i]
+        changes = self.steady[i]
+        firsts = [first for first, cycles, parts in changes]
+        out = []
+        for tick in busy[bisect.bisect_left(busy, start):bisect.bisect_left(busy, stop)]:
+            first, cycles, parts = changes[max(0, bisect.bisect_right(firsts, tick) - 1)]
+            parts = Counter(parts)
+            parts.update(self.extra[i].get(tick, {}))
+            if tick in self.received:
+                parts['receive'] += self.model.receive(self.received[tick])
+            out.append((tick, sum(parts.values()), parts))
+        spans = []
+        for n in range(max(0, bisect.bisect_right(firsts, start) - 1), bisect.bisect_left(firsts, stop)):
+            first, cycles, parts = changes[n]
+            end = changes[n+1][0] if n + 1 < len(changes) else stop
+            first, end = max(first, start), min(end, stop)
+            if end > first:
+                spans.append((first, end - first, cycles, parts))
+        return out, spans
+
+
+class Budget(object):
+    """The CPU time for one program on every slave.
+    """
+    def __init__(self, sim, stats, budget):
+        self.name = stats.name
+        self.start_tick = stats.start_tick
+        self.ticks = stats.ticks
+        self.overruns = []              # per slave
+        self.worst = None               # (cycles, tick, slave address, parts)
+        self.heavy = []                 # (cycles, tick, slave address, parts) over budget, busy ticks
+        for i, slave in enumerate(sim.slaves):
+            busy, spans = sim.ticks(i, stats.start_tick, stats.end_tick)
+            busy_ticks = [tick for tick, cycles, parts in busy]
+            overruns = sum(1 for tick, cycles, parts in busy if cycles > budget)
+            for first, count, cycles, parts in spans:
+                quiet = count - (bisect.bisect_left(busy_ticks, first + count) - bisect.bisect_left(busy_ticks, first))
+                if quiet > 0:
+                    if cycles > budget:
+                        overruns += quiet
+                    self._note(cycles, first, slave.address, parts)
+            for tick, cycles, parts in busy:
+                self._note(cycles, tick, slave.address, parts)
+                if cycles > budget:
+                    self.heavy.append((cycles, tick, slave.address, parts))
+            self.overruns.append(overruns)
+        self.heavy.sort(key=lambda h: (-h[0], h[1], h[2]))
+
+    def _note(self, cycles, tick, address, parts):
+        if self.worst is None or cycles > self.worst[0]:
+            self.worst = (cycles, tick, address, parts)
+
+
+def breakdown(parts):
+    """Where the time in a tick went, biggest first.
+    """
+    return ', '.join('%s %.2f' % (name, ms(cycles))
+                     for name, cycles in sorted(parts.items(), key=lambda p: (-p[1], p[0])) if cycles)
+
+
+def report(sim, budgets, budget, show):
+    slaves = sim.slaves
+    print('%-12s %7s %8s %5s %6s  %s' % ('program', 'ticks', 'worst ms', 'slave', 'over',
+                                         'overruns by slave ' + ''.join('%X' % (s.address % 16) for s in slaves)))
+    for b in budgets:
+        cycles, tick, address, parts = b.worst if b.worst else (0, b.start_tick, 0, {})
+        print('%-12s %7d %8.2f %5d %6d  %18s%s' % (b.name, b.ticks, ms(cycles), address, sum(b.overruns), '',
+                                                   ''.join('.' if n == 0 else '%X' % n if n < 16 else '+'
+                                                           for n in b.overruns)))
+        for cycles, tick, address, parts in b.heavy[:show]:
+            print('    tick %d on slave %d: %.2f ms = %s' % (tick - b.start_tick, address, ms(cycles), breakdown(parts)))
+        if len(b.heavy) > show:
+            print('    ... and %d more busy ticks over %.1f ms' % (len(b.heavy) - show, ms(budget)))
+
+
+def idle_report(model, slaves):
+    print('slave  strand      pixels  idle ms  all dynamics ms   (idle: %s)' % ', '.join(STEADY))
+    for config in slaves:
+        n = config.pixels_in_strand + 1
+        idle = model.steady(config, np.zeros(n), 0)
+        busy = model.steady(config, np.full(n, DYNAMICS_BLINK | DYNAMICS_THROB | DYNAMICS_SPARKLE), 0)
+        print('%5d  %-10s %7d %8.2f %16.2f   %s' % (
+            config.address, 'Starfish' if config.strand_type == isis_config.STRAND_STARFISH else 'Caroushell',
+            config.pixels_in_strand, ms(sum(idle.values())), ms(sum(busy.values())),
+            ' '.join('%.2f' % ms(idle[part]) for part in STEADY)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid slave CPU budget estimator')
+    parser.add_argument('files', nargs='*', help='.PKT files, PLAYLIST.TXT files and/or show files, played in order')
+    parser.add_argument('--show', type=int, default=5, metavar='N', help='list at most N overrunning ticks per program')
+    parser.add_argument('--slaves', action='store_true', help="list each slave's idle tick")
+    parser.add_argument('--cycles', metavar='FILE', help='JSON file of cycle counts to use instead of the estimates')
+    parser.add_argument('--budget', type=float, default=TICK_LENGTH, metavar='MS',
+                        help='CPU time a tick may take (default TICK_LENGTH)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for RANDOMIZE')
+    args = parser.parse_args(argv)
+
+    cycles = None
+    if args.cycles:
+        with open(args.cycles) as f:
+            cycles = json.load(f)
+    try:
+        model = CostModel(cycles)
+    except KeyError as e:
+        parser.error(e.args[0])
+    budget = int(args.budget * CPU_HZ / 1000)
+    if args.slaves:
+        idle_report(model, isis_config.load_config())
+    if not args.files:
+        return 0
+
+    programs = load_programs(args.files)
+    started = time.time()
+    sim = CpuSimulator(seed=args.seed, model=model)
+    for span in sim.play(programs):
+        pass
+    budgets = [Budget(sim, stats, budget) for stats in sim.stats]
+    elapsed = time.time() - started
+    report(sim, budgets, budget, args.show)
+    overruns = sum(sum(b.overruns) for b in budgets)
+    print('%d programs, %d ticks, estimated in %.3f s: %d slave ticks over %.1f ms' % (
+        len(budgets), sim.tick, elapsed, overruns, args.budget))
+    return 1 if overruns else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,356 @@
+#! /usr/bin/env python3
+
+# Decompiler for Isis Pyramid 1.1 PKT files.
+#
+# Turns a compiled lighting program back into source for lpcompile, for when the PKT
+# file on the SD card is all that's left. Every packet becomes the call that would have
+# made it (cmd_e_fill_rgb(DIAGS, 1,0,0, 255,0,0) and so on), with entity bitmaps spelled
+# with the usual names (ALL, DIAGS, SIDES, E_DIAG_0|E_DIAG_1). Packets no call can make
+# (wrong lengths, unknown commands) become write_packet() calls, and anything in the file
+# that isn't a packet at all (junk between packets, dropped packets) becomes write_raw(),
+# so that compiling the result gives back the very same bytes. That is checked, unless
+# --no-check says not to.
+#
+# Runs of calls that repeat with each number changing by a fixed step are folded back
+# into for loops, the way they were most likely written, e.g. the waits and fades of
+# wfade.py, or the hand-unrolled rainbow rotations of rbow1.py. A step may wrap around
+# the way a byte does (% 256), or the way the rainbow positions in rbow1.py do (% 255).
+#
+# The PKT file is read a packet at a time (see lpdump) and the source is written out as
+# it goes, looking ahead only far enough to see whether a loop continues, so even a
+# very large file is decompiled in a small, fixed amount of memory.
+#
+# Usage: lpdecompile [-o FILE] [--period N] [--no-check] file.PKT
+
+import argparse
+import io
+import os
+import sys
+
+from isis_packets import *
+import lpdump
+
+# Arguments of each call, after the bitmap: 8 and 16 bit numbers.
+SIGNATURES = {
+    'cmd_e_fill_rgb':   (8, 16, 16, 8, 8, 8),
+    'cmd_e_fill_d':     (8, 16, 16, 8),
+    'cmd_e_shift_up':   (8, 16, 16, 8, 8, 8, 8, 8),
+    'cmd_e_shift_down': (8, 16, 16, 8, 8, 8, 8, 8),
+    'cmd_e_rotate':     (8, 16, 16, 8, 8),
+    'cmd_e_randomize':  (8, 16, 16),
+    'cmd_e_loadone':    (8, 16, 16, 8, 8, 8, 8, 8),
+    'cmd_e_rainbow':    (8, 16, 16, 8, 8, 8),
+    'cmd_s_reset_clock': (),
+    'cmd_s_dyn_blink':  (16, 16, 8),
+    'cmd_s_dyn_throb':  (16, 16, 8, 8),
+    'cmd_s_dyn_sparkle': (16,),
+}
+
+ENTITY_CALLS = {
+    CMD_E_FILL_RGB:   'cmd_e_fill_rgb',
+    CMD_E_FILL_D:     'cmd_e_fill_d',
+    CMD_E_SHIFT_UP:   'cmd_e_shift_up',
+    CMD_E_SHIFT_DOWN: 'cmd_e_shift_down',
+    CMD_E_ROTATE:     'cmd_e_rotate',
+    CMD_E_RANDOMIZE:  'cmd_e_randomize',
+    CMD_E_LOADONE:    'cmd_e_loadone',
+    CMD_E_RAINBOW:    'cmd_e_rainbow',
+}
+
+SLAVE_CALLS = {
+    CMD_S_RESET_CLOCK: 'cmd_s_reset_clock',
+    CMD_S_DYN_BLINK:   'cmd_s_dyn_blink',
+    CMD_S_DYN_THROB:   'cmd_s_dyn_throb',
+    CMD_S_DYN_SPARKLE: 'cmd_s_dyn_sparkle',
+}
+
+META_CALLS = {
+    META_CONSOLE:    'console',
+    META_WAIT:       'wait_for_tick',
+    META_ENDS:       'ends_at_tick',
+    META_RESET_TIME: 'reset_master_clock',
+}
+
+# Entity bitmaps, biggest groups first.
+ENTITY_GROUPS = [(0xFFFF, 'ALL'), (0x00FF, 'DIAGS'), (0x0F00, 'SIDES')]
+ENTITY_BITS = ['E_DIAG_0', 'E_DIAG_1', 'E_DIAG_2', 'E_DIAG_3', 'E_DIAG_4', 'E_DIAG_5',
+               'E_DIAG_6', 'E_DIAG_7', 'E_LEFT', 'E_BACK', 'E_RIGHT', 'E_FRONT']
+
+MODULI = [256, 255]         # the ways a byte-sized step is allowed to wrap
+LOOKAHEAD = 1024            # calls to look at when deciding whether a loop starts here
+
+
+def entity_bitmap(bitmap):
+    """An entity bitmap as the names a programmer would use.
+    """
+    parts = []
+    for mask, name in ENTITY_GROUPS:
+        if bitmap & mask == mask:
+            parts.append(name)
+            bitmap &= ~mask
+    for bit, name in enumerate(ENTITY_BITS):
+        if bitmap & (1 << bit):
+            parts.append(name)
+            bitmap &= ~(1 << bit)
+    if bitmap or not parts:
+        parts.append('0x%04X' % bitmap)
+    return '|'.join(parts)
+
+
+def slave_bitmap(bitmap):
+    return 'ALL' if bitmap == PKT_ADDRESS_ALL_CALL else '0x%04X' % bitmap
+
+
+class Call(object):
+    """One statement of the program: a function and its arguments. Numbers in args may
+    change from one trip round a loop to the next; everything in fixed may not.
+    """
+    __slots__ = ('function', 'fixed', 'args', 'widths', 'key')
+
+    def __init__(self, function, fixed, args=(), widths=()):
+        self.function = function
+        self.fixed = fixed              # a string of leading arguments, as written
+        self.args = args
+        self.widths = widths
+        self.key = (function, fixed)    # the same for every trip round a loop
+
+    def source(self):
+        return '%s(%s)' % (self.function, ', '.join(([self.fixed] if self.fixed else []) +
+                                                     [str(a) for a in self.args]))
+
+
+def _field(packet, offset, width):
+    return packet[offset] if width == 8 else u16(packet, offset)
+
+
+def _fields(packet, offset, widths):
+    values = []
+    for width in widths:
+        values.append(_field(packet, offset, width))
+        offset += width // 8
+    return tuple(values), offset
+
+
+def packet_call(packet):
+    """The call that makes this packet, falling back to write_packet().
+    """
+    packet = bytes(packet)
+    code = packet[PKT_COMMAND_OFFSET]
+    function = None
+    if code == CMD_META:
+        if len(packet) > PKT_META_CMD_OFFSET:
+            function = META_CALLS.get(packet[PKT_META_CMD_OFFSET])
+        if function == 'reset_master_clock':
+            if len(packet) == 2:
+                return Call(function, '')
+        elif function is not None and len(packet) == 4:
+            return Call(function, '', (u16(packet, PKT_META_DATA_OFFSET),), (16,))
+    elif code & COMMAND_MASK in ENTITY_CALLS and code & ENTITY_ADDRESSED or code in SLAVE_CALLS:
+        entity = bool(code & ENTITY_ADDRESSED)
+        function = ENTITY_CALLS[code & COMMAND_MASK] if entity else SLAVE_CALLS[code]
+        widths = SIGNATURES[function]
+        if len(packet) == PKT_S_DATA_OFFSET + sum(widths) // 8:
+            args, end = _fields(packet, PKT_S_DATA_OFFSET, widths)
+            bitmap = u16(packet, PKT_ADDRESS_OFFSET)
+            fixed = entity_bitmap(bitmap) if entity else slave_bitmap(bitmap)
+            return Call(function, fixed, args, widths)
+    elif code == CMD_S_COMMENT and len(packet) >= 3 and u16(packet, PKT_ADDRESS_OFFSET) == 0xFFFF \
+            and len(packet) <= PKT_S_DATA_OFFSET + 11:
+        return Call('comment', repr(packet[PKT_S_DATA_OFFSET:].decode('latin-1')))
+    return Call('write_packet', '[%s]' % ', '.join('0x%02X' % b for b in packet))
+
+
+def program_calls(data):
+    """The calls that reproduce the contents of a PKT file, in order.
+    """
+    end = 0
+    for record in lpdump.records(data):
+        end = record.end
+        if record.error is not None:
+            yield Call('write_raw', repr(bytes(data[record.offset:record.end])))
+            continue
+        extra = record.escapes - sum(1 for b in record.packet if b in (FEND, FESC))
+        if extra:                       # back-to-back FENDs before the packet
+            yield Call('write_raw', repr(b'\xc0' * extra))
+        yield packet_call(record.packet)
+    if end < len(data):                 # FENDs after the last packet
+        yield Call('write_raw', repr(bytes(data[end:])))
+
+
+class _Progression(object):
+    """The ways one number can change round a loop: by a fixed step, or by a fixed
+    step wrapping around a modulus.
+    """
+    def __init__(self, first, second, width):
+        self.first = first
+        self.modes = [(None, second - first)]
+        if width == 8:
+            self.modes += [(m, (second - first) % m) for m in MODULI if first < m and second < m]
+
+    def allows(self, k, value):
+        """The modes that give value on the k'th trip round.
+        """
+        return [(m, step) for m, step in self.modes
+                if (self.first + k * step if m is None else (self.first + k * step) % m) == value]
+
+    def expression(self):
+        modulus, step = self.modes[0]
+        if step == 0:
+            return str(self.first)
+        if self.first == 0:
+            text = '%d*i' % step if step != 1 else 'i'
+        elif step < 0:
+            text = '%d - %s' % (self.first, '%d*i' % -step if step != -1 else 'i')
+        else:
+            text = '%d + %s' % (self.first, '%d*i' % step if step != 1 else 'i')
+        if modulus is not None:
+            text = '(%s) %% %d' % (text, modulus)
+        return text
+
+
+class _Lookahead(object):
+    """A window onto a stream of calls, filled as far as it needs to be.
+    """
+    def __init__(self, calls):
+        self.calls = iter(calls)
+        self.buffer = []
+        self.start = 0
+
+    def fill(self, count):
+        """True if there are count calls from the current one on.
+        """
+        while len(self.buffer) - self.start < count:
+            call = next(self.calls, None)
+            if call is None:
+                return False
+            self.buffer.append(call)
+        return True
+
+    def get(self, k):
+        """The call k places past the current one, or None past the end.
+        """
+        return self.buffer[self.start + k] if self.fill(k + 1) else None
+
+    def slice(self, begin, end):
+        return self.buffer[self.start + begin:self.start + end]
+
+    def advance(self, count):
+        self.start += count
+        if self.start > 4 * LOOKAHEAD:
+            del self.buffer[:self.start]
+            self.start = 0
+
+
+def _run(window, period, limit):
+    """How many times the block of period calls at the front of the window repeats,
+    each time with its numbers one step further on, and the progressions that do it.
+    Three times at least, or it's (1, None).
+    """
+    if not window.fill(3 * period):
+        return 1, None
+    keys = [call.key for call in window.slice(0, 3 * period)]
+    if keys[:period] != keys[period:2*period] or keys[:period] != keys[2*period:]:
+        return 1, None
+    first = window.slice(0, period)
+    second = window.slice(period, 2 * period)
+    third = window.slice(2 * period, 3 * period)
+    for c0, c1, c2 in zip(first, second, third):   # a quick look before the careful one
+        for a, b, c, width in zip(c0.args, c1.args, c2.args, c0.widths):
+            bend = c - 2 * b + a
+            if bend and not (width == 8 and any(bend % m == 0 for m in MODULI)):
+                return 1, None
+    progressions = [[_Progression(a, b, w) for a, b, w in zip(c.args, n.args, c.widths)]
+                    for c, n in zip(first, second)]
+    k = 2
+    while (limit is None or k * period < limit) and window.fill((k + 1) * period):
+        block = window.slice(k * period, (k + 1) * period)
+        if any(a.key != b.key for a, b in zip(first, block)):
+            break
+        allowed = [(p, p.allows(k, v)) for ps, call in zip(progressions, block)
+                   for p, v in zip(ps, call.args)]
+        if not all(modes for p, modes in allowed):
+            break
+        for p, modes in allowed:
+            p.modes = modes
+        k += 1
+    if k < 3:
+        return 1, None
+    return k, progressions
+
+
+def decompile(data, name, out, max_period=12):
+    """Write lpcompile source for the contents of a PKT file to out. Returns the number
+    of calls and the number of loops written.
+    """
+    out.write('# %s, decompiled by lpdecompile\n\n' % name)
+    out.write('filename(%r)\n' % name)
+    window = _Lookahead(program_calls(data))
+    calls = loops = 0
+    while window.get(0) is not None:
+        best = (1, 1, None)
+        for period in range(1, max_period + 1):
+            reps, progressions = _run(window, period, LOOKAHEAD)
+            if progressions is not None and reps * period >= 4 and reps * period > best[0] * best[1]:
+                best = (period, reps, progressions)
+        period, reps, progressions = best
+        if progressions is None:
+            out.write(window.get(0).source() + '\n')
+            window.advance(1)
+            calls += 1
+            continue
+        # A loop: now that it's decided, follow it as far as it goes.
+        reps, progressions = _run(window, period, None)
+        out.write('for i in range(%d):\n' % reps)
+        for j, ps in enumerate(progressions):
+            call = window.get(j)
+            out.write('    %s(%s)\n' % (call.function, ', '.join(
+                ([call.fixed] if call.fixed else []) + [p.expression() for p in ps])))
+        window.advance(period * reps)
+        calls += period * reps
+        loops += 1
+    return calls, loops
+
+
+def check(path, text):
+    """Compile decompiled source and see whether it makes the same bytes as path.
+    """
+    from lpcompiler import Compiler, MemorySink
+    compiler = Compiler(MemorySink())
+    compiler.run_source(text, '<decompiled %s>' % path)
+    compiler.close()
+    made = b''.join(compiler.sink.files.values())
+    with open(path, 'rb') as f:
+        return made == f.read()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid PKT file decompiler')
+    parser.add_argument('file', help='.PKT file to decompile')
+    parser.add_argument('-o', '--output', help='source file to write (default: standard output)')
+    parser.add_argument('--period', type=int, default=12, metavar='N',
+                        help='longest loop body to look for, in calls')
+    parser.add_argument('--no-check', dest='check', action='store_false',
+                        help="don't compile the result to check it round trips")
+    args = parser.parse_args(argv)
+
+    name = os.path.basename(args.file)
+    with lpdump.PktFile(args.file) as pkt:
+        if args.output:
+            with open(args.output, 'w') as out:
+                calls, loops = decompile(pkt.data, name, out, args.period)
+        else:
+            out = io.StringIO()
+            calls, loops = decompile(pkt.data, name, out, args.period)
+            sys.stdout.write(out.getvalue())
+    print('%s: %d calls, %d loops' % (name, calls, loops), file=sys.stderr)
+    if args.check:
+        text = open(args.output).read() if args.output else out.getvalue()
+        if not check(args.file, text):
+            print('%s: does NOT round trip!' % name, file=sys.stderr)
+            return 1
+        print('%s: round trips byte for byte' % name, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
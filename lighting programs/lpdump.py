@@ -0,0 +1,362 @@
+#! /usr/bin/env python3
+
+# Disassembler for Isis Pyramid 1.1 PKT files.
+#
+# Reads a compiled lighting program the way the master does, with handle_file_byte() in
+# isis_master.ino: a FEND opens a packet, back-to-back FENDs are ignored, a FEND closes
+# the packet, FESC TFEND and FESC TFESC are de-stuffed, anything else after a FESC drops
+# the packet, and so does a packet that runs to PACKET_MAX bytes. In each case it then
+# waits in IDLE for the next FEND. Each packet comes out as a typed record (command,
+# bitmap, repeat count, start tick, repeat interval and the rest of the payload, or the
+# subcommand and value of a META packet), and each thing the master would throw away
+# comes out as an error record saying why, with the file offsets either way.
+#
+# The file is mapped rather than read, and records are made one at a time as the file
+# is scanned, so a generated show of many megabytes never has to be in memory at once.
+# The scan jumps from flag to flag with find(), and a packet without escapes is handed
+# out as a memoryview of the mapping, not a copy; only the few packets with escapes
+# are de-stuffed byte by byte.
+#
+#     with PktFile('SONNET.PKT') as pkt:
+#         for record in pkt.records():
+#             ...
+#
+# Usage: lpdump [-x] [--errors] [--summary] file.PKT ...
+
+import argparse
+import collections
+import mmap
+import sys
+
+from isis_packets import *
+
+META, SLAVE, ENTITY, ERROR = 'META', 'SLAVE', 'ENTITY', 'ERROR'
+
+# Why a record is an ERROR.
+BAD_ESCAPE = 'bad escape'           # FESC followed by something other than TFEND or TFESC
+OVERFLOW = 'overflow'               # PACKET_MAX bytes without a closing FEND
+UNTERMINATED = 'unterminated'       # the file ended inside a packet
+JUNK = 'junk'                       # bytes between packets, skipped in IDLE
+
+
+class Record(object):
+    """One packet from a PKT file, or one stretch of the file the master throws away.
+    offset is where it starts in the file (its opening FEND) and end is just past its
+    closing FEND; packet is the de-stuffed packet, as a memoryview into the file where
+    no de-stuffing was needed. Fields missing from a short packet are None (the slaves
+    would use whatever was left in their receive buffer).
+    """
+    __slots__ = ('offset', 'end', 'packet', 'error')
+
+    def __init__(self, offset, end, packet, error=None):
+        self.offset = offset
+        self.end = end
+        self.packet = packet
+        self.error = error
+
+    @property
+    def kind(self):
+        if self.error is not None:
+            return ERROR
+        if self.packet[PKT_COMMAND_OFFSET] == CMD_META:
+            return META
+        if self.packet[PKT_COMMAND_OFFSET] & ENTITY_ADDRESSED:
+            return ENTITY
+        return SLAVE
+
+    @property
+    def wire_bytes(self):
+        """Bytes of the file the record takes, flags and escapes included.
+        """
+        return self.end - self.offset
+
+    @property
+    def escapes(self):
+        if self.error is not None:
+            return 0
+        return self.wire_bytes - len(self.packet) - 2
+
+    @property
+    def command(self):
+        if self.error is not None:
+            return None
+        return self.packet[PKT_COMMAND_OFFSET]
+
+    @property
+    def name(self):
+        if self.error is not None:
+            return self.error.upper().replace(' ', '_')
+        if len(self.packet) <= PKT_META_CMD_OFFSET and self.packet[PKT_COMMAND_OFFSET] == CMD_META:
+            return 'META'
+        return command_name(bytes(self.packet[:PKT_META_CMD_OFFSET+1]))
+
+    @property
+    def short(self):
+        """True if the packet is too short for its own header.
+        """
+        kind = self.kind
+        if kind == META:
+            return len(self.packet) < PKT_META_DATA_OFFSET
+        if kind == SLAVE:
+            return len(self.packet) < PKT_S_DATA_OFFSET
+        if kind == ENTITY:
+            return len(self.packet) < PKT_E_DATA_OFFSET
+        return False
+
+    def _u16(self, offset):
+        if self.error is None and len(self.packet) >= offset + 2:
+            return u16(self.packet, offset)
+        return None
+
+    @property
+    def bitmap(self):
+        if self.kind in (SLAVE, ENTITY):
+            return self._u16(PKT_ADDRESS_OFFSET)
+        return None
+
+    @property
+    def repeat_count(self):
+        if self.kind == ENTITY and len(self.packet) > PKT_REPEAT_COUNT_OFFSET:
+            return self.packet[PKT_REPEAT_COUNT_OFFSET]
+        return None
+
+    @property
+    def start_tick(self):
+        if self.kind == ENTITY:
+            return self._u16(PKT_EFFECTIVE_TIME_OFFSET)
+        return None
+
+    @property
+    def interval(self):
+        if self.kind == ENTITY:
+            return self._u16(PKT_REPEAT_INTERVAL_OFFSET)
+        return None
+
+    @property
+    def subcommand(self):
+        if self.kind == META and len(self.packet) > PKT_META_CMD_OFFSET:
+            return self.packet[PKT_META_CMD_OFFSET]
+        return None
+
+    @property
+    def value(self):
+        """The argument of a META packet (the tick of a WAIT or ENDS, the number of a CONSOLE).
+        """
+        if self.kind == META:
+            return self._u16(PKT_META_DATA_OFFSET)
+        return None
+
+    @property
+    def payload(self):
+        """The packet-specific arguments, after the common header.
+        """
+        offset = {META: PKT_META_DATA_OFFSET, SLAVE: PKT_S_DATA_OFFSET,
+                  ENTITY: PKT_E_DATA_OFFSET, ERROR: 0}[self.kind]
+        return self.packet[offset:]
+
+    def __repr__(self):
+        return 'Record(%d, %d, %s%s)' % (self.offset, self.end, self.name,
+                                         '' if self.error else ' ' + bytes(self.packet).hex())
+
+
+def records(data):
+    """Disassemble the contents of a PKT file (bytes, bytearray or mmap), yielding a
+    Record for every packet and for every stretch the master would throw away.
+    The packets are exactly the ones isis_packets.read_packets() finds.
+    """
+    view = memoryview(data)
+    find = data.find
+    n = len(data)
+    packet_max = PACKET_MAX
+    pos = 0
+    while True:
+        if pos < n and view[pos] == FEND:           # IDLE: wait for a FEND
+            start = pos                             # (usually the very next byte)
+        else:
+            start = find(b'\xc0', pos)
+        if start < 0:
+            if pos < n:
+                yield Record(pos, n, view[pos:n], JUNK)
+            return
+        if start > pos:
+            yield Record(pos, start, view[pos:start], JUNK)
+        body = start + 1
+        while body < n and view[body] == FEND:      # back-to-back FENDs, no action
+            body += 1
+        close = find(b'\xc0', body)
+        stop = n if close < 0 else close
+        if find(b'\xdb', body, stop) < 0:
+            # Nothing to de-stuff: the packet is a slice of the file.
+            if stop - body >= packet_max:
+                pos = body + packet_max             # overflow, back to IDLE
+                resume = find(b'\xc0', pos)
+                resume = n if resume < 0 else resume
+                yield Record(start, resume, view[body:resume], OVERFLOW)
+                pos = resume
+            elif close < 0:
+                if body < n:
+                    yield Record(start, n, view[body:n], UNTERMINATED)
+                return
+            else:
+                yield Record(start, close + 1, view[body:close])
+                pos = close + 1
+            continue
+
+        # Escapes: de-stuff them one at a time, copying the runs in between.
+        buf = bytearray()
+        error = None
+        i = body
+        while True:
+            esc = find(b'\xdb', i, stop)
+            run = (stop if esc < 0 else esc) - i
+            if run and len(buf) + run >= PACKET_MAX:
+                i += max(1, PACKET_MAX - len(buf))  # up to the byte that fills the buffer
+                error = OVERFLOW
+                break
+            buf += view[i:i+run]
+            if esc < 0:
+                i = stop
+                break
+            if esc + 1 >= n:
+                i = n
+                error = UNTERMINATED
+                break
+            b = view[esc+1]
+            i = esc + 2
+            if b == TFESC:
+                buf.append(FESC)
+            elif b == TFEND:
+                buf.append(FEND)
+            else:                                   # may even be the FEND we took for the end
+                error = BAD_ESCAPE
+                break
+            # A de-stuffed byte leaves the state machine in RECV, even past PACKET_MAX.
+        if error is None and close < 0:
+            error = UNTERMINATED
+        if error is None:
+            yield Record(start, close + 1, bytes(buf))
+            pos = close + 1
+        else:
+            resume = find(b'\xc0', i)
+            resume = n if resume < 0 else resume
+            yield Record(start, resume, view[body:resume], error)
+            pos = resume
+
+
+class PktFile(object):
+    """A PKT file mapped into memory, for disassembly with records().
+    Records that are views of the file are only good while it is open.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:                          # can't map an empty file
+            self.data = b''
+
+    def records(self):
+        return records(self.data)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:                     # records still hold views; let them
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+
+def format_record(record, tick, show_hex=False):
+    """One line of the listing.
+    """
+    kind = record.kind
+    fields = ''
+    if kind == ENTITY:
+        fields = '%-5s %-5s %-5s %-5s %s' % tuple(
+            '-' if v is None else ('%04X' % v if i == 0 else str(v))
+            for i, v in enumerate((record.bitmap, record.repeat_count, record.start_tick, record.interval,
+                                   ' '.join(str(b) for b in record.payload) or None)))
+    elif kind == SLAVE:
+        payload = record.payload
+        if record.command & COMMAND_MASK == CMD_S_COMMENT:
+            payload = repr(bytes(payload).decode('latin-1'))
+        else:
+            payload = ' '.join(str(b) for b in payload)
+        fields = '%-5s %-17s %s' % ('-' if record.bitmap is None else '%04X' % record.bitmap, '', payload)
+    elif kind == META:
+        fields = '-' if record.value is None else str(record.value)
+    else:
+        fields = '%d bytes' % record.wire_bytes
+    if record.short:
+        fields += '  (short; slaves would use stale bytes)'
+    line = '%08X %6s %-15s %s' % (record.offset, tick, record.name, fields)
+    if show_hex:
+        line += '\n' + ' ' * 16 + bytes(record.packet).hex(' ')
+    return line.rstrip()
+
+
+def dump(path, show_hex=False, errors_only=False, out=sys.stdout):
+    """Print a listing of a PKT file. Returns the number of error records.
+    """
+    errors = 0
+    tick = 0                    # the master's clock, as far as META_WAIT says
+    with PktFile(path) as pkt:
+        print('%s: %d bytes' % (path, len(pkt.data)), file=out)
+        print('  offset   tick command         bitmap rpt   start intvl payload', file=out)
+        for record in pkt.records():
+            kind = record.kind
+            if kind == META and record.subcommand == META_WAIT and record.value is not None:
+                tick = record.value
+            elif kind == META and record.subcommand == META_RESET_TIME:
+                tick = 0
+            elif kind == ERROR:
+                errors += 1
+            if not errors_only or kind == ERROR:
+                print(format_record(record, tick, show_hex), file=out)
+    return errors
+
+
+def summarize(path, out=sys.stdout):
+    """Print the count and bytes of each kind of packet in a PKT file. Returns the
+    number of error records.
+    """
+    counts = collections.Counter()
+    wire = collections.Counter()
+    errors = 0
+    with PktFile(path) as pkt:
+        for record in pkt.records():
+            counts[record.name] += 1
+            wire[record.name] += record.wire_bytes
+            errors += record.error is not None
+    print('%s: %d records, %d bytes' % (path, sum(counts.values()), sum(wire.values())), file=out)
+    for name in sorted(counts, key=lambda name: (-wire[name], name)):
+        print('  %-14s %6d %8d bytes' % (name, counts[name], wire[name]), file=out)
+    return errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid PKT file disassembler')
+    parser.add_argument('files', nargs='+', help='.PKT files to disassemble')
+    parser.add_argument('-x', '--hex', action='store_true', help='show the bytes of each packet too')
+    parser.add_argument('--errors', action='store_true', help='only list what the master would throw away')
+    parser.add_argument('--summary', action='store_true', help='only count the packets of each kind')
+    args = parser.parse_args(argv)
+
+    errors = 0
+    for path in args.files:
+        if args.summary:
+            errors += summarize(path)
+        else:
+            errors += dump(path, args.hex, args.errors)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
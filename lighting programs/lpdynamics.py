@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+# The slaves' pixel dynamics (BLINK, THROB, SPARKLE) for Isis Pyramid 1.1 previews.
+#
+# Dynamics never touch the entity buffers. Each tick, dynamics_precalc_tick() works out a
+# blink and a throb adjustment from current_tick, and then, as update_strand() shifts the
+# strand buffer out to the LEDs, dynamics_precalc_pixel() and dynamics_calc_component()
+# apply them to every pixel whose D byte asks for them: add_with_limit() the blink value,
+# add_with_limit() the throb value, and slam the pixel to white if SPARKLE's random(0xFFFF)
+# comes in under the sparkle probability. That's three calls per component per pixel per
+# tick in the firmware; here it's a handful of NumPy operations on an (N, 4) RGBD strand
+# buffer, for one tick or for a whole run of ticks at once.
+#
+# The arithmetic is the AVR's, bit for bit: int and unsigned are 16 bits, so the throb
+# ramp's products wrap at 65536 before the unsigned division, the results go through
+# int16_t on the way to dynamics_throb_value, and add_with_limit()'s sum wraps as an
+# int16_t before it is clamped. SPARKLE draws from AvrRandom, avr-libc's random() (the
+# Park-Miller minimal standard generator), one draw per SPARKLE pixel in strand order,
+# as the pipelined update does. The generator can be jumped ahead, so a run of ticks
+# takes all its draws at once. On the pyramid each slave seeds its own generator from
+# analogRead(0), and RANDOMIZE draws from it too, so matching a slave's sparkles needs
+# its seed; lpsim keeps RANDOMIZE on a generator of its own.
+#
+# lpsim --dynamics uses Renderer to apply the dynamics to the frames it saves, every
+# tick, on every pixel a slave displays, with that slave's settings and clock.
+#
+# Usage: lpdynamics [--blink PERIOD ONTIME DIMMING] [--throb PERIOD RAMPTIME BRIGHT DIM]
+#                   prints the blink and throb adjustments over one period
+
+import argparse
+import sys
+
+import numpy as np
+
+from isis_packets import *
+
+RANDOM_MAX = 0x7FFFFFFF     # avr-libc random() returns 0..RANDOM_MAX
+MULTIPLIER = 16807          # and steps x -> 16807 * x mod RANDOM_MAX
+SPARKLE_RANGE = 0xFFFF      # dynamics_precalc_pixel() calls random(0xFFFF)
+
+
+class Dynamics(object):
+    """A slave's dynamics settings, with the firmware's power-up defaults. lpsim's
+    SlaveState has the same attributes and serves just as well.
+    """
+    def __init__(self, blink_period=100, blink_ontime=50, blink_dimming=255, throb_period=100,
+                 throb_ramptime=10, throb_bright=10, throb_dim=10, sparkle_probability=0):
+        self.blink_period = blink_period
+        self.blink_ontime = blink_ontime
+        self.blink_dimming = blink_dimming
+        self.throb_period = throb_period
+        self.throb_ramptime = throb_ramptime
+        self.throb_bright = throb_bright
+        self.throb_dim = throb_dim
+        self.sparkle_probability = sparkle_probability
+
+
+def _int16(values):
+    return ((values + 0x8000) & 0xFFFF) - 0x8000
+
+
+def blink_values(ticks, period, ontime, dimming):
+    """dynamics_blink_value for each current_tick in ticks.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64) & 0xFFFF
+    return np.where(ticks % period < ontime, 0, -dimming).astype(np.int64)
+
+
+def throb_values(ticks, period, ramptime, bright, dim):
+    """dynamics_throb_value for each current_tick in ticks, in the AVR's 16-bit arithmetic.
+    """
+    t = (np.asarray(ticks, dtype=np.int64) & 0xFFFF) % period
+    r = ramptime
+    divisor = max(r, 1)             # a ramp time of 0 never gets as far as dividing
+    up = ((bright * t) & 0xFFFF) // divisor
+    down = ((bright * ((2*r - t) & 0xFFFF)) & 0xFFFF) // divisor
+    dimming = ((dim * ((t - 2*r) & 0xFFFF)) & 0xFFFF) // divisor
+    brightening = ((dim * ((4*r - t) & 0xFFFF)) & 0xFFFF) // divisor
+    return np.select([t < r, t < (2*r) & 0xFFFF, t < (3*r) & 0xFFFF, t < (4*r) & 0xFFFF],
+                     [_int16(up), _int16(down), _int16(-_int16(dimming)), _int16(-_int16(brightening))], 0)
+
+
+def add_with_limit(component, adj):
+    """add_with_limit(): component plus a signed adjustment, clamped to 0..255, the sum
+    wrapping as an int16_t first as it does on the AVR. Broadcasts.
+    """
+    result = _int16(np.asarray(component, dtype=np.int64) + np.asarray(adj, dtype=np.int64))
+    return np.clip(result, 0, 255).astype(np.uint8)
+
+
+def _do_random(x):
+    """One step of avr-libc's do_random(), on its signed 32-bit state: Schrage's method
+    for 16807 * x mod RANDOM_MAX, which a state set by srandom() can start off outside of.
+    """
+    if x == 0:
+        x = 123459876
+    hi = abs(x) // 127773 * (1 if x > 0 else -1)    # C division truncates
+    lo = x - hi * 127773
+    x = 16807 * lo - 2836 * hi
+    if x < 0:
+        x += RANDOM_MAX
+    return x
+
+
+class AvrRandom(object):
+    """avr-libc's random(), with its state, able to take any number of draws at once.
+    After the first draw, the state is in 1..RANDOM_MAX-1 and each draw is just the one
+    before times 16807, mod RANDOM_MAX, so the kth one on is the first times 16807 ** k.
+    """
+    _powers = np.array([1, MULTIPLIER], dtype=np.uint64)  # MULTIPLIER ** k mod RANDOM_MAX
+
+    def __init__(self, seed=1):
+        self.state = 1
+        self.seed(seed)
+
+    def seed(self, seed):
+        """randomSeed(): a seed of 0 leaves the generator as it was.
+        """
+        if seed:
+            seed &= 0xFFFFFFFF
+            self.state = seed - (1 << 32) if seed & 0x80000000 else seed
+
+    @classmethod
+    def _powers_to(cls, count):
+        powers = cls._powers
+        while len(powers) < count:          # a^(n+k) = a^k * a^n, doubling the table each time
+            powers = np.concatenate([powers, powers * (powers[-1] * np.uint64(MULTIPLIER) % np.uint64(RANDOM_MAX))
+                                     % np.uint64(RANDOM_MAX)])
+        cls._powers = powers
+        return powers[:count]
+
+    def draws(self, count):
+        """The next count values of random(), as an int64 array.
+        """
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+        first = _do_random(self.state)
+        values = np.uint64(first) * self._powers_to(count) % np.uint64(RANDOM_MAX)
+        self.state = int(values[-1])
+        return values.astype(np.int64)
+
+    def random(self, howbig, count):
+        """The next count values of Arduino's random(howbig).
+        """
+        if howbig == 0:
+            return np.zeros(count, dtype=np.int64)
+        return self.draws(count) % howbig
+
+
+def apply(rgbd, ticks, params, rng=None):
+    """What the strand shows for an (N, 4) RGBD strand buffer: (N, 3) for a single
+    current_tick, (T, N, 3) for a sequence of them. params holds the slave's settings
+    (see Dynamics); rng, an AvrRandom, is only needed if a pixel has SPARKLE set.
+    """
+    rgbd = np.asarray(rgbd, dtype=np.uint8)
+    single = np.ndim(ticks) == 0
+    ticks = np.atleast_1d(np.asarray(ticks, dtype=np.int64))
+    rgb = np.broadcast_to(rgbd[:, :3], (len(ticks),) + rgbd[:, :3].shape)
+    d = rgbd[:, 3]
+    if not d.any():
+        out = rgb.copy()
+        return out[0] if single else out
+
+    out = rgb.astype(np.int64)
+    blink = d & DYNAMICS_BLINK != 0
+    if blink.any():
+        adj = blink_values(ticks, params.blink_period, params.blink_ontime, params.blink_dimming)
+        out[:, blink] = add_with_limit(out[:, blink], adj[:, None, None])
+    throb = d & DYNAMICS_THROB != 0
+    if throb.any():
+        adj = throb_values(ticks, params.throb_period, params.throb_ramptime,
+                           params.throb_bright, params.throb_dim)
+        out[:, throb] = add_with_limit(out[:, throb], adj[:, None, None])
+    sparkle = np.flatnonzero(d & DYNAMICS_SPARKLE)
+    if len(sparkle):
+        draws = rng.random(SPARKLE_RANGE, len(ticks) * len(sparkle)).reshape(len(ticks), len(sparkle))
+        now = draws < params.sparkle_probability
+        lit = out[:, sparkle]
+        lit[now] = 255
+        out[:, sparkle] = lit
+    out = out.astype(np.uint8)
+    return out[0] if single else out
+
+
+class Renderer(object):
+    """Applies the dynamics to lpsim's frames, slave by slave: each slave's strand buffer
+    (see Simulator.strands()) goes through apply() with its settings, clock and
+    generator, and its pixels are put back in place. Slave N's generator is seeded with
+    seed + N, as the real ones don't sparkle in step either.
+    """
+    def __init__(self, sim, seed=1):
+        self.sim = sim
+        self.rngs = [AvrRandom(seed + slave.address) for slave in sim.slaves]
+        self.shown = []             # per slave: (strand pixels, entities, entity pixels) it displays
+        for slave in sim.slaves:
+            entities, pixels = slave.config.strand_map()
+            shown = np.flatnonzero(entities >= 0)
+            self.shown.append((shown, entities[shown], pixels[shown]))
+
+    def render(self, first, count, frame):
+        """The count ticks of a frame span from the Simulator, shape (count, 12, 96, 3),
+        with the dynamics applied. Call it as the span comes out of Simulator.play(), while
+        the slaves' settings and clocks are still the ones it was shown with.
+        """
+        frames = np.broadcast_to(frame, (count,) + frame.shape).copy()
+        ticks = np.arange(first, first + count)
+        strands = self.sim.strands()
+        for slave, strand, rng, (shown, entities, pixels) in zip(self.sim.slaves, strands, self.rngs, self.shown):
+            strand = strand[:slave.config.pixels_in_strand+1]
+            if not strand[:, 3].any():
+                continue
+            frames[:, entities, pixels] = apply(strand, ticks - slave.origin, slave, rng)[:, shown]
+        return frames
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid slave dynamics')
+    parser.add_argument('--blink', nargs=3, type=int, metavar=('PERIOD', 'ONTIME', 'DIMMING'),
+                        default=[100, 50, 255], help='blink settings (default: the power-up ones)')
+    parser.add_argument('--throb', nargs=4, type=int, metavar=('PERIOD', 'RAMPTIME', 'BRIGHT', 'DIM'),
+                        default=[100, 10, 10, 10], help='throb settings (default: the power-up ones)')
+    args = parser.parse_args(argv)
+
+    np.set_printoptions(linewidth=100, threshold=100000)
+    period, ontime, dimming = args.blink
+    print('blink, period %d, on %d, dimming %d:' % (period, ontime, dimming))
+    print(blink_values(np.arange(period), period, ontime, dimming))
+    period, ramptime, bright, dim = args.throb
+    print('throb, period %d, ramp %d, bright %d, dim %d:' % (period, ramptime, bright, dim))
+    print(throb_values(np.arange(period), period, ramptime, bright, dim))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,326 @@
+#! /usr/bin/env python3
+
+# Rendered-frame cache for Isis Pyramid 1.1 lighting programs.
+#
+# lpsim can play a ten-minute show in a couple of seconds, but previewing, diffing and
+# checking long programs means playing them over and over, and always from tick 0. This
+# plays a program (or a whole playlist) once with lpsim and keeps what the pyramid shows
+# on every 10 ms tick in a file, which is memory mapped when it's looked at again. Any
+# tick's frame is then one lookup away: tick 40,000 of a ten-minute show costs the same
+# as tick 0.
+#
+# The file holds:
+#   - every distinct frame, once: the RGB of all 928 entity pixels (the padding of the
+#     shorter entities isn't kept), 2784 bytes each;
+#   - a frame number for every tick, as a uint32, since the lights mostly stay put from
+#     one tick to the next;
+#   - a keyframe every so many ticks (--keyframes, 1000 by default): a snapshot of the
+#     simulator at the start of that tick, with every slave's entity buffers (dynamics
+#     bytes included), clock, deferred queue and dynamics settings, and the state of
+#     the RANDOMIZE generator. Frames.resume() restores a Simulator from the keyframe
+#     before a tick, and it carries on from there exactly as if it had played from the
+#     start.
+#
+# The cache is keyed by a hash of the PKT files (and the random seed, the keyframe spacing
+# and the simulator's own source), so it's only built once for any given show, and a
+# recompiled program gets a fresh one. Cache files go in a framecache directory next to
+# the first PKT file unless --cache says otherwise.
+#
+# Usage: lpframes [--seed N] [--keyframes TICKS] [--cache DIR] [--tick N ...]
+#                 [--diff OTHER ...] PLAYLIST.TXT | file.PKT ...
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+import lpsim
+
+MAGIC = b'ISISFRM1'
+PREFIX = struct.Struct('<8sQQ')     # magic, header offset, header length
+ALIGN = 64
+KEYFRAME_INTERVAL = 1000            # ticks between keyframes (10 seconds)
+CACHE_DIR = 'framecache'
+
+# What the frames depend on, besides the PKT files themselves.
+SIMULATOR_SOURCES = ['lpsim.py', 'lpcolor.py', 'isis_packets.py', 'isis_config.py',
+                     os.path.join(os.pardir, 'isis_config', 'isis_config.ino')]
+
+
+def cache_key(programs, seed=0, interval=KEYFRAME_INTERVAL):
+    """Hash identifying the frames of a sequence of (name, contents) programs.
+    """
+    h = hashlib.sha256(b'%s seed %d keyframes %d\n' % (MAGIC, seed, interval))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in SIMULATOR_SOURCES:
+        path = os.path.join(here, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    for name, data in programs:
+        h.update(name.encode() + b'\n' + hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+
+def _pixel_mask(slaves):
+    """Which (entity, pixel) places of a (12, 96, 3) frame are real pixels.
+    """
+    counts = isis_config.entity_pixel_counts(slaves)
+    return np.arange(lpsim.MAX_PIXELS)[np.newaxis, :] < np.array(counts)[:, np.newaxis]
+
+
+def _pad(f):
+    f.write(bytes(-f.tell() % ALIGN))
+    return f.tell()
+
+
+def _jsonable(state):
+    """A simulator snapshot, minus its buffers, in a form json can write.
+    """
+    state = dict(state)
+    del state['buffers']
+    state['rcv_buffer'] = state['rcv_buffer'].hex()
+    state['slaves'] = [dict(slave, queue=[slot.hex() for slot in slave['queue']]) for slave in state['slaves']]
+    return state
+
+
+def _unjsonable(state, buffers):
+    state = dict(state, buffers=buffers, rcv_buffer=bytes.fromhex(state['rcv_buffer']))
+    state['slaves'] = [dict(slave, queue=[bytes.fromhex(slot) for slot in slave['queue']])
+                       for slave in state['slaves']]
+    return state
+
+
+def build(path, programs, seed=0, interval=KEYFRAME_INTERVAL, slaves=None):
+    """Play the programs and write their frame cache to path.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    mask = _pixel_mask(slaves)
+    sim = lpsim.Simulator(slaves, seed)
+    index = []                      # frame number of every tick
+    seen = {}                       # digest of a frame -> its number
+    keyframes = []
+    buffers_offsets = []
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, 0, 0))
+        frames_offset = _pad(f)
+
+        def checkpoint(events):
+            state = sim.snapshot()
+            keyframes.append(dict(_jsonable(state), events=events))
+            snapshots.append(state['buffers'])
+
+        snapshots = []
+        for first, count, frame in sim.play(programs, every=interval, checkpoint=checkpoint):
+            packed = frame[mask].tobytes()
+            digest = hashlib.blake2b(packed, digest_size=16).digest()
+            number = seen.get(digest)
+            if number is None:
+                number = seen[digest] = len(seen)
+                f.write(packed)
+            index.extend([number] * count)
+
+        index_offset = _pad(f)
+        f.write(np.array(index, dtype='<u4').tobytes())
+        for buffers in snapshots:
+            buffers_offsets.append(_pad(f))
+            f.write(buffers.tobytes())
+
+        header = {
+            'version': 1,
+            'key': cache_key(programs, seed, interval),
+            'programs': [[name, hashlib.sha256(data).hexdigest()] for name, data in programs],
+            'stats': [[st.name, st.start_tick, st.end_tick] for st in sim.stats],
+            'seed': seed,
+            'ticks': len(index),
+            'pixel_counts': isis_config.entity_pixel_counts(slaves),
+            'frames': len(seen),
+            'frames_offset': frames_offset,
+            'index_offset': index_offset,
+            'keyframe_interval': interval,
+            'buffers_shape': list(sim.buffers.shape),
+            'keyframes': [dict(keyframe, buffers_offset=offset)
+                          for keyframe, offset in zip(keyframes, buffers_offsets)],
+        }
+        header_offset = _pad(f)
+        text = json.dumps(header).encode()
+        f.write(text)
+        f.seek(0)
+        f.write(PREFIX.pack(MAGIC, header_offset, len(text)))
+    os.replace(temp, path)
+
+
+class Frames(object):
+    """The cached frames of a show, memory mapped. frame(tick) is what lpsim's frame()
+    would have been during that tick.
+    """
+    def __init__(self, path, programs=None):
+        self.path = path
+        self.programs = programs
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, length = PREFIX.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame cache' % path)
+        self.header = json.loads(self._map[offset:offset+length].decode())
+        self.ticks = self.header['ticks']
+        self.pixel_counts = self.header['pixel_counts']
+        self.mask = np.arange(lpsim.MAX_PIXELS)[np.newaxis, :] < np.array(self.pixel_counts)[:, np.newaxis]
+        pixels = sum(self.pixel_counts)
+        self.packed = np.frombuffer(self._map, dtype=np.uint8, count=self.header['frames'] * pixels * 3,
+                                    offset=self.header['frames_offset']).reshape(-1, pixels, 3)
+        self.index = np.frombuffer(self._map, dtype='<u4', count=self.ticks, offset=self.header['index_offset'])
+
+    def __len__(self):
+        return self.ticks
+
+    def pixels(self, tick):
+        """The 928 entity pixels shown during a tick, entity by entity, shape (928, 3).
+        A view of the cache file; no copying.
+        """
+        return self.packed[self.index[tick]]
+
+    def frame(self, tick):
+        """The frame shown during a tick, laid out as lpsim's are, shape (12, 96, 3).
+        """
+        frame = np.zeros(self.mask.shape + (3,), dtype=np.uint8)
+        frame[self.mask] = self.pixels(tick)
+        return frame
+
+    def changes(self, first=0, stop=None):
+        """The ticks in [first, stop) at which the frame differs from the tick before.
+        """
+        stop = self.ticks if stop is None else min(stop, self.ticks)
+        index = self.index[first:stop]
+        return first + np.flatnonzero(np.diff(index.astype(np.int64), prepend=-1) != 0)
+
+    def keyframe(self, tick):
+        """The last keyframe at or before a tick, as a Simulator.snapshot() state plus
+        the number of playout events handled before it.
+        """
+        keyframes = self.header['keyframes']
+        number = min(tick // self.header['keyframe_interval'], len(keyframes) - 1)
+        saved = keyframes[number]
+        shape = tuple(self.header['buffers_shape'])
+        buffers = np.frombuffer(self._map, dtype=np.uint8, count=int(np.prod(shape)),
+                                offset=saved['buffers_offset']).reshape(shape)
+        return _unjsonable(saved, buffers), saved['events']
+
+    def resume(self, tick, slaves=None):
+        """A Simulator restored from the last keyframe at or before a tick, and the rest of
+        the show from there as a generator of frame spans, like Simulator.play()'s. This is
+        for carrying on with the simulation itself (to look at queues or stats, say) without
+        playing everything before the keyframe again.
+        """
+        if self.programs is None:
+            raise ValueError('the programs are needed to carry on from a keyframe')
+        state, events = self.keyframe(tick)
+        sim = lpsim.Simulator(slaves, self.header['seed'])
+        sim.restore(state)
+        return sim, sim.play(self.programs, skip=events)
+
+    def close(self):
+        self.packed = self.index = None
+        try:
+            self._map.close()
+        except BufferError:             # someone still has frames from it; leave it to them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+
+def open_frames(programs, seed=0, interval=KEYFRAME_INTERVAL, cache=CACHE_DIR, log=None):
+    """The Frames of a sequence of (name, contents) programs, from the cache if they're
+    there, or made and put there first.
+    """
+    key = cache_key(programs, seed, interval)
+    path = os.path.join(cache, key[:24] + '.frm')
+    if not os.path.exists(path):
+        os.makedirs(cache, exist_ok=True)
+        started = time.time()
+        build(path, programs, seed, interval)
+        if log:
+            log('built %s in %.2f s' % (path, time.time() - started))
+    return Frames(path, programs)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid rendered-frame cache')
+    parser.add_argument('files', nargs='+', help='.PKT files and/or PLAYLIST.TXT files, played in order')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for RANDOMIZE')
+    parser.add_argument('--keyframes', type=int, default=KEYFRAME_INTERVAL, metavar='TICKS',
+                        help='ticks between keyframes (default %d)' % KEYFRAME_INTERVAL)
+    parser.add_argument('--cache', metavar='DIR', help='cache directory (default framecache beside the first file)')
+    parser.add_argument('--tick', type=int, action='append', default=[], metavar='N',
+                        help='show what each entity looks like at tick N')
+    parser.add_argument('--diff', nargs='+', metavar='OTHER',
+                        help='compare with another show (PKT files and/or playlists)')
+    args = parser.parse_args(argv)
+
+    cache = args.cache or os.path.join(os.path.dirname(args.files[0]), CACHE_DIR)
+    log = lambda message: print(message)
+    started = time.time()
+    frames = open_frames(lpsim.load_programs(args.files), args.seed, args.keyframes, cache, log)
+    print('%s: %d ticks (%.1f s of show), %d distinct frames, %d keyframes, opened in %.3f s' % (
+        frames.path, frames.ticks, frames.ticks * TICK_LENGTH / 1000.0, frames.header['frames'],
+        len(frames.header['keyframes']), time.time() - started))
+
+    for tick in args.tick:
+        if not 0 <= tick < frames.ticks:
+            print('tick %d: past the end of the show' % tick)
+            continue
+        started = time.time()
+        pixels = frames.pixels(tick)
+        elapsed = time.time() - started
+        print('tick %d (frame %d, looked up in %.1f us):' % (tick, frames.index[tick], elapsed * 1e6))
+        first = 0
+        for entity, count in enumerate(frames.pixel_counts):
+            colors = pixels[first:first+count]
+            first += count
+            unique = np.unique(colors, axis=0)
+            if len(unique) == 1:
+                print('  entity %2d: all %3d %3d %3d' % ((entity,) + tuple(unique[0])))
+            else:
+                print('  entity %2d: %d colors, mean %5.1f %5.1f %5.1f' % ((entity, len(unique)) +
+                                                                        tuple(colors.mean(axis=0))))
+
+    if args.diff:
+        other = open_frames(lpsim.load_programs(args.diff), args.seed, args.keyframes, cache, log)
+        ticks = min(frames.ticks, other.ticks)
+        # Two frame numbers can only be compared within one file; compare the frames
+        # themselves wherever either show changes.
+        changes = np.union1d(frames.changes(0, ticks), other.changes(0, ticks))
+        bounds = np.append(changes, ticks)
+        differing = 0
+        first_diff = None
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if not np.array_equal(frames.pixels(start), other.pixels(start)):
+                differing += stop - start
+                if first_diff is None:
+                    first_diff = start
+        if frames.ticks != other.ticks:
+            print('the shows are %d and %d ticks long' % (frames.ticks, other.ticks))
+        if first_diff is None:
+            print('the frames of the first %d ticks are the same' % ticks)
+        else:
+            print('%d of the first %d ticks differ, the first at tick %d' % (differing, ticks, first_diff))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,463 @@
+#! /usr/bin/env python3
+
+# The real slave and master firmware, built for the host and driven from Python.
+#
+# isis_slave.ino and isis_master.ino compile unchanged with g++ against the Arduino shim
+# in isis_host/ (see isis_host/Arduino.h), each into a shared library that ctypes loads:
+# the same handle_serial_byte(), scan_deferred_queue(), refresh_segments() and dynamics
+# code that runs on the Diavolinos, on a virtual clock, with a file-backed SD card and a
+# serial port that keeps time at 9600 baud. lpsim models that code; this runs it.
+#
+#   HostSlave    one slave, set up from its isis_config table: push bus bytes in (each
+#                with the time it arrives), run it for a while or a number of ticks, and
+#                read its entity buffers, strand buffer, deferred queue, and the bytes it
+#                last shifted out to the strand, dynamics and all
+#   HostMaster   the master, playing PLAYLIST.TXT out of a directory: what it sends on
+#                the bus, with the time each byte has gone out
+#   HostPyramid  a master and the 16 slaves, the bus bytes passed from one to the others
+#
+# Each instance is a private copy of its library, since the sketch's globals are all the
+# state there is. The libraries are built in isis_host/build the first time they're
+# wanted, and again whenever a sketch or the shim changes. The Arduino IDE writes
+# prototypes for a sketch's functions before compiling it; prototypes() does that here.
+#
+# --bench runs one slave as fast as it will go, with every pixel blinking, throbbing and
+# sparkling and a rainbow rotating on each entity. --fuzz throws random packets at
+# handle_serial_byte() and runs the ticks, stopping at the first one that hangs; with
+# --sanitize the slave is built with AddressSanitizer and run in a child process, so
+# writes outside the buffers stop it too. (Without it they go unnoticed, or bring Python
+# down later on. LOADONE doesn't check its pixel index, for one.)
+#
+# Usage: lphost [--build] [--bench TICKS] [--fuzz PACKETS [--sanitize] [--seed N]]
+#               [--play SECONDS DIR]
+
+import argparse
+import atexit
+import ctypes
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+HOST_DIR = os.path.join(ROOT, 'isis_host')
+BUILD_DIR = os.path.join(HOST_DIR, 'build')
+SHIM = ['Arduino.h', 'host.cpp', 'EEPROM.h', 'SPI.h', 'SD.h', 'SoftwareSerial.h', 'digitalWriteFast.h']
+
+# kind -> (the file that builds it, the sketch files it includes)
+SKETCHES = {
+    'slave': ('isis_slave_host.cpp', ['isis_slave/isis_slave.ino', 'isis_slave/isis_packets.h']),
+    'master': ('isis_master_host.cpp', ['isis_master/isis_master.ino', 'isis_master/isis_user_c.ino',
+                                        'isis_master/isis_packets.h']),
+}
+
+CXX = os.environ.get('CXX', 'g++')
+CXXFLAGS = ['-O2', '-std=gnu++11', '-fPIC', '-shared', '-fno-strict-aliasing']
+SANITIZE = ['-fsanitize=address', '-fno-omit-frame-pointer', '-g']
+
+US_PER_TICK = TICK_LENGTH * 1000
+WATCHDOG_SECONDS = 10       # HOST_WATCHDOG_US in Arduino.h
+
+
+class HostError(Exception):
+    pass
+
+
+def prototypes(text):
+    """Declarations for the functions a sketch defines, as the Arduino IDE would write them.
+    """
+    text = re.sub(r'//[^\n]*|/\*.*?\*/', '', text, flags=re.S)     # left to right: //*** isn't /*
+    found = []
+    for ret, name, args in re.findall(r'^([A-Za-z_][\w \t*]*?[\s*])([A-Za-z_]\w*)\s*\(([^)]*)\)\s*\{',
+                                      text, flags=re.M):
+        if ret.strip() not in ('else', 'return'):
+            found.append('%s%s(%s);' % (ret, name, args))
+    return found
+
+
+def build(kind, force=False, sanitize=False):
+    """The path of the library for 'slave' or 'master', building it if it's out of date.
+    """
+    main, sketches = SKETCHES[kind]
+    suffix = '_asan' if sanitize else ''
+    library = os.path.join(BUILD_DIR, 'libisis_%s%s.so' % (kind, suffix))
+    sources = [os.path.join(HOST_DIR, name) for name in SHIM + [main]] + \
+              [os.path.join(ROOT, name) for name in sketches]
+    if (not force and os.path.exists(library) and
+            os.path.getmtime(library) >= max(os.path.getmtime(path) for path in sources)):
+        return library
+
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    header = os.path.join(BUILD_DIR, 'isis_%s_prototypes.h' % kind)
+    with open(header, 'w') as f:
+        f.write('// Written by lphost.py: prototypes for the functions of %s.\n' % ', '.join(sketches))
+        for sketch in sketches:
+            with open(os.path.join(ROOT, sketch)) as source:
+                f.write('\n'.join(prototypes(source.read())) + '\n')
+    command = ([CXX] + CXXFLAGS + (SANITIZE if sanitize else []) +
+               ['-I', HOST_DIR, '-include', 'Arduino.h', '-include', header, '-o', library,
+                os.path.join(HOST_DIR, main), os.path.join(HOST_DIR, 'host.cpp')])
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        raise HostError('building %s failed:\n%s' % (library, result.stdout))
+    return library
+
+
+_copies = None
+_loaded = 0
+
+
+def _load(kind):
+    """A private copy of the library, so each instance has its own globals. The copies
+    need names of their own too: dlopen() hands back the library it already has for a name.
+    """
+    global _copies, _loaded
+    sanitize = bool(os.environ.get('LPHOST_SANITIZE'))
+    library = build(kind, sanitize=sanitize)
+    if _copies is None:
+        _copies = tempfile.mkdtemp(prefix='lphost')
+        atexit.register(shutil.rmtree, _copies, True)
+    _loaded += 1
+    copy = os.path.join(_copies, '%d_%s' % (_loaded, os.path.basename(library)))
+    shutil.copyfile(library, copy)
+    lib = ctypes.CDLL(copy)
+    if not sanitize:                # the sanitizer reads the file for its reports
+        os.unlink(copy)             # the loaded copy stays mapped
+
+    u8p = ctypes.POINTER(ctypes.c_uint8)
+    intp = ctypes.POINTER(ctypes.c_int)
+    lib.host_run.argtypes = [ctypes.c_uint64]
+    lib.host_current_tick.restype = ctypes.c_uint16
+    lib.host_serial_push.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint64), ctypes.c_int]
+    lib.host_serial_output.argtypes = [u8p, ctypes.POINTER(ctypes.c_uint64), ctypes.c_int]
+    lib.host_serial_dropped.restype = ctypes.c_uint32
+    lib.host_debug_output.argtypes = [ctypes.c_char_p, ctypes.c_int]
+    lib.host_spi_last.argtypes = [u8p, ctypes.c_int]
+    lib.host_spi_total.restype = ctypes.c_uint64
+    if kind == 'slave':
+        lib.host_setup.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_int]
+        lib.host_next_tick_us.restype = ctypes.c_uint64
+        lib.host_handle_bytes.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        lib.host_strand.argtypes = [intp]
+        lib.host_strand.restype = u8p
+        lib.host_entity.argtypes = [ctypes.c_int, intp, intp]
+        lib.host_entity.restype = u8p
+        lib.host_queue.argtypes = [intp, intp]
+        lib.host_queue.restype = u8p
+    else:
+        lib.host_setup.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        lib.host_waitfor_tick.restype = ctypes.c_uint16
+        lib.host_filename.argtypes = [intp]
+        lib.host_filename.restype = ctypes.c_char_p
+        lib.host_pin.argtypes = [ctypes.c_int, ctypes.c_int]
+    return lib
+
+
+class _Host(object):
+    """What the slave and the master have in common: the clock, the serial port and the
+    debug output.
+    """
+    def _check(self, result, what):
+        if result != 0:
+            text = self.debug_text().strip()
+            raise HostError('%s: %s ran for more than %d seconds without coming back%s' % (
+                self, what, WATCHDOG_SECONDS, ' (it said: %s)' % ' / '.join(text.splitlines()) if text else ''))
+
+    @property
+    def now_us(self):
+        return ctypes.c_uint64.in_dll(self.lib, 'host_clock_us').value
+
+    @property
+    def current_tick(self):
+        return self.lib.host_current_tick()
+
+    def run(self, until_us):
+        """Run loop() until the clock reaches until_us.
+        """
+        self._check(self.lib.host_run(until_us), 'loop()')
+
+    def feed(self, data, times_us=None):
+        """Bytes arriving on the serial port: all now, or each at its time in times_us.
+        """
+        data = bytes(data)
+        times = None
+        if times_us is not None:
+            times = (ctypes.c_uint64 * len(data))(*[int(t) for t in times_us])
+        self.lib.host_serial_push(data, times, len(data))
+
+    def output(self):
+        """The bytes written to the serial port since last asked, and when each had gone out.
+        """
+        data = bytearray()
+        times = []
+        chunk = 4096
+        buf = (ctypes.c_uint8 * chunk)()
+        stamps = (ctypes.c_uint64 * chunk)()
+        while True:
+            count = self.lib.host_serial_output(buf, stamps, chunk)
+            data += bytes(buf[:count])
+            times += stamps[:count]
+            if count < chunk:
+                return bytes(data), np.array(times, dtype=np.uint64)
+
+    def debug_text(self):
+        """What the sketch has printed on its SoftwareSerial since last asked.
+        """
+        text = b''
+        buf = ctypes.create_string_buffer(4096)
+        while True:
+            count = self.lib.host_debug_output(buf, len(buf))
+            text += buf.raw[:count]
+            if count < len(buf):
+                return text.decode('latin-1')
+
+    @property
+    def dropped(self):
+        """Bytes lost to a full serial receive buffer.
+        """
+        return self.lib.host_serial_dropped()
+
+
+class HostSlave(_Host):
+    """One slave, running isis_slave.ino. slave is its isis_config.Slave; analog is what
+    analogRead(0) gives randomSeed() at powerup.
+    """
+    def __init__(self, slave, analog=0):
+        self.config = slave
+        self.lib = _load('slave')
+        image = slave.eeprom()
+        self._check(self.lib.host_setup(image, len(image), analog), 'setup()')
+
+    def __repr__(self):
+        return 'HostSlave(%d)' % self.config.address
+
+    def run_ticks(self, count):
+        """Run loop() through count more ticks.
+        """
+        if count > 0:
+            self.run(self.lib.host_next_tick_us() + (count - 1) * US_PER_TICK)
+
+    def handle(self, data):
+        """Bytes straight into handle_serial_byte(), with no time passing.
+        """
+        data = bytes(data)
+        self._check(self.lib.host_handle_bytes(data, len(data)), 'handle_serial_byte()')
+
+    def strand(self):
+        """A copy of the strand buffer, (pixels_in_strand + 1, 4) RGBD.
+        """
+        count = ctypes.c_int()
+        pointer = self.lib.host_strand(ctypes.byref(count))
+        return np.ctypeslib.as_array(pointer, (count.value, 4)).copy()
+
+    def entities(self):
+        """Copies of the entity buffers, {entity address: (pixels, 4) RGBD}.
+        """
+        buffers = {}
+        address, count = ctypes.c_int(), ctypes.c_int()
+        for n in range(self.lib.host_entity_count()):
+            pointer = self.lib.host_entity(n, ctypes.byref(address), ctypes.byref(count))
+            buffers[address.value] = np.ctypeslib.as_array(pointer, (count.value, 4)).copy()
+        return buffers
+
+    def queue(self):
+        """A copy of deferred_queue, (QUEUE_MAX, PACKET_MAX).
+        """
+        slots, size = ctypes.c_int(), ctypes.c_int()
+        pointer = self.lib.host_queue(ctypes.byref(slots), ctypes.byref(size))
+        return np.ctypeslib.as_array(pointer, (slots.value, size.value)).copy()
+
+    def wire(self):
+        """The RGB values of the last update_strand(), as they went out to the pixels, (pixels, 3).
+        """
+        pixels = self.config.pixels_in_strand
+        length = 3 * pixels + (6 + 3 if self.config.strand_type == isis_config.STRAND_STARFISH else 0)
+        buf = (ctypes.c_uint8 * length)()
+        count = self.lib.host_spi_last(buf, length)
+        data = np.frombuffer(bytes(buf[:count]), dtype=np.uint8)
+        if self.config.strand_type == isis_config.STRAND_STARFISH:
+            data = data[6:-3]               # leading zeros and the blank pixel after
+        return data.reshape(-1, 3)
+
+
+class HostMaster(_Host):
+    """The master, running isis_master.ino with the SD card in directory sd_dir.
+    """
+    def __init__(self, sd_dir, analog=0):
+        playlist = [name for name in os.listdir(sd_dir) if name.upper() == 'PLAYLIST.TXT']
+        if not playlist:
+            raise HostError('no PLAYLIST.TXT in %s' % sd_dir)
+        with open(os.path.join(sd_dir, playlist[0])) as f:
+            if not any(line.strip() for line in f.read().split('\n')[:-1]):
+                raise HostError('%s lists no files (each needs a newline after it)' % playlist[0])
+        self.sd_dir = sd_dir
+        self.lib = _load('master')
+        self._check(self.lib.host_setup(sd_dir.encode(), analog), 'setup()')
+
+    def __repr__(self):
+        return 'HostMaster(%r)' % self.sd_dir
+
+    def filename(self):
+        """The lighting program now playing, and the playlist index of the next one.
+        """
+        index = ctypes.c_int()
+        name = self.lib.host_filename(ctypes.byref(index))
+        return name.decode('latin-1'), index.value
+
+    @property
+    def waitfor_tick(self):
+        return self.lib.host_waitfor_tick()
+
+    def pin(self, pin, level):
+        """Hold a console button's pin LOW (pressed) or let it go HIGH.
+        """
+        self.lib.host_pin(pin, level)
+
+
+class HostPyramid(object):
+    """The master and every slave in isis_config, with the master's bus output going to
+    all the slaves. The bus passes bytes on the moment they've been sent.
+    """
+    def __init__(self, sd_dir, slaves=None, analog=0):
+        if slaves is None:
+            slaves = isis_config.load_config()
+        self.master = HostMaster(sd_dir, analog)
+        self.slaves = [HostSlave(slave, analog + slave.address) for slave in slaves]
+
+    def run(self, until_us, step_us=100000):
+        """Run everything until until_us, step_us at a time.
+        """
+        now = self.master.now_us
+        while now < until_us:
+            now = min(now + step_us, until_us)
+            self.master.run(now)
+            data, times = self.master.output()
+            for slave in self.slaves:
+                if len(data):
+                    slave.feed(data, times)
+                slave.run(now)
+
+    def entity_buffers(self):
+        """Every slave's entity buffers: {(slave address, entity address): (pixels, 4) RGBD}.
+        """
+        return dict(((slave.config.address, entity), buffer)
+                    for slave in self.slaves for entity, buffer in slave.entities().items())
+
+
+def _frame(packet):
+    return slip_encode(bytes(packet))
+
+
+def bench(ticks):
+    """Ticks per second for the slave with the longest strand, everything switched on.
+    """
+    config = max(isis_config.load_config(), key=lambda s: s.pixels_in_strand)
+    slave = HostSlave(config)
+    setup = [[CMD_S_DYN_SPARKLE, 0xFF, 0xFF, 0x00, 0x10],
+             [CMD_E_FILL_D | ENTITY_ADDRESSED, 0xFF, 0xFF, 1, 0, 0, 0, 0,
+              DYNAMICS_BLINK | DYNAMICS_THROB | DYNAMICS_SPARKLE],
+             [CMD_E_RAINBOW | ENTITY_ADDRESSED, 0xFF, 0xFF, 255, 1, 0, 1, 0, 0, 3, 0]]
+    slave.handle(b''.join(_frame(packet) for packet in setup))
+    start = time.perf_counter()
+    slave.run_ticks(ticks)
+    elapsed = time.perf_counter() - start
+    print('slave %d, %d pixels, all dynamics on: %d ticks in %.3f s, %.0f ticks/s (%.0fx real time)' % (
+        config.address, config.pixels_in_strand, ticks, elapsed, ticks / elapsed,
+        ticks * TICK_LENGTH / 1000.0 / elapsed))
+
+
+def _random_packet(rng):
+    """A packet that might be anything: often well formed, sometimes not at all.
+    """
+    if rng.random() < 0.1:
+        return bytes(rng.randrange(256) for i in range(rng.randrange(1, PACKET_MAX + 4)))
+    entity = rng.random() < 0.8
+    command = rng.choice(list(ENTITY_COMMAND_NAMES) if entity else list(SLAVE_COMMAND_NAMES))
+    header = [command | (ENTITY_ADDRESSED if entity else 0), rng.randrange(256), rng.randrange(256)]
+    if entity:
+        start = rng.choice([0, 0, rng.randrange(300)])
+        header += [rng.choice([1, 1, 2, 5, 255]), start & 0xFF, start >> 8, rng.randrange(1, 20), 0]
+    body = [rng.choice([0, 1, rng.randrange(256)]) for i in range(rng.randrange(0, 6))]
+    return bytes(header + body)
+
+
+def fuzz(count, seed):
+    """Random packets into the slaves, a few ticks between them. Returns the number of failures.
+    """
+    rng = random.Random(seed)
+    slaves = [HostSlave(config) for config in isis_config.load_config()]
+    for n in range(count):
+        slave = rng.choice(slaves)
+        packet = _random_packet(rng)
+        try:
+            slave.handle(_frame(packet))
+            slave.run_ticks(rng.randrange(4))
+        except HostError as e:
+            print('packet %d, %s: %s' % (n, ' '.join('%02X' % b for b in packet), e))
+            return 1
+    print('%d packets to %d slaves, no hangs' % (count, len(slaves)))
+    return 0
+
+
+def play(seconds, sd_dir):
+    pyramid = HostPyramid(sd_dir)
+    start = time.perf_counter()
+    pyramid.run(int(seconds * 1e6))
+    elapsed = time.perf_counter() - start
+    name, index = pyramid.master.filename()
+    print('%.1f s of show in %.2f s; master on %s (next %d), tick %d' % (
+        seconds, elapsed, name, index, pyramid.master.current_tick))
+    for slave in pyramid.slaves:
+        lit = sum(int(buffer[:, :3].any(axis=1).sum()) for buffer in slave.entities().values())
+        print('  slave %2d: tick %5d, %3d pixels lit, %d queued, %d bytes dropped' % (
+            slave.config.address, slave.current_tick, lit,
+            int((slave.queue()[:, PKT_REPEAT_COUNT_OFFSET] != 0).sum()), slave.dropped))
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid firmware, built for the host')
+    parser.add_argument('--build', action='store_true', help='rebuild the libraries')
+    parser.add_argument('--bench', type=int, metavar='TICKS', help='time a slave running TICKS ticks')
+    parser.add_argument('--fuzz', type=int, metavar='PACKETS', help='feed the slaves random packets')
+    parser.add_argument('--sanitize', action='store_true', help='fuzz with AddressSanitizer')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for --fuzz (default 1)')
+    parser.add_argument('--play', nargs=2, metavar=('SECONDS', 'DIR'), help='play a show for SECONDS')
+    args = parser.parse_args(argv)
+
+    if args.sanitize and not os.environ.get('LPHOST_SANITIZE'):
+        # The sanitizer's runtime has to be loaded before Python is, so start over with it.
+        runtime = subprocess.check_output([CXX, '-print-file-name=libasan.so'], universal_newlines=True).strip()
+        build('slave', force=args.build, sanitize=True)
+        env = dict(os.environ, LPHOST_SANITIZE='1', LD_PRELOAD=runtime, ASAN_OPTIONS='detect_leaks=0')
+        return subprocess.call([sys.executable, os.path.abspath(__file__)] + argv, env=env)
+
+    try:
+        for kind in SKETCHES:
+            library = build(kind, force=args.build, sanitize=bool(os.environ.get('LPHOST_SANITIZE')))
+            if args.build:
+                print('built', os.path.relpath(library))
+        if args.bench:
+            bench(args.bench)
+        if args.fuzz:
+            return fuzz(args.fuzz, args.seed)
+        if args.play:
+            return play(float(args.play[0]), args.play[1])
+    except HostError as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
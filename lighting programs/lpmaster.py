@@ -0,0 +1,398 @@
+#! /usr/bin/env python3
+
+# Host-side master controller for the Isis Pyramid 1.1.
+#
+# This does what isis_master.ino does, from a laptop: it reads PLAYLIST.TXT, plays out
+# each lighting program in turn, forever, forwarding packets to the slaves SLIP-framed
+# and acting on the META packets itself (WAIT holds the playout until a tick comes
+# around, ENDS also moves on to the next program, RESET_TIME restarts the master's clock
+# and CONSOLE shows a number). With a USB RS-485 adapter on the bus in place of the
+# master, lighting programs can be tried out during rehearsals straight from the build
+# folder, without copying them to an SD card.
+#
+# It follows the firmware closely:
+#   - PLAYLIST.TXT is read again every time a program is opened, and the PKT file when
+#     it's opened, so files rebuilt while the show is running are picked up next time;
+#     a show file built by lpshow can be played instead, and is read through its index;
+#   - the clock is a 16-bit tick counter run off a millisecond timer the way loop() runs
+#     it: whenever TICK_LENGTH has passed since last_tick_millis, last_tick_millis goes
+#     up by TICK_LENGTH and the tick counter by one, so a late wakeup catches up one tick
+#     at a time rather than skipping ticks;
+#   - after power-up it waits for the slaves to wake up, then sends RESET_CLOCK to all;
+#   - the console buttons are commands typed on standard input: n (red, next program),
+#     r (black, restart this program), f (yellow, first program). s prints the timing
+#     statistics and q quits. Next and restart count from the program that's playing;
+#     the firmware counts from the one it last opened, which after a META_ENDS is
+#     already the next one.
+#
+# It runs on asyncio. The ticker and the playout are separate tasks; the playout sleeps
+# until the tick it's waiting for and the ticker measures how late each of its wakeups
+# is, so the timing statistics say how closely the host holds the 10 ms tick.
+#
+# The serial port is written without blocking. On the Arduino, Serial.write() blocks
+# once its 64-byte transmit buffer is full; a USB serial adapter will take kilobytes, and
+# the pyramid would fall seconds behind the master's clock. So writes are paced to the
+# baud rate against a model of the same 64-byte buffer (as lpbus models it) unless
+# --no-pace says not to.
+#
+# Any serial device will do; --pty makes a pseudo-terminal pair and prints the name of
+# the other end, for trying it out with nothing attached.
+#
+# Usage: lpmaster [--port DEVICE | --pty] [--baud RATE] [--no-pace] [--settle SECONDS]
+#                 [--loops N] PLAYLIST.TXT | SHOW.SHW
+
+import argparse
+import asyncio
+import os
+import sys
+import termios
+import tty
+
+from isis_packets import *
+from lpbus import BITS_PER_BYTE, TX_BUFFER
+from lpsim import read_playlist
+
+SETTLE = 2.0                # seconds for the slaves to wake up, as in setup()
+SPIN = 1.5                  # ms before a tick to stop sleeping and poll; the event loop's
+                            # sleeps come out in whole milliseconds, rounded up
+
+
+class SerialPort(object):
+    """A serial device (or pty) written from asyncio without blocking, paced to the baud
+    rate against a model of the Arduino serial driver's transmit buffer.
+    """
+    def __init__(self, fd, baud=BAUD_RATE, pace=True, tx_buffer=TX_BUFFER):
+        self.fd = fd
+        self.byte_ms = 1000.0 * BITS_PER_BYTE / baud
+        self.pace = pace
+        self.tx_buffer = tx_buffer
+        self.line_free = 0.0            # when the modelled UART finishes what it's been given
+        self.written = 0
+        os.set_blocking(fd, False)
+
+    @classmethod
+    def open(cls, path, baud=BAUD_RATE, pace=True):
+        """Open a serial device for 8N1 raw output at the given baud rate.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(fd):
+            tty.setraw(fd)
+            speed = getattr(termios, 'B%d' % baud, None)
+            if speed is not None:
+                attrs = termios.tcgetattr(fd)
+                attrs[4] = attrs[5] = speed
+                termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        return cls(fd, baud, pace)
+
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        if self.pace:
+            now = loop.time() * 1000.0
+            held = max(0.0, self.line_free - now) / self.byte_ms
+            if held + len(data) > self.tx_buffer:
+                await asyncio.sleep((held + len(data) - self.tx_buffer) * self.byte_ms / 1000.0)
+                now = loop.time() * 1000.0
+            self.line_free = max(self.line_free, now) + len(data) * self.byte_ms
+        view = memoryview(data)
+        while view:
+            try:
+                count = os.write(self.fd, view)
+            except BlockingIOError:
+                ready = loop.create_future()
+                loop.add_writer(self.fd, lambda: ready.done() or ready.set_result(None))
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(self.fd)
+                continue
+            view = view[count:]
+            self.written += count
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TickStats(object):
+    """How closely the ticker holds the tick: the lateness of each wakeup, in ms, past the
+    time the tick was due, and how many ticks had to be caught up.
+    """
+    def __init__(self):
+        self.lateness = []
+        self.ticks = 0
+        self.catchups = 0               # wakeups that found more than one tick due
+        self.longest_catchup = 0        # most ticks processed in one wakeup
+
+    def record(self, late, ticks):
+        self.lateness.append(late)
+        self.ticks += ticks
+        if ticks > 1:
+            self.catchups += 1
+            self.longest_catchup = max(self.longest_catchup, ticks)
+
+    def summary(self):
+        if not self.lateness:
+            return 'no ticks yet'
+        late = sorted(self.lateness)
+        n = len(late)
+        return ('%d ticks, jitter mean %.3f ms, median %.3f, p99 %.3f, max %.3f; '
+                '%d catch-ups (longest %d ticks)' % (
+                    self.ticks, sum(late) / n, late[n // 2], late[min(n - 1, n * 99 // 100)], late[-1],
+                    self.catchups, self.longest_catchup))
+
+
+class Master(object):
+    """The master's playout of a playlist onto a SerialPort. run() plays until stop() or
+    until the playlist has been played loops times (forever if loops is 0).
+    """
+    def __init__(self, port, playlist='PLAYLIST.TXT', loops=0, settle=SETTLE, display=None, log=None):
+        self.port = port
+        self.playlist = playlist
+        self.folder = os.path.dirname(playlist)
+        self.show = None                # an lpshow.Show, if playlist is a show file
+        if not playlist.upper().endswith('.TXT'):
+            import lpshow
+            self.show = lpshow.Show(playlist)
+        self.loops = loops
+        self.settle = settle
+        self.display = display or (lambda number: None)     # display_number()
+        self.log = log or (lambda message: None)
+
+        self.current_tick = 0           # uint16_t, as in the firmware
+        self.last_tick_millis = 0
+        self.time_origin = 0.0
+        self.waitfor_tick = 0
+        self.program_end_tick = 0
+        self.playlist_index = 0         # index of the next program to open
+        self.playing_index = 0          # index of the program being played out
+        self.filename = None
+        self.packets = None             # what's left of the open lighting program
+        self.passes = 0                 # times the playlist has wrapped around
+        self.stats = TickStats()
+        self.sent = 0
+        self._tick = asyncio.Event()
+        self._stopping = False
+
+    def millis(self):
+        return asyncio.get_running_loop().time() * 1000.0
+
+    # ---- the clock ----
+
+    async def ticker(self):
+        """loop()'s tick processing, run off the event loop's clock.
+        """
+        while not self._stopping:
+            due = self.time_origin + self.last_tick_millis + TICK_LENGTH
+            delay = due - self.millis()
+            if delay > SPIN:
+                await asyncio.sleep((delay - SPIN) / 1000.0)
+            while self.millis() < due and not self._stopping:
+                await asyncio.sleep(0)          # other tasks still get their turn
+            now = self.millis()
+            ticks = 0
+            late = now - (self.time_origin + self.last_tick_millis + TICK_LENGTH)
+            while now - self.time_origin - self.last_tick_millis >= TICK_LENGTH:
+                self.last_tick_millis += TICK_LENGTH    # if we get behind, we'll try to catch up
+                self.current_tick = (self.current_tick + 1) & 0xFFFF
+                ticks += 1
+            if ticks:
+                self.stats.record(late, ticks)
+                self._tick.set()
+
+    async def wait_for_tick(self):
+        """Sleep until the ticker gets to waitfor_tick.
+        """
+        while self.current_tick < self.waitfor_tick and not self._stopping:
+            self._tick.clear()
+            await self._tick.wait()
+
+    # ---- the playlist ----
+
+    def file_get_filename(self, index):
+        """The index'th name in PLAYLIST.TXT, going back to the first past the last one.
+        """
+        names = self.show.names if self.show else read_playlist(self.playlist)
+        if not names:
+            raise ValueError('%s names no lighting programs' % self.playlist)
+        if index >= len(names):
+            index = 0
+            self.passes += 1
+        self.playlist_index = index + 1
+        return names[index]
+
+    def ready_next_file(self):
+        """Open the next lighting program in the playlist.
+        """
+        self.filename = self.file_get_filename(self.playlist_index)
+        try:
+            if self.show:
+                self.packets = read_packets(self.show.read(self.playlist_index - 1))
+            else:
+                with open(os.path.join(self.folder, self.filename), 'rb') as f:
+                    self.packets = read_packets(f.read())
+        except OSError as e:
+            self.log('tick %d: can\'t open %s: %s' % (self.current_tick, self.filename, e.strerror))
+            self.packets = None
+        else:
+            self.log('tick %d: playing %s' % (self.current_tick, self.filename))
+        self.display(self.playlist_index)
+
+    # ---- the console buttons ----
+
+    def next_program(self):
+        """The red button jumps ahead to begin the next lighting program.
+        """
+        self.waitfor_tick = 0
+        self.playlist_index = self.playing_index + 1
+        self.ready_next_file()
+        self._tick.set()
+
+    def restart_program(self):
+        """The black button restarts the current lighting program.
+        """
+        self.waitfor_tick = 0
+        self.playlist_index = self.playing_index
+        self.ready_next_file()
+        self._tick.set()
+
+    def first_program(self):
+        """The yellow button goes back to the very first lighting program.
+        """
+        self.waitfor_tick = 0
+        self.playlist_index = 0
+        self.ready_next_file()
+        self._tick.set()
+
+    def stop(self):
+        self._stopping = True
+        self._tick.set()
+
+    # ---- packets ----
+
+    async def send_packet(self, packet):
+        await self.port.write(slip_encode(packet))
+        self.sent += 1
+
+    async def reset_time_origin(self):
+        await self.send_packet(bytes([CMD_S_RESET_CLOCK, 0xFF, 0xFF]))
+        self.time_origin = self.millis()
+        self.waitfor_tick = 0
+
+    async def handle_file_packet(self, packet):
+        if not is_meta(packet):
+            await self.send_packet(packet)
+            return
+        value = u16(packet + bytes(4), PKT_META_DATA_OFFSET)
+        command = packet[PKT_META_CMD_OFFSET] if len(packet) > PKT_META_CMD_OFFSET else None
+        if command == META_CONSOLE:
+            self.display(value)
+        elif command == META_WAIT:
+            self.waitfor_tick = value
+        elif command == META_ENDS:
+            self.program_end_tick = value
+            self.waitfor_tick = value
+            self.ready_next_file()
+        elif command == META_RESET_TIME:
+            self.time_origin = self.millis()
+            self.current_tick = 0
+            self.last_tick_millis = 0
+            self.waitfor_tick = 0
+
+    async def playout(self):
+        """loop()'s file playout: whenever the tick has come, the next packet.
+        """
+        while not self._stopping:
+            await self.wait_for_tick()
+            if self._stopping or (self.loops and self.passes >= self.loops):
+                break
+            if self.packets is None:
+                self.ready_next_file()
+                await asyncio.sleep(0)
+                continue
+            packet = next(self.packets, None)
+            if packet is None:
+                self.packets = None
+                continue
+            self.playing_index = self.playlist_index - 1
+            await self.handle_file_packet(packet)
+
+    async def run(self):
+        await asyncio.sleep(self.settle)
+        await self.reset_time_origin()
+        ticker = asyncio.ensure_future(self.ticker())
+        try:
+            await self.playout()
+        finally:
+            self._stopping = True
+            await ticker
+
+
+def _console(master, stream):
+    """Handle a command line typed at the console.
+    """
+    line = stream.readline()
+    if not line:
+        asyncio.get_running_loop().remove_reader(stream)
+        return
+    command = line.strip().lower()[:1]
+    if command == 'n':
+        master.next_program()
+    elif command == 'r':
+        master.restart_program()
+    elif command == 'f':
+        master.first_program()
+    elif command == 's':
+        print(master.stats.summary())
+    elif command == 'q':
+        master.stop()
+    elif command:
+        print('n: next program, r: restart program, f: first program, s: timing statistics, q: quit')
+
+
+async def _main(args):
+    if args.pty:
+        fd, other = os.openpty()
+        tty.setraw(other)
+        port = SerialPort(fd, args.baud, not args.no_pace)
+        print('pty: %s' % os.ttyname(other))
+    else:
+        port = SerialPort.open(args.port, args.baud, not args.no_pace)
+    master = Master(port, args.playlist, args.loops, args.settle,
+                    display=lambda number: print('console: %d' % number), log=print)
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_reader(sys.stdin, _console, master, sys.stdin)
+    except (PermissionError, ValueError):    # stdin is a plain file; no console then
+        pass
+    try:
+        await master.run()
+    finally:
+        loop.remove_reader(sys.stdin)
+        port.close()
+        if master.show:
+            master.show.close()
+    print('%d packets, %d bytes sent' % (master.sent, port.written))
+    print(master.stats.summary())
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid host-side master controller')
+    parser.add_argument('playlist', help='PLAYLIST.TXT to play, with its PKT files beside it, or an lpshow show file')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--port', metavar='DEVICE', help='serial device on the RS-485 bus')
+    where.add_argument('--pty', action='store_true', help='make a pseudo-terminal pair and play into it')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE, help='bus speed')
+    parser.add_argument('--no-pace', action='store_true', help='don\'t pace writes to the baud rate')
+    parser.add_argument('--settle', type=float, default=SETTLE, metavar='SECONDS',
+                        help='wait for the slaves to wake up before starting (default %g)' % SETTLE)
+    parser.add_argument('--loops', type=int, default=0, metavar='N',
+                        help='stop after playing the playlist N times (default: forever)')
+    args = parser.parse_args(argv)
+    try:
+        return asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
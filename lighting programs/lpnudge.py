@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+
+# Escape-aware nudging for Isis Pyramid 1.1 packet streams.
+#
+# A packet byte that happens to be FEND (0xC0) or FESC (0xDB) goes on the bus as two
+# bytes. Generated programs hit those values all the time: a color component of 192 or
+# 219, or a start tick or repeat interval with 0xC0 or 0xDB in either byte. Nobody can
+# tell 192 from 191, so this pass rewrites such bytes where the difference doesn't
+# matter:
+#
+#   - a red, green or blue component on an escape value is moved down one, if the
+#     tolerance (how far a component may move, 1 by default; 0 leaves colors alone)
+#     allows it. The escape values aren't next to each other or to 0 or 255, so one step
+#     always does it;
+#   - the repeat interval of a packet that only runs once is never used, so an escaping
+#     one is made 0;
+#   - where the author has said the timing doesn't have to be exact (flexible_timing() in
+#     the lighting program, or --flexible here for the whole file), an escaping start
+#     tick or repeat interval is moved one tick later. Later is never late, and a tick
+#     whose high byte is the escape can't be helped by one tick, so it stays.
+#
+# Packets are marked flexible by their contents as the program writes them, so a packet
+# that another pass (lpoptimize, lprepeat, lpsegment) rewrites loses its mark; its timing
+# is then left as it is.
+#
+# As with the other passes, nudge_and_check() proves the result: it replays the stream
+# through lpsim before and after the color and interval edits, and every pixel of every
+# frame has to be within the tolerance of the original, dynamics bytes exactly the same;
+# and the timing edits must not make lpqueue count more dropped packets. Edits that fail
+# are backed out one by one. It reports how many escape bytes the bus is spared.
+#
+# lpcompile -N runs this on its output, after the other passes, before writing the PKT
+# file. It can also be run on existing PKT files.
+#
+# Usage: lpnudge [--tolerance N] [--flexible] [--write] file.PKT ...
+
+import argparse
+import bisect
+import sys
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+import lpoptimize
+import lpqueue
+
+COLOR_FIELDS = ('red', 'green', 'blue')
+TIMING_FIELDS = ('effective_time', 'repeat_interval')
+ESCAPES = (FEND, FESC)
+
+COLOR, UNUSED, TIMING = 'color', 'unused', 'timing'
+
+
+def _escapes(data):
+    return sum(1 for b in data if b in ESCAPES)
+
+
+def bus_escapes(packets):
+    """Escape bytes the packets cost on the bus. META packets stay in the master.
+    """
+    return sum(_escapes(packet) for packet in packets if not is_meta(packet))
+
+
+def plan(packets, tolerance=1, flexible=()):
+    """The edits for a packet stream, as a list of (kind, position, offset, new bytes).
+    flexible holds the contents of the packets whose timing may move, as tuples.
+    """
+    edits = []
+    for pos, packet in enumerate(packets):
+        if not is_entity_packet(packet):
+            continue
+        for name, offset, width in packet_fields(packet) or ():
+            field = packet[offset:offset+width]
+            if len(field) < width or not _escapes(field):
+                continue
+            if name in COLOR_FIELDS:
+                if tolerance >= 1:
+                    edits.append((COLOR, pos, offset, [field[0] - 1]))
+            elif name == 'repeat_interval' and packet[PKT_REPEAT_COUNT_OFFSET] == 1:
+                edits.append((UNUSED, pos, offset, [0, 0]))
+            elif name in TIMING_FIELDS and tuple(packet) in flexible:
+                value = u16(packet, offset) + 1
+                if value <= 0xFFFF and _escapes([value & 0xFF, value >> 8]) < _escapes(field):
+                    edits.append((TIMING, pos, offset, [value & 0xFF, value >> 8]))
+    return edits
+
+
+def apply(packets, edits):
+    """The packet stream with the given edits made.
+    """
+    out = [bytearray(packet) for packet in packets]
+    for kind, pos, offset, data in edits:
+        out[pos][offset:offset+len(data)] = bytes(data)
+    return out
+
+
+def _frame_at(trace, firsts, tick):
+    i = bisect.bisect_right(firsts, tick) - 1
+    return trace[i][1] if i >= 0 else None
+
+
+def _within(replayed, reference, tolerance):
+    """True if two lpoptimize.replay()s show the same thing, give or take tolerance in
+    each color component, tick by tick.
+    """
+    trace, end, queues = replayed
+    ref_trace, ref_end, ref_queues = reference
+    if end != ref_end or [len(q) for q in queues] != [len(q) for q in ref_queues]:
+        return False
+    firsts = [first for first, frame in trace]
+    ref_firsts = [first for first, frame in ref_trace]
+    for tick in sorted(set(firsts) | set(ref_firsts)):
+        a = _frame_at(trace, firsts, tick)
+        b = _frame_at(ref_trace, ref_firsts, tick)
+        if a is None or b is None:
+            if a is not b:
+                return False
+            continue
+        diff = np.abs(np.frombuffer(a, dtype=np.uint8).astype(np.int16) -
+                      np.frombuffer(b, dtype=np.uint8)).reshape(-1, 4)
+        if diff[:, :3].max() > tolerance or diff[:, 3].any():
+            return False
+    return True
+
+
+def _dropped(packets, slaves):
+    data = b''.join(slip_encode(packet) for packet in packets)
+    return sum(len(stats.dropped) for stats in lpqueue.check([('', data)], slaves).stats)
+
+
+def nudge_and_check(packets, name='', tolerance=1, flexible=(), verbose=True):
+    """Nudge the escaping bytes of a packet stream, keeping only the edits that replay
+    within tolerance and drop no more packets. Prints a before and after report unless
+    told not to.
+    """
+    packets = [bytearray(packet) for packet in packets]
+    edits = plan(packets, tolerance, flexible)
+    rejected = 0
+    if edits:
+        reference = lpoptimize.replay(packets)
+        close = [edit for edit in edits if edit[0] != TIMING]
+        if close and not _within(lpoptimize.replay(apply(packets, close)), reference, tolerance):
+            kept = []
+            for edit in close:
+                if _within(lpoptimize.replay(apply(packets, kept + [edit])), reference, tolerance):
+                    kept.append(edit)
+            close = kept
+        timing = [edit for edit in edits if edit[0] == TIMING]
+        if timing:
+            slaves = isis_config.load_config()
+            dropped = _dropped(apply(packets, close), slaves)
+            if _dropped(apply(packets, close + timing), slaves) > dropped:
+                kept = []
+                for edit in timing:
+                    if _dropped(apply(packets, close + kept + [edit]), slaves) <= dropped:
+                        kept.append(edit)
+                timing = kept
+        rejected = len(edits) - len(close) - len(timing)
+        edits = close + timing
+    stream = apply(packets, edits)
+    if verbose:
+        before = lpoptimize.wire_bytes(packets)
+        after = lpoptimize.wire_bytes(stream)
+        counts = dict((kind, sum(1 for edit in edits if edit[0] == kind)) for kind in (COLOR, UNUSED, TIMING))
+        print('%-12s %6d -> %6d bytes (%+d, %.1f%%): %d escape bytes removed from the bus '
+              '(%d colors, %d unused intervals, %d flexible times)%s' % (
+                  name, before, after, after - before, 100.0 * (after - before) / max(before, 1),
+                  bus_escapes(packets) - bus_escapes(stream), counts[COLOR], counts[UNUSED], counts[TIMING],
+                  ', %d edits rejected by replay' % rejected if rejected else ''))
+    return stream
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid packet stream escape nudger')
+    parser.add_argument('files', nargs='+', help='.PKT files to nudge')
+    parser.add_argument('--tolerance', type=int, default=1, metavar='N',
+                        help='how far a color component may move (0 leaves colors alone)')
+    parser.add_argument('--flexible', action='store_true',
+                        help='let the start tick and repeat interval of every entity packet move a tick')
+    parser.add_argument('--write', action='store_true', help='write the nudged packets back to the files')
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            packets = list(read_packets(f.read()))
+        flexible = set(tuple(packet) for packet in packets) if args.flexible else ()
+        stream = nudge_and_check(packets, path, args.tolerance, flexible)
+        if args.write:
+            with open(path, 'wb') as f:
+                for packet in stream:
+                    f.write(slip_encode(packet))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
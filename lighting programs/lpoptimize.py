@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+
+# Peephole optimizer for Isis Pyramid 1.1 packet streams.
+#
+# Every byte of a lighting program goes out over the RS-485 bus at 9600 baud, about a
+# millisecond a byte, so packets that don't change what the pyramid shows are worth
+# getting rid of. This pass looks at the packets the master sends in the same tick
+# (with a bus that takes no time, as lpsim models it) and rewrites them three ways:
+#
+#   - a packet whose effect on every entity it addresses is completely painted over by
+#     later packets in the same tick, before the slaves show the next frame, is dropped;
+#   - back-to-back CMD_E_SHIFT_UP (or SHIFT_DOWN) packets that differ only in count are
+#     folded into one packet shifting by the total count;
+#   - packets in the same tick that differ only in entity bitmap are merged into one
+#     packet addressed to all of those entities.
+#
+# The result is only as good as its proof, so optimize_and_check() replays the original
+# and the optimized stream through lpsim and compares every displayed tick, pixel colors
+# and dynamics bytes alike, along with whatever is left in the slaves' queues at the end.
+# Rewrites that change anything are backed out one by one.
+#
+# lpcompile -O runs this on its output before writing the PKT file. It can also be run
+# on existing PKT files.
+#
+# Usage: lpoptimize [--write] file.PKT ...
+
+import argparse
+import sys
+
+from isis_packets import *
+import isis_config
+from lpsim import Simulator, playout
+
+# Bytes of the receive buffer each command uses. A packet shorter than that runs on
+# whatever the packets before it left behind.
+SLAVE_PACKET_LENGTH = {
+    CMD_S_RESET_CLOCK: PKT_S_DATA_OFFSET,
+    CMD_S_DYN_BLINK:   PKT_S_DATA_OFFSET + 5,
+    CMD_S_DYN_THROB:   PKT_S_DATA_OFFSET + 6,
+    CMD_S_DYN_SPARKLE: PKT_S_DATA_OFFSET + 2,
+    CMD_S_COMMENT:     PKT_S_DATA_OFFSET,
+}
+
+PACKET_LENGTH = {
+    CMD_E_FILL_RGB:   PKT_E_DATA_OFFSET + 3,
+    CMD_E_FILL_D:     PKT_E_DATA_OFFSET + 1,
+    CMD_E_SHIFT_UP:   PKT_E_DATA_OFFSET + 5,
+    CMD_E_SHIFT_DOWN: PKT_E_DATA_OFFSET + 5,
+    CMD_E_ROTATE:     PKT_E_DATA_OFFSET + 2,
+    CMD_E_RANDOMIZE:  PKT_E_DATA_OFFSET,
+    CMD_E_LOADONE:    PKT_E_DATA_OFFSET + 5,
+    CMD_E_RAINBOW:    PKT_E_DATA_OFFSET + 3,
+}
+
+DEAD, FOLDED, MERGED = 'dead', 'folded', 'merged'
+
+
+def wire_bytes(packets):
+    """Bytes the packets take up in a PKT file and on the bus, SLIP framing included.
+    """
+    return sum(len(slip_encode(packet)) for packet in packets)
+
+
+def _is_immediate(packet):
+    return packet[PKT_REPEAT_COUNT_OFFSET] == 1 and u16(packet, PKT_EFFECTIVE_TIME_OFFSET) == 0
+
+
+def _entities(bitmap, counts):
+    return [e for e in range(isis_config.NUM_ENTITIES) if bitmap & (1 << e) and counts[e]]
+
+
+def is_complete(packet):
+    """True for a whole, well-formed entity packet, the only kind lpoptimize and lprepeat
+    rewrite.
+    """
+    return (is_entity_packet(packet) and not is_meta(packet) and
+            len(packet) == PACKET_LENGTH.get(packet[PKT_COMMAND_OFFSET] & COMMAND_MASK))
+
+
+def _reads_stale(packet):
+    """True if a packet picks up bytes left in the receive buffer by earlier packets.
+    """
+    command = packet[PKT_COMMAND_OFFSET] & COMMAND_MASK
+    if is_entity_packet(packet):
+        return len(packet) < PACKET_LENGTH.get(command, PACKET_MAX)
+    return len(packet) < SLAVE_PACKET_LENGTH.get(command, PKT_S_DATA_OFFSET)
+
+
+def _tick_groups(packets):
+    """Positions of the packets sent to the slaves, grouped by the tick the master sends them.
+    Packets the master never sends (after META_ENDS) aren't in any group.
+    """
+    data = b''.join(slip_encode(packet) for packet in packets)
+    if [bytes(p) for p in read_packets(data)] != [bytes(p) for p in packets]:
+        return []               # wouldn't survive the round trip; leave well alone
+    groups = []
+    last = None
+    for tick, name, index, packet in playout([('', data)]):
+        if packet is None or name == '(setup)' or is_meta(packet):
+            continue
+        if tick != last:
+            groups.append([])
+            last = tick
+        groups[-1].append(index)
+    return groups
+
+
+def _dead_writes(packets, group, counts, pinned):
+    """Immediate packets in a tick group whose effect is entirely overwritten later in the
+    group. Tracks, for every pixel of every entity, which packet last wrote its color and
+    its dynamics byte (shifts and rotates carry the labels along with the pixels).
+    """
+    labels = {}
+    for pos in group:
+        packet = packets[pos]
+        if not is_entity_packet(packet):
+            continue
+        if not is_complete(packet):
+            return []           # who knows what this one does
+        if not _is_immediate(packet):
+            continue            # runs in the scan after the frame, if at all
+        command = packet[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        data = PKT_E_DATA_OFFSET
+        for e in _entities(u16(packet, PKT_ADDRESS_OFFSET), counts):
+            n = counts[e]
+            rgb, d = labels.setdefault(e, ([-1] * n, [-1] * n))
+            if command in (CMD_E_FILL_RGB, CMD_E_RAINBOW, CMD_E_RANDOMIZE):
+                rgb[:] = [pos] * n
+            elif command == CMD_E_FILL_D:
+                d[:] = [pos] * n
+            elif command in (CMD_E_SHIFT_UP, CMD_E_SHIFT_DOWN, CMD_E_ROTATE):
+                k = packet[data]
+                if k == 0 or k > n:
+                    continue
+                for layer in (rgb, d):
+                    if command == CMD_E_SHIFT_UP:
+                        layer[:] = [pos] * k + layer[:n-k]
+                    elif command == CMD_E_SHIFT_DOWN:
+                        layer[:] = layer[k:] + [pos] * k
+                    elif packet[data+1]:
+                        layer[:] = layer[k:] + layer[:k]
+                    else:
+                        layer[:] = layer[n-k:] + layer[:n-k]
+            elif command == CMD_E_LOADONE and packet[data] < n:
+                rgb[packet[data]] = d[packet[data]] = pos
+
+    dead = []
+    for i, pos in enumerate(group):
+        packet = packets[pos]
+        if not is_entity_packet(packet) or not _is_immediate(packet):
+            continue
+        command = packet[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        entities = _entities(u16(packet, PKT_ADDRESS_OFFSET), counts)
+        if command == CMD_E_RANDOMIZE:
+            continue            # would throw the random number sequence off
+        if command == CMD_E_LOADONE and any(packet[PKT_E_DATA_OFFSET] >= counts[e] for e in entities):
+            continue            # scribbles past the end of the buffer in the firmware
+        if pos in pinned:
+            continue
+        if command in (CMD_E_FILL_RGB, CMD_E_RAINBOW):
+            layers = (0,)
+        elif command == CMD_E_FILL_D:
+            layers = (1,)
+        else:
+            layers = (0, 1)
+        if all(min(labels[e][layer]) > pos for e in entities for layer in layers):
+            dead.append(pos)
+    return dead
+
+
+def _shift_folds(packets, group, counts, pinned):
+    """Runs of adjacent SHIFT_UP or SHIFT_DOWN packets that differ only in count.
+    """
+    folds = []
+    run = []
+    total = 0
+    for pos in group + [None]:
+        packet = packets[pos] if pos is not None else None
+        if run and packet is not None and is_complete(packet):
+            first = packets[run[0]]
+            entities = _entities(u16(first, PKT_ADDRESS_OFFSET), counts)
+            room = min([counts[e] for e in entities] + [255])
+            count = packet[PKT_E_DATA_OFFSET]
+            if (packet[:PKT_E_DATA_OFFSET] == first[:PKT_E_DATA_OFFSET] and
+                    packet[PKT_E_DATA_OFFSET+1:] == first[PKT_E_DATA_OFFSET+1:] and
+                    0 < count and total + count <= room and pos not in pinned):
+                run.append(pos)
+                total += count
+                continue
+        if len(run) > 1:
+            folds.append((FOLDED, run[0], run[1:]))
+        run = []
+        if packet is not None and is_complete(packet) and \
+                packet[PKT_COMMAND_OFFSET] & COMMAND_MASK in (CMD_E_SHIFT_UP, CMD_E_SHIFT_DOWN) and \
+                0 < packet[PKT_E_DATA_OFFSET]:
+            run = [pos]
+            total = packet[PKT_E_DATA_OFFSET]
+    return folds
+
+
+def _bitmap_merges(packets, group, pinned):
+    """Packets that differ only in entity bitmap, with nothing between them touching the
+    same entities, merged into the first of them.
+    """
+    def body(packet):
+        return (packet[PKT_COMMAND_OFFSET],) + tuple(packet[PKT_REPEAT_COUNT_OFFSET:])
+
+    merges = []
+    taken = set()
+    for i, a in enumerate(group):
+        first = packets[a]
+        if a in taken or not is_complete(first) or first[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_E_RANDOMIZE:
+            continue
+        bitmap = u16(first, PKT_ADDRESS_OFFSET)
+        touched = 0             # entities the packets in between work on
+        merged = []
+        for j in range(i + 1, len(group)):
+            b = group[j]
+            packet = packets[b]
+            if not is_entity_packet(packet):
+                break           # slave packets (RESET_CLOCK above all) stay put
+            other = u16(packet, PKT_ADDRESS_OFFSET)
+            if (b not in taken and is_complete(packet) and body(packet) == body(first) and
+                    not other & (bitmap | touched) and b not in pinned):
+                merged.append(b)
+                bitmap |= other
+            else:
+                touched |= other
+        if merged:
+            taken.update(merged)
+            merges.append((MERGED, a, merged))
+    return merges
+
+
+def plan(packets, slaves=None):
+    """Work out the rewrites for a packet stream, as a list of (kind, position, [positions])
+    edits: a dead packet at a position, or packets folded or merged into the one at a
+    position. Positions index into packets.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    counts = isis_config.entity_pixel_counts(slaves)
+    groups = _tick_groups(packets)
+
+    # A packet just before one that reads stale bytes has to stay as it is.
+    sent = [pos for group in groups for pos in group]
+    pinned = set(sent[k-1] for k in range(1, len(sent)) if _reads_stale(packets[sent[k]]))
+
+    edits = []
+    for group in groups:
+        dead = _dead_writes(packets, group, counts, pinned)
+        edits += [(DEAD, pos, []) for pos in dead]
+        group = [pos for pos in group if pos not in dead]
+        folds = _shift_folds(packets, group, counts, pinned)
+        edits += folds
+        gone = set(pos for kind, first, others in folds for pos in others)
+        group = [pos for pos in group if pos not in gone]
+        edits += _bitmap_merges(packets, group, pinned)
+    return edits
+
+
+def apply(packets, edits):
+    """The packet stream with the given edits made.
+    """
+    out = [bytearray(packet) for packet in packets]
+    gone = set()
+    for kind, first, others in edits:
+        if kind == DEAD:
+            gone.add(first)
+        elif kind == FOLDED:
+            out[first][PKT_E_DATA_OFFSET] = sum(packets[pos][PKT_E_DATA_OFFSET] for pos in [first] + others)
+        elif kind == MERGED:
+            bitmap = 0
+            for pos in [first] + others:
+                bitmap |= u16(packets[pos], PKT_ADDRESS_OFFSET)
+            out[first][PKT_ADDRESS_OFFSET] = bitmap & 0xFF
+            out[first][PKT_ADDRESS_OFFSET+1] = bitmap >> 8
+        gone.update(others)
+    return [packet for pos, packet in enumerate(out) if pos not in gone]
+
+
+class _StateSimulator(Simulator):
+    """A Simulator whose frames carry the dynamics byte along with the color.
+    """
+    def frame(self):
+        if self._dirty:
+            self._frame = self.buffers.reshape(-1, 4)[self.gather]
+            self._dirty = False
+        return self._frame
+
+
+def replay(packets, seed=0):
+    """What the pyramid shows while a packet stream plays: a list of (first tick, frame)
+    for every change of frame, followed by the slaves' queue contents at the end.
+    """
+    sim = _StateSimulator(seed=seed)
+    data = b''.join(slip_encode(packet) for packet in packets)
+    trace = []
+    for first, count, frame in sim.play([('', data)]):
+        frame = frame.tobytes()
+        if not trace or trace[-1][1] != frame:
+            trace.append((first, frame))
+    queues = [sorted(bytes(slot) for slot in slave.queue if slot[PKT_REPEAT_COUNT_OFFSET])
+              for slave in sim.slaves]
+    return trace, sim.tick, queues
+
+
+def optimize_and_check(packets, name='', verbose=True):
+    """Optimize a packet stream, keeping only the rewrites that replay identically.
+    Prints a before and after report unless told not to.
+    """
+    packets = [bytearray(packet) for packet in packets]
+    edits = plan(packets)
+    rejected = 0
+    stream = apply(packets, edits)
+    if edits:
+        reference = replay(packets)
+        if replay(stream) != reference:
+            kept = []
+            for edit in edits:
+                if replay(apply(packets, kept + [edit])) == reference:
+                    kept.append(edit)
+            rejected = len(edits) - len(kept)
+            edits = kept
+            stream = apply(packets, edits)
+    if verbose:
+        before = wire_bytes(packets)
+        after = wire_bytes(stream)
+        removed = {DEAD: 0, FOLDED: 0, MERGED: 0}
+        for kind, first, others in edits:
+            removed[kind] += len(others) or 1
+        print('%-12s %6d -> %6d bytes (%+d, %.1f%%): %d dead, %d folded, %d merged%s' % (
+            name, before, after, after - before, 100.0 * (after - before) / max(before, 1),
+            removed[DEAD], removed[FOLDED], removed[MERGED],
+            ', %d rewrites rejected by replay' % rejected if rejected else ''))
+    return stream
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid packet stream peephole optimizer')
+    parser.add_argument('files', nargs='+', help='.PKT files to optimize')
+    parser.add_argument('--write', action='store_true', help='write the optimized packets back to the files')
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            packets = list(read_packets(f.read()))
+        stream = optimize_and_check(packets, path)
+        if args.write:
+            with open(path, 'wb') as f:
+                for packet in stream:
+                    f.write(slip_encode(packet))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
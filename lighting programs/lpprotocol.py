@@ -0,0 +1,431 @@
+#! /usr/bin/env python3
+
+# The Isis Pyramid 1.1 packet protocol, from its one definition.
+#
+# isis_protocol.json lists the command codes of the slave, entity and meta packets,
+# the layout of each (every field's offset and width, header included), the dynamics
+# bits and the SLIP codes. From it this writes
+#
+#   isis_master/isis_packets.h   for the master
+#   isis_slave/isis_packets.h    the same, for the slave (the IDE only looks in the
+#                                sketch's own directory)
+#   isis_protocol.py             the same definitions for the host tools, which
+#                                isis_packets.py takes its constants from
+#
+# so the firmware and the tools can't drift apart again. Each time, the spec is checked
+# first: codes are distinct and fit under COMMAND_MASK, every packet fits in PACKET_MAX,
+# and no command byte, as it goes on the wire (with ENTITY_ADDRESSED set, for an entity
+# command), is FEND or FESC. A command byte that is costs an escape in every packet of
+# that kind. That was the case for FILL_RGB, the
+# commonest packet in the show, while it was 0x40; it is now 0x48. A command that has
+# moved keeps its old code as "was" in the spec, and --migrate rewrites PKT files
+# compiled before the move.
+#
+# --risk prints each field's SLIP escape risk: how many escape bytes it would cost per
+# thousand packets if its values were spread evenly over their range, and how many it
+# actually costs in the PKT files given (the ones in this directory by default).
+# Addresses and colors are where the escapes are: E_DIAG_6|E_DIAG_7 is 0x00C0.
+#
+# Usage: lpprotocol [--check] [--risk [PKT ...]] [--migrate PKT ...]
+
+import argparse
+import collections
+import glob
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+SPEC = os.path.join(HERE, 'isis_protocol.json')
+
+HEADERS = [os.path.join(ROOT, 'isis_master', 'isis_packets.h'),
+           os.path.join(ROOT, 'isis_slave', 'isis_packets.h')]
+MODULE = os.path.join(HERE, 'isis_protocol.py')
+
+SLAVE, ENTITY, META = 'slave', 'entity', 'meta'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else value
+
+
+class Field(object):
+    """One field of one kind of packet: where it is, how wide, and the largest value it takes.
+    """
+    def __init__(self, name, offset, width, maximum):
+        self.name = name
+        self.offset = offset
+        self.width = width
+        self.maximum = maximum
+
+    def __repr__(self):
+        return 'Field(%s, %d, %d)' % (self.name, self.offset, self.width)
+
+
+class Command(object):
+    """One command code, with the full layout of its packets.
+    """
+    def __init__(self, kind, name, code, fields, was=None):
+        self.kind = kind
+        self.name = name
+        self.code = code
+        self.fields = fields
+        self.was = was
+
+    @property
+    def length(self):
+        return self.fields[-1].offset + self.fields[-1].width
+
+
+class Protocol(object):
+    """The parsed spec.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.title = spec['title']
+        self.entity_addressed = _int(spec['entity_addressed'])
+        self.command_mask = _int(spec['command_mask'])
+        self.packet_max = spec['packet_max']
+        self.all_call = _int(spec['address_all_call'])
+        self.cmd_meta = _int(spec['meta_command']['code'])
+        self.slip = collections.OrderedDict((s['name'], _int(s['code'])) for s in spec['slip'])
+        self.dynamics = [(d['name'], _int(d['bit']), d['doc']) for d in spec['dynamics']]
+        self.layouts = spec['layouts']
+
+        self.offsets = collections.OrderedDict()        # #define -> offset, in spec order
+        for kind in ('all', SLAVE, ENTITY, META):
+            offset = 0 if kind in ('all', META) else sum(f['width'] for f in self.layouts['all'])
+            for field in self.layouts[kind]:
+                if 'define' in field:
+                    self.offsets[field['define']] = offset
+                offset += field['width']
+
+        self.commands = []
+        for kind in (SLAVE, ENTITY, META):
+            for c in spec[kind + '_commands']:
+                self.commands.append(Command(kind, c['name'], _int(c['code']), self._layout(kind, c),
+                                             _int(c['was']) if 'was' in c else None))
+
+    def _layout(self, kind, command):
+        if kind == META:
+            header = self.layouts[META][:-1]
+        else:
+            header = self.layouts['all'] + self.layouts[kind][:-1]
+        address_max = self.spec['address_max'].get(kind)
+        fields = []
+        offset = 0
+        for f in header + command['fields']:
+            maximum = _int(f['max']) if 'max' in f else (1 << (8 * min(f['width'], 2))) - 1
+            if f['name'] == 'address':
+                maximum = _int(address_max)
+            fields.append(Field(f['name'], offset, f['width'], maximum))
+            offset += f['width']
+        return fields
+
+    def of_kind(self, kind):
+        return [c for c in self.commands if c.kind == kind]
+
+    def wire_code(self, command):
+        """The command byte as it goes in a PKT file and on the bus.
+        """
+        if command.kind == META:
+            return self.cmd_meta
+        if command.kind == ENTITY:
+            return self.entity_addressed | command.code
+        return command.code
+
+    def check(self):
+        """Raise ProtocolError if the spec contradicts itself or the firmware's assumptions.
+        """
+        escapes = (self.slip['FEND'], self.slip['FESC'])
+        for kind in (SLAVE, ENTITY, META):
+            codes = [c.code for c in self.of_kind(kind)]
+            if len(set(codes)) != len(codes):
+                raise ProtocolError('two %s commands share a code' % kind)
+        for c in self.commands:
+            wire = self.wire_code(c)
+            if c.kind != META and (c.code & ~self.command_mask or
+                                   bool(wire & self.entity_addressed) != (c.kind == ENTITY)):
+                raise ProtocolError('%s %s: code 0x%02X does not fit the command mask' % (c.kind, c.name, c.code))
+            if wire in escapes or (c.kind == META and c.code in escapes):
+                raise ProtocolError('%s %s: 0x%02X would have to be escaped in every packet' % (c.kind, c.name, wire))
+            if c.length >= self.packet_max:
+                raise ProtocolError('%s %s: %d bytes, and the receivers drop packets of PACKET_MAX (%d)'
+                                    % (c.kind, c.name, c.length, self.packet_max))
+            if c.was is not None and any(c.was == other.code for other in self.of_kind(c.kind)):
+                raise ProtocolError('%s %s: its old code 0x%02X is in use again' % (c.kind, c.name, c.was))
+        if self.cmd_meta in [self.wire_code(c) for c in self.commands if c.kind != META]:
+            raise ProtocolError('CMD_META collides with a command code')
+
+
+def load(path=SPEC):
+    with open(path) as f:
+        protocol = Protocol(json.load(f, object_pairs_hook=collections.OrderedDict))
+    protocol.check()
+    return protocol
+
+
+# ---- generated files ----
+
+def c_header(protocol):
+    """The text of isis_packets.h.
+    """
+    def define(name, value, comment=None, width=28):
+        line = '#define  %-*s %s' % (width, name, value)
+        return line + ('    // ' + comment if comment else '')
+
+    def offset_comment(width):
+        return {0: 'any number of packet-specific arguments', 2: 'uint16_t'}.get(width)
+
+    out = ['// %s' % protocol.title, '//',
+           '// Generated by lpprotocol.py from lighting programs/isis_protocol.json. Don\'t edit',
+           '// it here: change the spec and run lpprotocol.py, which writes the copies for the',
+           '// master and the slave and the host tools\' isis_protocol.py together.', '']
+
+    out.append('// Packet command codes for slave commands')
+    out += [define('CMD_S_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(SLAVE)]
+    out += ['', '// Packet command codes for entity commands. Entity packets carry ENTITY_ADDRESSED',
+            '// in the command byte, and the slave masks it off with COMMAND_MASK. None of the',
+            '// codes, with that bit set, is FEND or FESC.']
+    out += [define('CMD_E_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(ENTITY)]
+    out += [define('ENTITY_ADDRESSED', '0x%02X' % protocol.entity_addressed),
+            define('COMMAND_MASK', '0x%02X' % protocol.command_mask)]
+    out += ['', '// ' + protocol.spec['meta_command']['doc'],
+            define('CMD_META', '0x%02X' % protocol.cmd_meta), '']
+
+    headings = {'PKT_COMMAND_OFFSET': 'Offsets into the packet format for parsing all packets.',
+                'PKT_S_DATA_OFFSET': 'Offsets into the packet format for parsing slave packets.',
+                'PKT_REPEAT_COUNT_OFFSET': 'Offsets into the packet format for parsing entity packets.\n'
+                                           '// All entity packets share a common header.',
+                'PKT_META_CMD_OFFSET': 'Offsets into the packet format for parsing meta packets in '
+                                       'the canned packet file.'}
+    widths = dict((f['define'], f['width']) for kind in protocol.layouts.values()
+                  for f in kind if 'define' in f)
+    for name, offset in protocol.offsets.items():
+        if name == 'PKT_META_CMD_OFFSET':
+            line = define('PACKET_MAX', protocol.packet_max, 'number of bytes in longest valid packet')
+            out += [line, ' ' * line.index('//') + '// applies to slave or entity packets', '',
+                    define('PKT_ADDRESS_ALL_CALL', '0x%04X' % protocol.all_call,
+                           'address all slaves or all entities'), '']
+        if name in headings:
+            out.append('// ' + headings[name])
+        out.append(define(name, offset, offset_comment(widths[name])))
+        if name in ('PKT_ADDRESS_OFFSET', 'PKT_S_DATA_OFFSET', 'PKT_E_DATA_OFFSET'):
+            out.append('')
+
+    out += ['', '// The following meta commands are defined:']
+    out += [define('META_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(META)]
+    out += ['', '// The following types of dynamics are defined:']
+    out += [define('DYNAMICS_' + name, '0x%02X' % bit, doc) for name, bit, doc in protocol.dynamics]
+    out += ['', '// Special codes for byte stuffing. Per KISS or SLIP protocol standards.']
+    out += [define(name, '0x%02X' % code) for name, code in protocol.slip.items()]
+    return '\n'.join(line.rstrip() for line in out) + '\n'
+
+
+def python_module(protocol):
+    """The text of isis_protocol.py.
+    """
+    def assign(name, value, comment=None, width=26):
+        line = '%-*s = %s' % (width, name, value)
+        return line + ('    # ' + comment if comment else '')
+
+    out = ['# %s, for host-side tools.' % protocol.title, '#',
+           '# Generated by lpprotocol.py from isis_protocol.json, like isis_packets.h. Don\'t',
+           '# edit it here: change the spec and run lpprotocol.py. isis_packets.py brings these',
+           '# names in, along with the helpers for picking packets apart.', '']
+
+    out.append('# Packet command codes for slave commands')
+    out += [assign('CMD_S_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(SLAVE)]
+    out += ['', '# Packet command codes for entity commands, as the slave sees them after',
+            '# masking off the entity-addressing bit.']
+    out += [assign('CMD_E_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(ENTITY)]
+    out += ['', assign('ENTITY_ADDRESSED', '0x%02X' % protocol.entity_addressed,
+                       'set in the command byte of every entity packet'),
+            assign('COMMAND_MASK', '0x%02X' % protocol.command_mask, 'what the slave keeps of the command byte')]
+    out += ['', '# ' + protocol.spec['meta_command']['doc'],
+            assign('CMD_META', '0x%02X' % protocol.cmd_meta), '']
+
+    out.append('# Offsets into the packets, as in isis_packets.h.')
+    out += [assign(name, offset) for name, offset in protocol.offsets.items()]
+    out += ['', assign('PACKET_MAX', protocol.packet_max, 'number of bytes in longest valid packet'),
+            assign('PKT_ADDRESS_ALL_CALL', '0x%04X' % protocol.all_call, 'address all slaves or all entities')]
+
+    out += ['', '# The following meta commands are defined:']
+    out += [assign('META_' + c.name, '0x%02X' % c.code) for c in protocol.of_kind(META)]
+    out += ['', '# The following types of dynamics are defined:']
+    out += [assign('DYNAMICS_' + name, '0x%02X' % bit, doc) for name, bit, doc in protocol.dynamics]
+    out += ['', '# Special codes for byte stuffing. Per KISS or SLIP protocol standards.']
+    out += [assign(name, '0x%02X' % code) for name, code in protocol.slip.items()]
+
+    prefixes = {SLAVE: 'CMD_S_', ENTITY: 'CMD_E_', META: 'META_'}
+    tables = {SLAVE: 'SLAVE_COMMAND', ENTITY: 'ENTITY_COMMAND', META: 'META'}
+    out += ['', '# Human-readable names, for reports.']
+    for kind in (SLAVE, ENTITY, META):
+        out.append('%s_NAMES = {' % tables[kind])
+        out += ['    %s: %r,' % (prefixes[kind] + c.name, c.name) for c in protocol.of_kind(kind)]
+        out += ['}', '']
+
+    out += ['# The fields of each kind of packet, header included, as (name, offset, width).',
+            '# Widths are in bytes; two-byte fields are little-endian, as the AVR has them.']
+    for kind in (SLAVE, ENTITY, META):
+        out.append('%s_FIELDS = {' % kind.upper())
+        for c in protocol.of_kind(kind):
+            out.append('    %s: (%s),' % (prefixes[kind] + c.name,
+                                          ', '.join('(%r, %d, %d)' % (f.name, f.offset, f.width) for f in c.fields)))
+        out += ['}', '']
+    return '\n'.join(line.rstrip() for line in out[:-1]) + '\n'
+
+
+def generated(protocol):
+    """Each generated file's path, with what it should contain.
+    """
+    header = c_header(protocol)
+    return [(path, header) for path in HEADERS] + [(MODULE, python_module(protocol))]
+
+
+def write_generated(protocol, check_only=False):
+    """Write the files that are out of date, and return their paths. With check_only,
+    just return them.
+    """
+    stale = []
+    for path, text in generated(protocol):
+        current = None
+        if os.path.exists(path):
+            with open(path) as f:
+                current = f.read()
+        if current != text:
+            stale.append(path)
+            if not check_only:
+                with open(path, 'w') as f:
+                    f.write(text)
+    return stale
+
+
+# ---- escape risk ----
+
+def _escape_bytes(value, width, escapes):
+    return sum(1 for i in range(width) if (value >> (8 * i)) & 0xFF in escapes)
+
+
+def theoretical_risk(field, escapes):
+    """Escape bytes the field costs on average, its values spread evenly over 0..maximum.
+    Fields wider than two bytes are taken a byte at a time.
+    """
+    if field.name == 'command':
+        return None
+    per = min(field.width, 2)
+    total = sum(_escape_bytes(v, per, escapes) for v in range(field.maximum + 1))
+    return total / float(field.maximum + 1) * field.width / per
+
+
+def observed_risk(protocol, paths):
+    """Escape bytes each field actually costs in the given PKT files, as
+    {(kind, command name, field name): escapes}, with the number of packets of each command.
+    """
+    from isis_packets import read_packets
+    escapes = (protocol.slip['FEND'], protocol.slip['FESC'])
+    by_wire = {}
+    for c in protocol.commands:
+        by_wire[(protocol.wire_code(c), c.code if c.kind == META else None)] = c
+    counts = collections.Counter()
+    packets = collections.Counter()
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        for packet in read_packets(data):
+            if not packet:
+                continue
+            meta = packet[1] if packet[0] == protocol.cmd_meta and len(packet) > 1 else None
+            command = by_wire.get((packet[0], meta))
+            if command is None:
+                continue
+            packets[(command.kind, command.name)] += 1
+            for field in command.fields:
+                chunk = packet[field.offset:field.offset + field.width]
+                counts[(command.kind, command.name, field.name)] += sum(1 for b in chunk if b in escapes)
+    return counts, packets
+
+
+def risk_report(protocol, paths):
+    escapes = (protocol.slip['FEND'], protocol.slip['FESC'])
+    counts, packets = observed_risk(protocol, paths)
+    print('%-7s %-12s %-16s %6s %5s %10s %8s %10s' % ('kind', 'command', 'field', 'offset', 'width',
+                                                        'risk/1000', 'escapes', 'seen/1000'))
+    total_packets = sum(packets.values())
+    total_escapes = 0
+    for c in protocol.commands:
+        seen = packets[(c.kind, c.name)]
+        for field in c.fields:
+            risk = theoretical_risk(field, escapes)
+            if risk is None:
+                risk = 1000.0 if protocol.wire_code(c) in escapes else 0.0
+            else:
+                risk *= 1000
+            escaped = counts[(c.kind, c.name, field.name)]
+            total_escapes += escaped
+            print('%-7s %-12s %-16s %6d %5d %10.1f %8d %10s' % (
+                c.kind, c.name, field.name, field.offset, field.width, risk, escaped,
+                '%.1f' % (1000.0 * escaped / seen) if seen else '-'))
+    print('\n%d packets in %d files, %d escape bytes (meta packets are in the files but never on the bus)'
+          % (total_packets, len(paths), total_escapes))
+
+
+# ---- migration ----
+
+def migrate(protocol, path):
+    """Rewrite the command bytes of a PKT file compiled with codes the spec has since moved.
+    Returns the number of packets changed.
+    """
+    from isis_packets import read_packets, slip_encode
+    moved = dict((protocol.wire_code(Command(c.kind, c.name, c.was, c.fields)), protocol.wire_code(c))
+                 for c in protocol.commands if c.was is not None)
+    with open(path, 'rb') as f:
+        data = f.read()
+    out = bytearray()
+    changed = 0
+    for packet in read_packets(data):
+        packet = bytearray(packet)
+        if packet and packet[0] in moved:
+            packet[0] = moved[packet[0]]
+            changed += 1
+        out += slip_encode(packet)
+    if changed:
+        with open(path, 'wb') as f:
+            f.write(out)
+    return changed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate the Isis Pyramid packet definitions from isis_protocol.json')
+    parser.add_argument('--check', action='store_true', help="only say whether the generated files are up to date")
+    parser.add_argument('--risk', nargs='*', metavar='PKT', help='print the escape risk of each field')
+    parser.add_argument('--migrate', nargs='+', metavar='PKT', help='rewrite PKT files compiled with old codes')
+    args = parser.parse_args(argv)
+
+    try:
+        protocol = load()
+    except ProtocolError as e:
+        print('%s: %s' % (SPEC, e), file=sys.stderr)
+        return 1
+
+    if args.risk is not None:
+        risk_report(protocol, args.risk or sorted(glob.glob(os.path.join(HERE, '*.PKT'))))
+        return 0
+    if args.migrate:
+        for path in args.migrate:
+            print('%s: %d packets rewritten' % (path, migrate(protocol, path)))
+        return 0
+
+    stale = write_generated(protocol, args.check)
+    for path in stale:
+        print('%s %s' % ('out of date:' if args.check else 'wrote', os.path.relpath(path)))
+    return 1 if args.check and stale else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
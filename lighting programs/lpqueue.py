@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+
+# Static deferred-queue occupancy checker for Isis Pyramid 1.1 lighting programs.
+#
+# Each slave has QUEUE_MAX (10) slots in its deferred_queue. Every entity packet that
+# isn't for one-shot immediate execution takes a slot on every slave that handles one of
+# the entities it addresses, and holds it until its last repeat has executed. When a
+# packet arrives and all the slots are busy, handle_entity_packet() drops it on the
+# floor without a word, and the program author is left to guess ("don't queue up too
+# many packets in each slave").
+#
+# This pass works it out instead. It follows the master's playout of the programs with
+# a bus that takes no time (lpsim.playout()), routes every packet to the slaves that own
+# the addressed entities according to the isis_config.ino tables, and works out from
+# the repeat count, effective time and repeat interval exactly which tick each queued
+# packet finishes on, the way scan_deferred_queue() will run it. No pixels are touched
+# and no ticks are stepped through, so the whole playlist checks in a blink.
+#
+# It reports the peak occupancy of each slave's queue per program, every packet that
+# would be dropped, and optionally (--timeline) a strip chart of occupancy per slave.
+#
+# Usage: lpqueue [--show N] [--timeline] [--window TICKS] PLAYLIST.TXT | file.PKT ...
+
+import argparse
+import heapq
+import sys
+import time
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+from lpsim import load_programs, playout
+
+
+def last_execution(now, effective_time, repeat_count, interval):
+    """The slave tick (current_tick, counting on past 0xFFFF) on which a packet put in the
+    queue at slave tick now executes for the last time.
+
+    scan_deferred_queue() executes a slot at most once per tick, on the first scan at or
+    after its effective time, then moves the effective time on by the repeat interval
+    (counting from the current tick when the effective time was 0). A packet that falls
+    behind its schedule therefore catches up one repeat per tick.
+    """
+    if effective_time == 0:
+        if repeat_count == 1:
+            return now
+        repeat_count -= 1
+        effective_time = (now + interval) & 0xFFFF
+        now += 1
+    if effective_time != 0:
+        # The k-th execution from here is at max(now + k, effective_time + k*interval),
+        # or at max(now, effective_time) + k when the interval is 0.
+        if interval == 0:
+            last = max(now, effective_time) + repeat_count - 1
+        else:
+            last = max(now + repeat_count - 1, effective_time + (repeat_count - 1) * interval)
+        if last <= 0xFFFF:
+            return last
+
+    # The clock or the effective time wraps around along the way; step through it.
+    while True:
+        current = now & 0xFFFF
+        if effective_time > current:
+            now += effective_time - current
+            continue
+        repeat_count -= 1
+        if repeat_count == 0:
+            return now
+        if effective_time == 0:
+            effective_time = current + interval
+        else:
+            effective_time += interval
+        effective_time &= 0xFFFF
+        now += 1
+
+
+class ProgramQueues(object):
+    """Deferred queue usage while one lighting program played.
+    """
+    def __init__(self, name, start_tick, slaves):
+        self.name = name
+        self.start_tick = start_tick
+        self.end_tick = start_tick
+        self.deferred = 0               # (packet, slave) deliveries put on a queue
+        self.peak = [0] * slaves        # most slots in use at once, per slave
+        self.dropped = []               # (tick, slave address, packet index, packet)
+
+    @property
+    def ticks(self):
+        return self.end_tick - self.start_tick
+
+
+class QueueChecker(object):
+    """Keeps count of the deferred_queue slots in use on every slave as a playout goes by.
+    """
+    def __init__(self, slaves=None, queue_max=QUEUE_MAX):
+        if slaves is None:
+            slaves = isis_config.load_config()
+        self.slaves = slaves
+        self.queue_max = queue_max
+        self.origin = [0] * len(slaves)         # absolute tick at which each slave's current_tick was 0
+        self.busy = [[] for s in slaves]        # heap of (release tick, span) per slave
+        self.spans = [[] for s in slaves]       # [arrival, release] ticks of every slot used
+        self.rcv_buffer = bytearray(PACKET_MAX)
+        self.stats = []
+        self.current = None
+
+    def occupancy(self, i, tick):
+        """Slots in use on slave i when a packet arrives during the given tick. A slot
+        whose last execution is in the scan at the end of tick t is free again at t+1.
+        """
+        busy = self.busy[i]
+        while busy and busy[0][0] < tick:
+            heapq.heappop(busy)
+        return len(busy)
+
+    def deliver(self, tick, index, packet):
+        """A packet arrives on the bus at the given absolute tick.
+        """
+        count = len(packet)
+        self.rcv_buffer[:count] = packet
+        buf = self.rcv_buffer           # short packets pick up stale bytes, as in the firmware
+        address = u16(buf, PKT_ADDRESS_OFFSET)
+        if not buf[PKT_COMMAND_OFFSET] & ENTITY_ADDRESSED:
+            if buf[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_S_RESET_CLOCK:
+                for i, slave in enumerate(self.slaves):
+                    if address & slave.slave_address_bitmap:
+                        self._reset(i, tick)
+            return
+
+        repeat_count = buf[PKT_REPEAT_COUNT_OFFSET]
+        effective_time = u16(buf, PKT_EFFECTIVE_TIME_OFFSET)
+        interval = u16(buf, PKT_REPEAT_INTERVAL_OFFSET)
+        if repeat_count == 1 and effective_time == 0:
+            return                      # executed on arrival, no slot needed
+        stats = self.current
+        for i, slave in enumerate(self.slaves):
+            if not address & slave.entity_address_bitmap:
+                continue
+            used = self.occupancy(i, tick)
+            if used >= self.queue_max:
+                stats.dropped.append((tick, slave.address, index, bytes(packet)))
+                continue
+            if repeat_count == 0:
+                continue                # lands in an empty slot and leaves it empty
+            now = (tick - self.origin[i]) & 0xFFFF
+            release = tick + last_execution(now, effective_time, repeat_count, interval) - now
+            span = [tick, release]
+            heapq.heappush(self.busy[i], (release, id(span), span))
+            self.spans[i].append(span)
+            stats.deferred += 1
+            stats.peak[i] = max(stats.peak[i], used + 1)
+
+    def _reset(self, i, tick):
+        """CMD_S_RESET_CLOCK: the slave's clock starts over and its queue is emptied.
+        """
+        self.origin[i] = tick
+        for release, key, span in self.busy[i]:
+            span[1] = tick - 1
+        del self.busy[i][:]
+
+    def play(self, programs):
+        """Check a sequence of (name, file contents) programs, played in order.
+        """
+        self.current = ProgramQueues('(setup)', 0, len(self.slaves))
+        for tick, name, index, packet in playout(programs):
+            if packet is None:
+                self.current.end_tick = tick
+                self.current = None
+                continue
+            if self.current is None:
+                self.current = ProgramQueues(name, tick, len(self.slaves))
+                self.stats.append(self.current)
+            if not is_meta(packet):
+                self.deliver(tick, index, packet)
+        return self.stats
+
+    def timeline(self, i, start, stop, window):
+        """Most slots in use on slave i in each window of ticks from start to stop.
+        """
+        level = np.zeros(stop - start + 1, dtype=np.int32)
+        for arrival, release in self.spans[i]:
+            if release < start or arrival >= stop or release < arrival:
+                continue
+            level[max(arrival, start) - start] += 1
+            level[min(release + 1, stop) - start] -= 1
+        level = np.cumsum(level[:-1])
+        windows = -(-len(level) // window)
+        level = np.pad(level, (0, windows * window - len(level)))
+        return level.reshape(windows, window).max(axis=1)
+
+
+def check(programs, slaves=None):
+    """Run the check over a list of (name, contents) programs. Returns the QueueChecker.
+    """
+    checker = QueueChecker(slaves)
+    checker.play(programs)
+    return checker
+
+
+def report(checker, show, timeline, window):
+    slaves = checker.slaves
+    print('%-12s %7s %8s %5s %5s  %s' % ('program', 'ticks', 'deferred', 'peakq', 'drops',
+                                         'peak by slave ' + ''.join('%X' % (s.address % 16) for s in slaves)))
+    for st in checker.stats:
+        print('%-12s %7d %8d %5d %5d  %14s%s' % (st.name, st.ticks, st.deferred, max(st.peak), len(st.dropped),
+                                                 '', ''.join('%X' % n if n < 16 else '+' for n in st.peak)))
+        for tick, slave, index, packet in st.dropped[:show]:
+            print('    packet %d dropped by slave %d at tick %d: %s bitmap %04X repeat %d start %d interval %d' % (
+                index, slave, tick - st.start_tick, command_name(packet), u16(packet, PKT_ADDRESS_OFFSET),
+                packet[PKT_REPEAT_COUNT_OFFSET], u16(packet, PKT_EFFECTIVE_TIME_OFFSET),
+                u16(packet, PKT_REPEAT_INTERVAL_OFFSET)))
+        if len(st.dropped) > show:
+            print('    ... and %d more dropped' % (len(st.dropped) - show))
+
+        if timeline and st.ticks > 0:
+            print('    one column per %d ticks; . empty, 1-9 slots in use, # full, X dropped' % window)
+            for i, slave in enumerate(slaves):
+                levels = checker.timeline(i, st.start_tick, st.end_tick, window)
+                chart = ['.' if n == 0 else '#' if n >= checker.queue_max else str(n) for n in levels]
+                for tick, address, index, packet in st.dropped:
+                    if address == slave.address:
+                        chart[min((tick - st.start_tick) // window, len(chart) - 1)] = 'X'
+                print('    slave %2d %s' % (slave.address, ''.join(chart)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid deferred queue occupancy checker')
+    parser.add_argument('files', nargs='+', help='.PKT files and/or PLAYLIST.TXT files, played in order')
+    parser.add_argument('--show', type=int, default=5, metavar='N', help='list at most N dropped packets per program')
+    parser.add_argument('--timeline', action='store_true', help='chart queue occupancy per slave over time')
+    parser.add_argument('--window', type=int, default=50, metavar='TICKS', help='ticks per timeline column')
+    args = parser.parse_args(argv)
+
+    programs = load_programs(args.files)
+    started = time.time()
+    checker = check(programs)
+    elapsed = time.time() - started
+    report(checker, args.show, args.timeline, max(1, args.window))
+    drops = sum(len(st.dropped) for st in checker.stats)
+    print('%d programs checked in %.3f s, %d packets dropped' % (len(checker.stats), elapsed, drops))
+    return 1 if drops else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,328 @@
+#! /usr/bin/env python3
+
+# Repeat folding for Isis Pyramid 1.1 packet streams.
+#
+# Lighting programs often spell out, packet by packet, what one repeating packet could
+# say: the same fill every so many ticks, or a rainbow handed on from one 100-repeat
+# packet to the next. scan_deferred_queue() runs a queued packet repeat_count times,
+# repeat_interval ticks apart, and execute_packet_wrapup() moves a RAINBOW's start on by
+# its increment after every run, so packets that are the same but for when they run (and,
+# for RAINBOW, for a start that keeps pace with the wrapup) can go as one.
+#
+# This pass follows the master's playout, works out on which slave ticks each entity
+# packet runs, and looks, among packets with the same command, entities and arguments,
+# for runs of them whose executions make one arithmetic progression:
+#   - queued packets, each taking over where the one before left off, are folded into the
+#     first of them, with the repeat counts added up;
+#   - immediate packets (repeat count 1, effective time 0) run as they arrive, before the
+#     slaves show the tick, so the queued packet that stands in for them runs in the scan
+#     at the end of the tick before. The first stays as it is; the rest, three or more
+#     in all, are folded into a queued packet sent along with it.
+# A repeat count is one byte, so runs stop at 255, and none crosses a RESET_CLOCK (which
+# empties the queues) or a wrap of the slaves' 16-bit clock. A folded packet holds a
+# deferred_queue slot on every slave it reaches for the whole run, where the packets it
+# replaces may have come and gone, so a fold is only made if those slaves have a slot to
+# spare throughout, counting the folds already made (see lpqueue).
+#
+# As with lpoptimize, fold_and_check() replays the stream through lpsim before and after,
+# pixel colors, dynamics bytes and leftover queues alike, and has lpqueue count dropped
+# packets; folds that change anything are backed out one by one.
+#
+# lpcompile -R runs this on its output before writing the PKT file. It can also be run
+# on existing PKT files.
+#
+# Usage: lprepeat [--write] file.PKT ...
+
+import argparse
+import sys
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+import lpoptimize
+import lpqueue
+from lpsim import playout
+
+REPEAT_MAX = 0xFF           # repeat_count is one byte
+IMMEDIATE_MIN = 3           # immediate packets it takes to make a fold worth it
+
+QUEUED, IMMEDIATE = 'queued', 'immediate'
+
+
+class _Runs(object):
+    """When an entity packet runs: count times on slave ticks first, first + step, ...
+    either on arrival (immediate) or in the scan at the end of the tick.
+    """
+    def __init__(self, index, sent, origin, first, count, step, immediate):
+        self.index = index
+        self.sent = sent                # absolute tick the master sends it
+        self.origin = origin            # absolute tick at which the slaves' clocks were 0
+        self.first = first
+        self.count = count
+        self.step = step                # None if it only runs once
+        self.immediate = immediate
+
+    @property
+    def last(self):
+        return self.first + (self.count - 1) * (self.step or 0)
+
+
+def _is_rainbow(packet):
+    return packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_E_RAINBOW
+
+
+def _body(packet):
+    """What has to be the same for packets to fold: everything but the timing and the
+    RAINBOW start.
+    """
+    body = bytearray(packet)
+    body[PKT_REPEAT_COUNT_OFFSET:PKT_E_DATA_OFFSET] = bytes(PKT_E_DATA_OFFSET - PKT_REPEAT_COUNT_OFFSET)
+    if _is_rainbow(packet):
+        body[PKT_E_DATA_OFFSET] = 0
+    return bytes(body)
+
+
+def _turned(packet, runs):
+    """A packet's RAINBOW start after the wrapup has moved it on runs times.
+    """
+    data = PKT_E_DATA_OFFSET
+    turn = -packet[data+1] if packet[data+2] else packet[data+1]
+    return (packet[data] + runs * turn) & 0xFF
+
+
+def _executions(packets):
+    """The _Runs of every entity packet that runs to a timetable the pass can follow, by
+    position, and the positions of the RESET_CLOCKs.
+    """
+    data = b''.join(slip_encode(packet) for packet in packets)
+    if [bytes(p) for p in read_packets(data)] != [bytes(p) for p in packets]:
+        return {}, []           # wouldn't survive the round trip; leave well alone
+    runs = {}
+    resets = []
+    origin = 0                  # None after a RESET_CLOCK that leaves the slaves' clocks out of step
+    for tick, name, index, packet in playout([('', data)]):
+        if packet is None or name == '(setup)' or is_meta(packet):
+            continue
+        if not is_entity_packet(packet):
+            if packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_S_RESET_CLOCK:
+                resets.append(index)
+                complete = len(packet) >= PKT_S_DATA_OFFSET
+                origin = tick if complete and u16(packet, PKT_ADDRESS_OFFSET) == PKT_ADDRESS_ALL_CALL else None
+            continue
+        if origin is None or not lpoptimize.is_complete(packet):
+            continue
+        now = tick - origin
+        count = packet[PKT_REPEAT_COUNT_OFFSET]
+        effective = u16(packet, PKT_EFFECTIVE_TIME_OFFSET)
+        interval = u16(packet, PKT_REPEAT_INTERVAL_OFFSET)
+        if now > 0xFFFF or count == 0 or (count > 1 and interval == 0):
+            continue            # never runs, or catches up a run a tick
+        if count == 1 and effective == 0:
+            r = _Runs(index, tick, origin, now, 1, None, True)
+        elif effective == 0:
+            r = _Runs(index, tick, origin, now, count, interval, False)
+        elif effective >= now:
+            r = _Runs(index, tick, origin, effective, count, interval if count > 1 else None, False)
+        else:
+            continue            # late, catching up
+        if r.last <= 0xFFFF:
+            runs[index] = r
+    return runs, resets
+
+
+def _step(chain):
+    """The ticks between a chain's runs, or None while it's one run long.
+    """
+    step = next((c.step for c in chain if c.step), None)
+    if step is None and len(chain) > 1:
+        step = chain[1].first - chain[0].first
+    return step
+
+
+def _follows(packets, chain, r):
+    """True if r carries on where the runs in chain leave off.
+    """
+    step = _step(chain) or r.step
+    gap = r.first - chain[-1].last
+    if gap <= 0 or (step is not None and gap != step) or (r.step is not None and r.step != gap):
+        return False
+    total = sum(c.count for c in chain)
+    if total + r.count > REPEAT_MAX:
+        return False
+    if r.immediate and len(chain) == 1 and r.first < 2:
+        return False            # the stand-in would need an effective time of 0
+    head = packets[chain[0].index]
+    return not _is_rainbow(head) or packets[r.index][PKT_E_DATA_OFFSET] == _turned(head, total)
+
+
+def _chains(packets, runs, resets):
+    """Runs of packets that could go as one, as lists of _Runs, in stream order.
+    """
+    chains = []
+    building = {}               # (body, immediate) -> chain so far
+    resets = set(resets)
+    for index in range(len(packets)):
+        if index in resets:
+            chains += building.values()
+            building = {}
+        r = runs.get(index)
+        if r is None:
+            continue
+        key = (_body(packets[index]), r.immediate)
+        chain = building.get(key)
+        if chain is not None and _follows(packets, chain, r):
+            chain.append(r)
+            continue
+        if chain is not None:
+            chains.append(chain)
+        building[key] = [r]
+    chains += building.values()
+    return sorted((chain for chain in chains if _long_enough(chain)), key=lambda chain: chain[0].index)
+
+
+def _long_enough(chain):
+    return len(chain) >= (IMMEDIATE_MIN if chain[0].immediate else 2)
+
+
+def _folded(packets, chain):
+    """The queued packet that stands in for a chain's queued runs, and the absolute ticks
+    it holds a slot from and to. Immediate runs after the first are run instead in the
+    scan the tick before.
+    """
+    runs = chain[1:] if chain[0].immediate else chain
+    head = runs[0]
+    step = _step(chain)
+    packet = bytearray(packets[head.index])
+    if head.immediate:
+        effective = head.first - 1
+    else:
+        effective = u16(packet, PKT_EFFECTIVE_TIME_OFFSET)
+    packet[PKT_REPEAT_COUNT_OFFSET] = sum(r.count for r in runs)
+    packet[PKT_EFFECTIVE_TIME_OFFSET] = effective & 0xFF
+    packet[PKT_EFFECTIVE_TIME_OFFSET+1] = effective >> 8
+    packet[PKT_REPEAT_INTERVAL_OFFSET] = step & 0xFF
+    packet[PKT_REPEAT_INTERVAL_OFFSET+1] = step >> 8
+    last = runs[-1].last - (1 if head.immediate else 0)
+    return packet, chain[0].sent, head.origin + last
+
+
+def plan(packets, slaves=None):
+    """Work out the folds for a packet stream, as a list of (kind, positions, packet)
+    edits. QUEUED: the packet takes the place of the ones at the positions. IMMEDIATE: the
+    first stays, the packet goes in after it, and the rest go. A chain that would leave a
+    slave without a free queue slot is cut short until it doesn't.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    runs, resets = _executions(packets)
+    chains = _chains(packets, runs, resets)
+    if not chains:
+        return []
+
+    # Slots in use on each slave, tick by tick, as lpqueue sees the stream.
+    checker = lpqueue.QueueChecker(slaves)
+    checker.play([('', b''.join(slip_encode(packet) for packet in packets))])
+    end = max([span[1] for spans in checker.spans for span in spans] +
+              [r.origin + r.last for r in runs.values()]) + 2
+    level = np.zeros((len(slaves), end + 1), dtype=np.int32)
+    for i, spans in enumerate(checker.spans):
+        for arrival, release in spans:
+            if release >= arrival:
+                level[i, arrival] += 1
+                level[i, release + 1] -= 1
+    level = np.cumsum(level, axis=1)
+
+    edits = []
+    for chain in chains:
+        while _long_enough(chain):
+            packet, arrival, release = _folded(packets, chain)
+            address = u16(packet, PKT_ADDRESS_OFFSET)
+            trial = {}
+            for i, slave in enumerate(slaves):
+                if not address & slave.entity_address_bitmap:
+                    continue
+                row = level[i].copy()
+                for r in chain:
+                    if not r.immediate:
+                        row[r.sent:r.origin+r.last+1] -= 1
+                row[arrival:release+1] += 1
+                trial[i] = row
+            if all(row[arrival:release+1].max() <= QUEUE_MAX for row in trial.values()):
+                for i, row in trial.items():
+                    level[i] = row
+                edits.append((IMMEDIATE if chain[0].immediate else QUEUED, [r.index for r in chain], packet))
+                break
+            chain = chain[:-1]
+    return edits
+
+
+def apply(packets, edits):
+    """The packet stream with the given folds made.
+    """
+    out = [[bytearray(packet)] for packet in packets]
+    for kind, positions, packet in edits:
+        if kind == QUEUED:
+            out[positions[0]] = [bytearray(packet)]
+        else:
+            out[positions[0]].append(bytearray(packet))
+        for pos in positions[1:]:
+            out[pos] = []
+    return [packet for packets in out for packet in packets]
+
+
+def _dropped(packets, slaves):
+    data = b''.join(slip_encode(packet) for packet in packets)
+    return sum(len(stats.dropped) for stats in lpqueue.check([('', data)], slaves).stats)
+
+
+def fold_and_check(packets, name='', verbose=True):
+    """Fold runs of repeats in a packet stream, keeping only the folds that replay
+    identically and drop no more packets. Prints a before and after report unless told not to.
+    """
+    packets = [bytearray(packet) for packet in packets]
+    slaves = isis_config.load_config()
+    edits = plan(packets, slaves)
+    rejected = 0
+    stream = apply(packets, edits)
+    if edits:
+        reference = lpoptimize.replay(packets)
+        dropped = _dropped(packets, slaves)
+        if lpoptimize.replay(stream) != reference or _dropped(stream, slaves) > dropped:
+            kept = []
+            for edit in edits:
+                trial = apply(packets, kept + [edit])
+                if lpoptimize.replay(trial) == reference and _dropped(trial, slaves) <= dropped:
+                    kept.append(edit)
+            rejected = len(edits) - len(kept)
+            edits = kept
+            stream = apply(packets, edits)
+    if verbose:
+        before = lpoptimize.wire_bytes(packets)
+        after = lpoptimize.wire_bytes(stream)
+        print('%-12s %6d -> %6d bytes (%+d, %.1f%%): %d runs of %d packets folded%s' % (
+            name, before, after, after - before, 100.0 * (after - before) / max(before, 1),
+            len(edits), sum(len(positions) for kind, positions, packet in edits),
+            ', %d folds rejected by replay' % rejected if rejected else ''))
+    return stream
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid packet stream repeat folder')
+    parser.add_argument('files', nargs='+', help='.PKT files to fold')
+    parser.add_argument('--write', action='store_true', help='write the folded packets back to the files')
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            packets = list(read_packets(f.read()))
+        stream = fold_and_check(packets, path)
+        if args.write:
+            with open(path, 'wb') as f:
+                for packet in stream:
+                    f.write(slip_encode(packet))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+#! /usr/bin/env python3
+
+# Just-in-time META_WAIT scheduling for Isis Pyramid 1.1 lighting programs.
+#
+# A packet queued for a later tick doesn't have to go out when the author happened to
+# write it. Sent too early, it sits in a deferred_queue slot (and there are only ten);
+# sent in a bunch with others, it ties up the bus and the packets behind it arrive late.
+# Authors have been steering this by hand with wait_for_tick() calls and globals like
+# wait_until.
+#
+# This pass takes the author's waits as hints only. Packets that act when they arrive
+# (immediate packets, anything repeating from its arrival, slave packets, console output)
+# keep the tick the author gave them, since that is what they mean. Packets with an
+# effective time are taken out and sent as late as they safely can be: working back
+# from the end of the program, each is put on the wire so that it arrives a little
+# (--slack ticks) ahead of its effective time on every slave it addresses, around the
+# bytes of the fixed packets and of the queued packets due after it. They go out in the
+# order they fall due, so one written early but due late doesn't hold the others up
+# (or sit in a queue slot while it waits), and packets due on the same tick still land
+# in the queue in the order the author wrote them; they may slip past packets that act
+# on arrival, which the slaves execute before scanning the queue anyway. RESET_CLOCK,
+# RESET_TIME and short packets (which run on stale bytes) are fences nothing moves
+# across. Then META_WAIT packets are written wherever the send tick moves on.
+#
+# Every slave's deferred_queue is kept track of as the packets go out: each queued
+# packet holds a slot on the slaves it addresses from its arrival until its last
+# execution, and so does a fixed packet that repeats. As every packet already goes as
+# late as it can, a queue that still overflows can't be helped by moving the sends (the
+# program ends before its packets fall due, say), and the schedule fails with a
+# ScheduleError that says where.
+#
+# The result is checked with lpqueue (queue overflows) and lpbus (late arrivals) and
+# reported next to the original.
+#
+# lpcompile -S runs this on its output. It can also be run on existing PKT files.
+#
+# Usage: lpschedule [--slack TICKS] [--baud RATE] [--write] file.PKT ...
+
+import argparse
+import bisect
+import heapq
+import sys
+
+from isis_packets import *
+import isis_config
+import lpbus
+import lpqueue
+from lpsim import playout
+
+FIXED, QUEUED, FENCE = 0, 1, 2
+
+
+class ScheduleError(Exception):
+    pass
+
+
+def _classify(packet, slaves):
+    """How a packet can be scheduled: FIXED to the tick the author chose, QUEUED for
+    just-in-time delivery ahead of its effective time, or a FENCE nothing crosses.
+    """
+    if is_meta(packet):
+        if len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_RESET_TIME:
+            return FENCE
+        return FIXED
+    if len(packet) < PKT_S_DATA_OFFSET:
+        return FENCE
+    if not is_entity_packet(packet):
+        if packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_S_RESET_CLOCK:
+            return FENCE
+        return FIXED
+    if len(packet) < PKT_E_DATA_OFFSET:
+        return FENCE
+    address = u16(packet, PKT_ADDRESS_OFFSET)
+    if not any(address & slave.entity_address_bitmap for slave in slaves):
+        return FIXED
+    if packet[PKT_REPEAT_COUNT_OFFSET] == 0 or u16(packet, PKT_EFFECTIVE_TIME_OFFSET) == 0:
+        return FIXED
+    return QUEUED
+
+
+def _latest_start(finish, width, reserved, starts):
+    """Latest start time for width ms of bus time ending no later than finish without
+    overlapping any of the reserved (start, end) intervals, sorted by start.
+    """
+    while True:
+        i = bisect.bisect_left(starts, finish) - 1
+        if i < 0 or reserved[i][1] <= finish - width:
+            return finish - width
+        finish = reserved[i][0]
+
+
+def schedule(packets, baud=BAUD_RATE, slack=1, slaves=None):
+    """Rewrite the META_WAITs of a packet stream so that queued packets go out just in
+    time. Returns the new list of packets. Packets after META_ENDS are kept as they are.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    packets = [bytes(packet) for packet in packets]
+    data = b''.join(slip_encode(packet) for packet in packets)
+    if [bytes(p) for p in read_packets(data)] != packets:
+        return packets              # wouldn't survive the round trip; leave well alone
+    byte_ms = 1000.0 * lpbus.BITS_PER_BYTE / baud
+
+    # Work out the tick the author sends each packet, and the deadline of the queued ones.
+    items = []                      # [segment, start ms, index, kind, tick, deadline ms, slave origins]
+    slave_origin = [0] * len(slaves)
+    segment = 0
+    floor = None                    # earliest send time in each segment, in ms
+    ends = None
+    end_tick = 0
+    for tick, name, index, packet in playout([('', data)]):
+        if name == '(setup)':
+            continue
+        if packet is None:
+            end_tick = tick
+            continue
+        if is_meta(packet) and len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_WAIT:
+            continue
+        if is_meta(packet) and len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_ENDS:
+            ends = index
+            continue
+        kind = _classify(packet, slaves)
+        deadline = None
+        if kind == FENCE:
+            segment += 1
+            if not is_entity_packet(packet) and not is_meta(packet) and \
+                    packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_S_RESET_CLOCK:
+                address = u16(packet, PKT_ADDRESS_OFFSET)
+                for i, slave in enumerate(slaves):
+                    if address & slave.slave_address_bitmap:
+                        slave_origin[i] = tick
+        elif kind == QUEUED:
+            address = u16(packet, PKT_ADDRESS_OFFSET)
+            effective_time = u16(packet, PKT_EFFECTIVE_TIME_OFFSET)
+            deadline = min((slave_origin[i] + effective_time + 1 - slack) * TICK_LENGTH
+                           for i, slave in enumerate(slaves) if address & slave.entity_address_bitmap)
+        if floor is None:
+            floor = {0: tick * TICK_LENGTH}
+        items.append([segment, tick * TICK_LENGTH, index, kind, tick, deadline, tuple(slave_origin)])
+        if kind == FENCE:
+            segment += 1
+            floor[segment] = tick * TICK_LENGTH
+
+    # The fixed packets and fences hold the bus when the author sent them.
+    reserved = []
+    line_free = 0.0
+    for item in items:
+        if item[3] != QUEUED:
+            start = max(item[1], line_free)
+            line_free = start + len(slip_encode(packets[item[2]])) * byte_ms
+            if is_meta(packets[item[2]]):
+                continue
+            item[1] = start
+            reserved.append((start, line_free))
+    starts = [start for start, end in reserved]
+
+    # Queued packets go as late as they can, last due first, fitting around the rest and
+    # going out before the fence (or the end of the program) after them.
+    fence = {}
+    limit = end_tick * TICK_LENGTH
+    for item in reversed(items):
+        if item[3] == FENCE:
+            limit = item[4] * TICK_LENGTH
+        fence[item[0]] = limit
+    queued = sorted((item for item in items if item[3] == QUEUED), key=lambda item: (item[0], item[5], item[2]))
+    limit = None
+    for n in range(len(queued) - 1, -1, -1):
+        item = queued[n]
+        if limit is None or queued[n+1][0] != item[0]:
+            limit = fence[item[0]]
+        width = len(slip_encode(packets[item[2]])) * byte_ms
+        start = _latest_start(min(item[5], limit), width, reserved, starts)
+        start = max(start, floor[item[0]])
+        item[1] = start
+        item[4] = int(start // TICK_LENGTH)
+        limit = start
+
+    # Write the stream back out in send order, with a META_WAIT wherever time moves on.
+    items.sort(key=lambda item: (item[0], item[1], item[5] or 0, item[2]))
+    for i in range(len(items) - 2, -1, -1):
+        if items[i][3] == QUEUED:       # never hold up a fixed packet behind it
+            items[i][4] = min(items[i][4], items[i+1][4])
+    _check_queues(items, packets, slaves, byte_ms)
+
+    out = []
+    origin = 0
+    waitfor = 0
+    for segment, start, index, kind, tick, deadline, origins in items:
+        if tick - origin > waitfor:
+            waitfor = tick - origin
+            out.append(bytes([CMD_META, META_WAIT, waitfor & 0xFF, waitfor >> 8]))
+        out.append(packets[index])
+        if is_meta(packets[index]) and kind == FENCE:
+            origin = tick
+            waitfor = 0
+    if ends is not None:
+        waitfor = max(waitfor, u16(packets[ends] + bytes(4), PKT_META_DATA_OFFSET))
+    if end_tick - origin > waitfor:       # the program still runs as long as it did
+        out.append(bytes([CMD_META, META_WAIT, (end_tick - origin) & 0xFF, (end_tick - origin) >> 8]))
+    if ends is not None:
+        out += packets[ends:]
+    return out
+
+
+def _check_queues(items, packets, slaves, byte_ms):
+    """Follow every slave's deferred_queue through the scheduled items, in send order,
+    and raise ScheduleError at the first packet that finds a full one.
+    """
+    busy = [[] for slave in slaves]         # heap of release ticks per slave
+    for segment, start, index, kind, tick, deadline, origins in items:
+        packet = packets[index]
+        if is_meta(packet) or len(packet) < PKT_S_DATA_OFFSET:
+            continue
+        address = u16(packet, PKT_ADDRESS_OFFSET)
+        if not is_entity_packet(packet):
+            if packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_S_RESET_CLOCK:
+                for i, slave in enumerate(slaves):
+                    if address & slave.slave_address_bitmap:
+                        del busy[i][:]
+            continue
+        if len(packet) < PKT_E_DATA_OFFSET:
+            continue
+        repeat_count = packet[PKT_REPEAT_COUNT_OFFSET]
+        effective_time = u16(packet, PKT_EFFECTIVE_TIME_OFFSET)
+        if repeat_count == 0 or (repeat_count == 1 and effective_time == 0):
+            continue
+        interval = u16(packet, PKT_REPEAT_INTERVAL_OFFSET)
+        arrival = int((max(start, tick * TICK_LENGTH) + len(slip_encode(packet)) * byte_ms) // TICK_LENGTH)
+        for i, slave in enumerate(slaves):
+            if not address & slave.entity_address_bitmap:
+                continue
+            while busy[i] and busy[i][0] < arrival:
+                heapq.heappop(busy[i])
+            if len(busy[i]) >= QUEUE_MAX:
+                raise ScheduleError('slave %d\'s queue is full when packet %d (%s, start %d) arrives at tick %d, '
+                                    'and it can\'t be sent late enough to find a slot at tick %d' % (
+                                        slave.address, index, command_name(packet), effective_time,
+                                        arrival - origins[i], busy[i][0] + 1 - origins[i]))
+            now = (arrival - origins[i]) & 0xFFFF
+            heapq.heappush(busy[i], arrival + lpqueue.last_execution(now, effective_time, repeat_count, interval) - now)
+
+
+def _assess(packets, name, baud):
+    """Queue drops, peak occupancy, late packets and META_WAIT count for a packet stream.
+    """
+    programs = [(name, b''.join(slip_encode(packet) for packet in packets))]
+    queues = lpqueue.check(programs)
+    bus = lpbus.BusModel(baud)
+    bus.play(programs)
+    waits = sum(1 for p in packets if is_meta(p) and len(p) > 1 and p[PKT_META_CMD_OFFSET] == META_WAIT)
+    return (sum(len(st.dropped) for st in queues.stats), max([max(st.peak) for st in queues.stats] or [0]),
+            sum(1 for t in bus.timings if t.late), waits)
+
+
+def schedule_and_check(packets, name='', baud=BAUD_RATE, slack=1, verbose=True):
+    """Schedule a packet stream and report how it compares with the original.
+    """
+    stream = schedule(packets, baud, slack)
+    if verbose:
+        before = _assess(packets, name, baud)
+        after = _assess(stream, name, baud)
+        print('%-12s drops %4d -> %-4d peak queue %2d -> %-2d late %4d -> %-4d waits %4d -> %d' % (
+            name, before[0], after[0], before[1], after[1], before[2], after[2], before[3], after[3]))
+    return stream
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid just-in-time META_WAIT scheduler')
+    parser.add_argument('files', nargs='+', help='.PKT files to schedule')
+    parser.add_argument('--slack', type=int, default=1, metavar='TICKS',
+                        help='ticks ahead of its effective time each queued packet should arrive')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE, help='bus speed to schedule for')
+    parser.add_argument('--write', action='store_true', help='write the rescheduled packets back to the files')
+    args = parser.parse_args(argv)
+
+    status = 0
+    for path in args.files:
+        with open(path, 'rb') as f:
+            packets = list(read_packets(f.read()))
+        try:
+            stream = schedule_and_check(packets, path, args.baud, args.slack)
+        except ScheduleError as e:
+            print('%-12s %s' % (path, e))
+            status = 1
+            continue
+        if args.write:
+            with open(path, 'wb') as f:
+                for packet in stream:
+                    f.write(slip_encode(packet))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,380 @@
+#! /usr/bin/env python3
+
+# Segmentation of long Isis Pyramid 1.1 lighting programs at the 16-bit tick horizon.
+#
+# Ticks are uint16_t everywhere: the master's current_tick and META_WAIT, and the slaves'
+# current_tick and the effective time of every entity packet. A program has 655 seconds
+# before its times wrap around, and isis_master.ino leaves it to the designer to see that
+# they never do.
+#
+# lpcompile lets wait_for_tick(), ends_at_tick() and the start_tick of entity packets go
+# past 65535 and hands such programs to this pass, which splits them into segments that
+# each fit in 16 bits. A split goes in at some tick W, between a packet the master sends
+# no later than W and one it sends no earlier (with a META_WAIT for W if need be), and is
+#   - CMD_S_RESET_CLOCK to all slaves, which restarts their clocks and empties their
+#     deferred queues, and META_RESET_TIME, which restarts the master's;
+#   - the repeating packets still in flight, sent again with what's left of them: the
+#     executions still to come, the time of the next one counted from W, and for RAINBOW
+#     the start it will have got to;
+# after which every tick is counted from W. Splits go in as late as they can, at a tick
+# where none of the carried packets falls due while the split is on the bus, so that on
+# the pyramid nothing runs twice or not at all. When no such tick turns up (a packet
+# repeating every tick, say) the split goes in where it must; lpsim, whose bus takes no
+# time, still plays it exactly.
+#
+# A packet sent more than a segment ahead of its start tick can't be fitted into the
+# segment it's sent in, so the master is made to hold on to it: it moves later in the
+# stream, behind a META_WAIT if need be, to be sent exactly one segment ahead.
+#
+# RESET_CLOCK to all slaves and RESET_TIME in the program itself are fences: nothing in
+# flight crosses them, and after RESET_TIME time starts again. The dynamics settings
+# survive a split, but BLINK and THROB take their phase from the slaves' clocks, which
+# restart. Packets that the slaves' queues would have dropped are carried as if they
+# weren't.
+#
+# The pass can also split existing PKT files at a shorter --limit and play the result in
+# lpsim against the original, which is how it's checked.
+#
+# Usage: lpsegment [--limit TICKS] [--baud BAUD] [--write] file.PKT ...
+
+import argparse
+import bisect
+import sys
+
+from isis_packets import *
+import lpbus
+
+TICK_LIMIT = 0xFFFF         # last tick a segment can use
+SEARCH = 1000               # how many ticks to look back for a split that's safe on the bus
+
+RESET_CLOCK_ALL = bytes([CMD_S_RESET_CLOCK, 0xFF, 0xFF])
+RESET_TIME = bytes([CMD_META, META_RESET_TIME])
+
+
+def _with_tick(packet, offset, tick):
+    packet = bytearray(packet)
+    packet[offset] = tick & 0xFF
+    packet[offset+1] = (tick >> 8) & 0xFF
+    return bytes(packet)
+
+
+class _Repeat(object):
+    """The executions of a deferred entity packet: count of them, the first at tick first
+    and then every interval ticks (every tick for an interval of 0).
+    """
+    def __init__(self, packet, first, count, interval):
+        self.packet = packet
+        self.first = first
+        self.count = count
+        self.step = interval or 1
+        self.last = first + (count - 1) * self.step
+
+    def done_before(self, tick):
+        """How many of the executions come before tick.
+        """
+        if tick <= self.first:
+            return 0
+        return min(self.count, -(-(tick - self.first) // self.step))
+
+    def due_between(self, first, last):
+        """True if one of the executions falls in ticks first to last.
+        """
+        done = self.done_before(first)
+        return done < self.count and self.first + done * self.step <= last
+
+    def carried(self, tick):
+        """The packet that carries on with the executions from tick on, if there are any.
+        """
+        done = self.done_before(tick)
+        if done == self.count:
+            return None
+        packet = bytearray(_with_tick(self.packet, PKT_EFFECTIVE_TIME_OFFSET,
+                                      self.first + done * self.step - tick))
+        packet[PKT_REPEAT_COUNT_OFFSET] = self.count - done
+        if packet[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_E_RAINBOW:     # the wrapup moves start
+            data = PKT_E_DATA_OFFSET
+            turn = -done * packet[data+1] if packet[data+2] else done * packet[data+1]
+            packet[data] = (packet[data] + turn) & 0xFF
+        return bytes(packet)
+
+
+class _Program(object):
+    """What the master does with a packet stream, in the stream's own time: when it sends
+    each packet, the tick each one names, and which packets are in flight.
+    """
+    def __init__(self, packets, ticks):
+        self.packets = [bytes(packet) for packet in packets]
+        self.ticks = ticks
+        self.sent = []              # tick the master sends each packet, since the last RESET_TIME
+        self.value = []             # tick named by each WAIT, ENDS or deferred entity packet
+        self.repeat = []            # the _Repeat each deferred entity packet starts
+        self.fence = []             # True for RESET_TIME and RESET_CLOCK to all slaves
+        now = 0
+        for index, packet in enumerate(self.packets):
+            value = repeat = None
+            fence = False
+            if is_meta(packet) and len(packet) > PKT_META_CMD_OFFSET:
+                command = packet[PKT_META_CMD_OFFSET]
+                if command in (META_WAIT, META_ENDS) and len(packet) >= PKT_META_DATA_OFFSET + 2:
+                    value = ticks.get(index, u16(packet, PKT_META_DATA_OFFSET))
+                elif command == META_RESET_TIME:
+                    fence = True
+            elif is_entity_packet(packet):
+                if len(packet) >= PKT_E_DATA_OFFSET:
+                    start = ticks.get(index, u16(packet, PKT_EFFECTIVE_TIME_OFFSET))
+                    count = packet[PKT_REPEAT_COUNT_OFFSET]
+                    if start:
+                        value = start
+                    if count and not (count == 1 and start == 0):
+                        repeat = _Repeat(packet, max(start, now), count,
+                                         u16(packet, PKT_REPEAT_INTERVAL_OFFSET))
+            elif (len(packet) >= PKT_S_DATA_OFFSET and packet[PKT_COMMAND_OFFSET] == CMD_S_RESET_CLOCK
+                  and u16(packet, PKT_ADDRESS_OFFSET) == PKT_ADDRESS_ALL_CALL):
+                fence = True
+            self.sent.append(now)
+            self.value.append(value)
+            self.repeat.append(repeat)
+            self.fence.append(fence)
+            if fence and is_meta(packet):
+                now = 0
+            elif value is not None and is_meta(packet):
+                now = max(now, value)
+                if packet[PKT_META_CMD_OFFSET] == META_ENDS:
+                    break           # ready_next_file() abandons the rest of the file
+        self.length = len(self.sent)
+
+    def latest(self, index):
+        """Latest tick a split before packets[index] can go in.
+        """
+        if self.value[index] is not None and is_meta(self.packets[index]):
+            return max(self.sent[index], self.value[index])
+        return self.sent[index]
+
+    def in_flight(self, first, index, tick=0):
+        """The _Repeats sent from packets[first] up to packets[index] that are still going
+        at tick.
+        """
+        return [r for r in self.repeat[first:index] if r is not None and r.last >= tick]
+
+    def exact(self, index, tick):
+        """False if a packet sent at tick, from packets[index] on, is to run at just that
+        tick without repeating. After a split there it would have to run at once, a tick
+        early.
+        """
+        for i in range(index, self.length):
+            if self.sent[i] > tick or self.latest(i) > tick:
+                return True
+            repeat = self.repeat[i]
+            if repeat is None and self.value[i] == tick and not is_meta(self.packets[i]):
+                return False
+        return True
+
+
+def defer(program, limit=TICK_LIMIT):
+    """Hold back the deferred entity packets that a _Program sends more than limit ticks
+    before their start, so that each goes out limit ticks before it, after a META_WAIT
+    if nothing else is sent then. Returns the new packet stream, the ticks map for it (as
+    segment() takes) and the number of packets held back. A packet isn't held back past a
+    fence; plan() will find it can't be fitted in.
+    """
+    held = []                   # (send tick, original index) of the packets held back
+    for index in range(program.length):
+        value = program.value[index]
+        packet = program.packets[index]
+        if not is_meta(packet) and is_entity_packet(packet) and value is not None and value - program.sent[index] > limit:
+            held.append((value - limit, index))
+    if not held:
+        return program.packets, program.ticks, 0
+
+    held_back = dict((index, tick) for tick, index in held)
+    waiting = []                # held packets passed in the stream and not yet sent
+    out = []
+    ticks = {}
+
+    def emit(index):
+        if index in program.ticks:
+            ticks[len(out)] = program.ticks[index]
+        out.append(program.packets[index])
+
+    def release(now, until, wait):
+        """Send the held packets due by until, waiting for each from now on if wait."""
+        while waiting and waiting[0][0] <= until:
+            tick, index = waiting.pop(0)
+            if wait and tick > now:
+                ticks[len(out)] = tick
+                out.append(bytes([CMD_META, META_WAIT, tick & 0xFF, (tick >> 8) & 0xFF]))
+                now = tick
+            emit(index)
+
+    for index, packet in enumerate(program.packets):
+        if index >= program.length:
+            release(None, float('inf'), False)
+        elif program.fence[index]:
+            release(None, float('inf'), False)
+        else:
+            release(program.sent[index], program.sent[index], False)
+            if is_meta(packet) and program.value[index] is not None:
+                release(program.sent[index], program.value[index], True)
+        if index in held_back:
+            bisect.insort(waiting, (held_back[index], index))
+        else:
+            emit(index)
+    now = program.sent[-1] if program.sent else 0
+    if program.length and program.value[-1] is not None and is_meta(program.packets[program.length-1]):
+        now = max(now, program.value[program.length-1])
+    release(now, float('inf'), True)
+    return out, ticks, len(held)
+
+
+def plan(program, limit=TICK_LIMIT, baud=BAUD_RATE):
+    """Where to split a _Program: a list of (index, tick, safe), each split to go in before
+    packets[index] at that tick of the stream's own time, safe if nothing falls due while
+    it's on the bus. Raises ValueError if a packet can't be got into any segment.
+    """
+    byte_ms = 1000.0 * lpbus.BITS_PER_BYTE / baud
+    splits = []
+    origin = 0                  # where the current segment starts
+    first = 0                   # first packet since the last fence
+    floor = 0                   # first packet the next split can go before
+
+    def safe(index, tick, repeats):
+        carried = [p for p in (r.carried(tick) for r in repeats) if p]
+        wire = len(slip_encode(RESET_CLOCK_ALL)) + sum(len(slip_encode(p)) for p in carried)
+        guard = int(wire * byte_ms) // TICK_LENGTH + 1
+        return not any(r.due_between(tick, tick + guard) for r in repeats) and program.exact(index, tick)
+
+    def split(index):
+        latest = None
+        for position in range(index, floor - 1, -1):
+            top = min(program.latest(position), origin + limit)
+            bottom = max(program.sent[position], origin + 1)
+            if top <= origin or latest is not None and top < latest[1] - SEARCH:
+                break
+            if top < bottom:
+                continue
+            if latest is None:
+                latest = (position, top)
+            repeats = program.in_flight(first, position, latest[1] - SEARCH)
+            for tick in range(top, max(bottom, latest[1] - SEARCH) - 1, -1):
+                if safe(position, tick, repeats):
+                    return position, tick, True
+        if latest is None:
+            raise ValueError('packet %d wants tick %d, more than %d ticks after it\'s sent at %d' % (
+                index, program.value[index], limit, program.sent[index]))
+        return latest + (False,)
+
+    for index in range(program.length):
+        if program.fence[index]:
+            if is_meta(program.packets[index]):
+                origin = 0
+            first = floor = index + 1
+            continue
+        value = program.value[index]
+        while value is not None and value - origin > limit:
+            split_at = split(index)
+            splits.append(split_at)
+            floor, origin = split_at[:2]
+    return splits
+
+
+def apply(program, splits):
+    """The packet stream with the splits put in and the ticks after each one counted from
+    it, and how many packets were carried across them.
+    """
+    out = []
+    splits = list(splits)
+    carried = 0
+    origin = 0
+    first = 0
+    for index, packet in enumerate(program.packets):
+        if index >= program.length:
+            out.append(packet)      # after META_ENDS, never sent
+            continue
+        while splits and splits[0][0] == index:
+            tick = splits.pop(0)[1]
+            if tick > program.sent[index]:
+                out.append(bytes([CMD_META, META_WAIT, (tick - origin) & 0xFF, (tick - origin) >> 8]))
+            out.append(RESET_CLOCK_ALL)
+            out.append(RESET_TIME)
+            for packet_in_flight in (r.carried(tick) for r in program.in_flight(first, index, tick)):
+                if packet_in_flight:
+                    out.append(packet_in_flight)
+                    carried += 1
+            origin = tick
+        value = program.value[index]
+        if program.fence[index]:
+            if is_meta(packet):
+                origin = 0
+            first = index + 1
+        elif value is not None and is_meta(packet):
+            packet = _with_tick(packet, PKT_META_DATA_OFFSET, max(0, value - origin))
+        elif value is not None:
+            # a start the segment has already passed is late anyway, and runs at once
+            once = packet[PKT_REPEAT_COUNT_OFFSET] == 1
+            packet = _with_tick(packet, PKT_EFFECTIVE_TIME_OFFSET, max(value - origin, 1 if once else 0))
+        out.append(packet)
+    return out, carried
+
+
+def segment(packets, ticks=None, limit=TICK_LIMIT, baud=BAUD_RATE):
+    """Split a packet stream into segments of at most limit ticks. ticks maps the index of
+    each packet whose tick field doesn't fit in 16 bits to the tick it should have.
+    Returns the new stream, the splits as plan() gives them, the number of packets
+    carried across them and the number held back by defer().
+    """
+    program = _Program(packets, ticks or {})
+    packets, ticks, held = defer(program, limit)
+    if held:
+        program = _Program(packets, ticks)
+    splits = plan(program, limit, baud)
+    stream, carried = apply(program, splits)
+    return stream, splits, carried, held
+
+
+def segment_and_check(packets, name='', ticks=None, limit=TICK_LIMIT, baud=BAUD_RATE, verbose=True):
+    """Segment a packet stream and report the splits.
+    """
+    stream, splits, carried, held = segment(packets, ticks, limit, baud)
+    if verbose and splits:
+        unsafe = sum(1 for split in splits if not split[2])
+        print('%-12s %d segments, split at %s; %d packets carried%s%s' % (
+            name, len(splits) + 1, ', '.join(str(split[1]) for split in splits), carried,
+            ', %d held back' % held if held else '',
+            ', %d splits unsafe on the bus' % unsafe if unsafe else ''))
+    return stream
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid lighting program segmenter')
+    parser.add_argument('files', nargs='+', help='.PKT files to segment')
+    parser.add_argument('--limit', type=int, default=TICK_LIMIT, metavar='TICKS',
+                        help='longest segment, for trying the splits out on short programs')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE, help='bus speed to make the splits safe for')
+    parser.add_argument('--write', action='store_true', help='write the segmented packets back to the files')
+    args = parser.parse_args(argv)
+
+    import lpoptimize
+    status = 0
+    for path in args.files:
+        with open(path, 'rb') as f:
+            packets = list(read_packets(f.read()))
+        try:
+            stream = segment_and_check(packets, path, limit=args.limit, baud=args.baud)
+        except ValueError as e:
+            print('%-12s %s' % (path, e))
+            status = 1
+            continue
+        if stream != packets:
+            before = lpoptimize.replay(packets)[:2]
+            if lpoptimize.replay(stream)[:2] != before:
+                print('%-12s plays differently in lpsim' % path)
+                status = 1
+        if args.write:
+            with open(path, 'wb') as f:
+                for packet in stream:
+                    f.write(slip_encode(packet))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,260 @@
+#! /usr/bin/env python3
+
+# Single-file show container for the Isis Pyramid 1.1.
+#
+# The master finds its next lighting program the slow way. file_get_filename() opens
+# PLAYLIST.TXT and reads it a byte at a time from the top until it has counted off the
+# lines before the one it wants, and then ready_next_file() opens that PKT file, so the
+# Nth program change of a pass through the show reads N lines of playlist and the whole
+# pass reads it O(n^2) times over, with two SD.open()s per change on top. Changes that
+# come at a META_ENDS mostly get away with it, as the master does this while it waits
+# for the end tick, but a program that just runs out, and every red, black or yellow
+# button press, leaves the pyramid waiting.
+#
+# This packs the programs of a playlist into one file, SHOW.SHW, with an index at the
+# front:
+#   - a 32-byte header: the magic ISISSHOW, the format version, the number of programs
+#     (entries), the size of an entry, the length of the whole show in ticks, and the
+#     offset of the first program;
+#   - one 32-byte entry per play, in playlist order: the 8.3 name, NUL padded to 12
+#     bytes, then the offset and length of the PKT file's bytes, its running time in
+#     ticks, the bytes it puts on the bus, its packet count and its ends_at_tick() value
+#     (all little-endian, uint32 but for the last two, uint16);
+#   - the PKT files themselves, each starting on a 512-byte SD block, and each kept once
+#     however many times the playlist names it.
+# Entry N is at 32 + 32 * N, so any program change, button jumps included, is one read
+# of the index and one seek, whatever N is, and the show stays open throughout.
+#
+# Given a playlist, lpshow builds the show file and reports the gap each program change
+# leaves today against the gap with the show file, from rough costs for the SD library
+# on a 16 MHz AVR (see below). Given a show file, it lists it. lpsim and lpmaster play
+# show files as they do playlists; Show here is the reader they use.
+#
+# Usage: lpshow [-o SHOW.SHW] PLAYLIST.TXT
+#        lpshow SHOW.SHW
+
+import argparse
+import os
+import struct
+import sys
+
+from isis_packets import *
+
+MAGIC = b'ISISSHOW'
+VERSION = 1
+HEADER = struct.Struct('<8sHHHHII8x')   # magic, version, entries, entry size, 0, show ticks, data offset
+ENTRY = struct.Struct('<12sIIIIHH')     # name, offset, length, ticks, wire bytes, packets, ends_at_tick
+BLOCK = 512                             # SD card block; every program starts on one
+SHOW = 'SHOW.SHW'
+NAME_MAX = 12                           # 8.3
+
+# What the SD library costs on the master, roughly: opening a file (a walk of the
+# directory), reading a block over SPI, each single-byte File.read(), and a seek in an
+# open file (a walk of the FAT, from the start of the file, per cluster).
+OPEN_MS = 8.0
+BLOCK_MS = 1.3
+BYTE_MS = 0.006
+SEEK_MS = 0.1
+CLUSTER_MS = 0.02
+CLUSTER = 32768
+
+
+class ShowEntry(object):
+    """One program in a show file's index.
+    """
+    def __init__(self, name, offset, length, ticks, wire_bytes, packets, ends):
+        self.name = name
+        self.offset = offset            # where its PKT bytes start in the show file
+        self.length = length            # how many there are
+        self.ticks = ticks              # its running time
+        self.wire_bytes = wire_bytes    # bytes it puts on the bus, SLIP framed
+        self.packets = packets
+        self.ends = ends                # its ends_at_tick() value, 0 if none
+
+    def pack(self):
+        return ENTRY.pack(self.name.encode('ascii'), self.offset, self.length, self.ticks,
+                          self.wire_bytes, self.packets, self.ends)
+
+    @classmethod
+    def unpack(cls, data):
+        fields = ENTRY.unpack(data)
+        return cls(fields[0].rstrip(b'\0').decode('ascii'), *fields[1:])
+
+
+class Show(object):
+    """A show file opened for reading. entries is the index; read() fetches a program.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        magic, version, count, size, _, self.ticks, self.data_offset = HEADER.unpack(
+            self.file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != ENTRY.size:
+            self.file.close()
+            raise ValueError('%s: not a version %d show file' % (path, VERSION))
+        index = self.file.read(count * ENTRY.size)
+        self.entries = [ShowEntry.unpack(index[i:i+ENTRY.size]) for i in range(0, len(index), ENTRY.size)]
+
+    @property
+    def names(self):
+        return [entry.name for entry in self.entries]
+
+    def entry(self, index):
+        """The index'th entry, read from the file the way the master would: one seek.
+        """
+        self.file.seek(HEADER.size + index * ENTRY.size)
+        return ShowEntry.unpack(self.file.read(ENTRY.size))
+
+    def read(self, index):
+        """The PKT file bytes of the index'th program, by way of its entry in the file.
+        """
+        entry = self.entry(index)
+        self.file.seek(entry.offset)
+        return self.file.read(entry.length)
+
+    def programs(self):
+        """The show as (name, contents) pairs, in order, for lpsim.
+        """
+        return [(entry.name, self.read(index)) for index, entry in enumerate(self.entries)]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+
+def program_entry(name, data):
+    """A ShowEntry for a PKT file, with everything but its offset filled in.
+    """
+    if len(name) > NAME_MAX:
+        raise ValueError('%s: longer than an 8.3 name' % name)
+    packets = list(read_packets(data))
+    ends = 0
+    for packet in packets:
+        if is_meta(packet) and len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_ENDS:
+            ends = u16(packet + bytes(4), PKT_META_DATA_OFFSET)
+            break
+    from lpsim import playout
+    ticks = 0
+    for tick, _, index, packet in playout([(name, data)]):
+        ticks = tick
+    wire = sum(len(slip_encode(packet)) for packet in packets if not is_meta(packet))
+    return ShowEntry(name, 0, len(data), ticks, wire, len(packets), ends)
+
+
+def _align(offset):
+    return -(-offset // BLOCK) * BLOCK
+
+
+def build(programs, path):
+    """Write a show file of a sequence of (name, contents) programs. Returns its entries.
+    """
+    entries = []
+    stored = {}                     # (name, contents) -> offset, for programs played again
+    offset = _align(HEADER.size + len(programs) * ENTRY.size)
+    blobs = []
+    for name, data in programs:
+        entry = program_entry(name, data)
+        if (name, data) not in stored:
+            stored[(name, data)] = offset
+            blobs.append((offset, data))
+            offset = _align(offset + len(data))
+        entry.offset = stored[(name, data)]
+        entries.append(entry)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), ENTRY.size, 0,
+                            sum(entry.ticks for entry in entries),
+                            blobs[0][0] if blobs else f.tell()))
+        for entry in entries:
+            f.write(entry.pack())
+        for start, data in blobs:
+            f.write(bytes(start - f.tell()))
+            f.write(data)
+    return entries
+
+
+def _read_ms(count):
+    """Reading count bytes one File.read() at a time, from the start of a file.
+    """
+    return -(-count // BLOCK) * BLOCK_MS + count * BYTE_MS
+
+
+def scan_gap(playlist_text, index):
+    """Milliseconds file_get_filename(index) and the SD.open() after it keep the master
+    busy, with PLAYLIST.TXT as given. An index past the end reads the whole playlist and
+    then starts again from the top, as the firmware does.
+    """
+    data = playlist_text.encode('ascii')
+    count = 0
+    seen = 0
+    for line in data.split(b'\n')[:-1]:      # a name counts only once its line ends
+        count += len(line) + 1
+        if line.split():
+            if seen == index:
+                return OPEN_MS + _read_ms(count) + OPEN_MS
+            seen += 1
+    if seen == 0:
+        raise ValueError('the playlist has no complete lines')
+    return OPEN_MS + _read_ms(len(data)) + scan_gap(playlist_text, 0)
+
+
+def seek_gap(entry):
+    """Milliseconds to move to a program in an open show file: read its index entry
+    (from the first blocks of the file) and seek to its first byte.
+    """
+    return SEEK_MS + BLOCK_MS + SEEK_MS + (entry.offset // CLUSTER) * CLUSTER_MS + BLOCK_MS
+
+
+def report(playlist_text, entries, log=print):
+    """Print the gap of each program change, today and with the show file.
+    """
+    before = [scan_gap(playlist_text, index) for index in range(len(entries))]
+    after = [seek_gap(entry) for entry in entries]
+    log('%-4s %-12s %8s %8s %10s' % ('#', 'program', 'ticks', 'today', 'show file'))
+    for index, entry in enumerate(entries):
+        log('%-4d %-12s %8d %6.1fms %8.1fms' % (index, entry.name, entry.ticks, before[index], after[index]))
+    n = len(entries)
+    wrap = scan_gap(playlist_text, n)
+    log('a pass through the show: %.1f ms of program changes today (%.1f worst, %.1f to go back to the top)'
+        % (sum(before[1:]) + wrap, max(before), wrap))
+    log('                         %.1f ms with the show file (%.1f worst)' % (sum(after), max(after)))
+    if playlist_text and not playlist_text.endswith('\n'):
+        log('the last line of the playlist has no newline, so the firmware never plays %s'
+            % playlist_text.rsplit('\n', 1)[-1].strip())
+    return before, after
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid single-file show builder')
+    parser.add_argument('file', help='PLAYLIST.TXT to pack, or a show file to list')
+    parser.add_argument('-o', '--output', metavar='SHOW', help='show file to write (default %s beside the playlist)'
+                        % SHOW)
+    args = parser.parse_args(argv)
+
+    if not args.file.upper().endswith('.TXT'):
+        with Show(args.file) as show:
+            print('%s: %d programs, %d ticks (%.1f s)' % (args.file, len(show.entries), show.ticks,
+                                                          show.ticks * TICK_LENGTH / 1000.0))
+            for index, entry in enumerate(show.entries):
+                print('%-4d %-12s at %8d: %6d bytes, %5d packets, %6d on the bus, %7d ticks, ends %d' % (
+                    index, entry.name, entry.offset, entry.length, entry.packets, entry.wire_bytes,
+                    entry.ticks, entry.ends))
+        return 0
+
+    from lpsim import load_programs
+    programs = load_programs([args.file])
+    output = args.output or os.path.join(os.path.dirname(args.file), SHOW)
+    entries = build(programs, output)
+    print('%s: %d programs, %d bytes, %d ticks' % (output, len(entries), os.path.getsize(output),
+                                                   sum(entry.ticks for entry in entries)))
+    with open(args.file) as f:
+        report(f.read(), entries)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,593 @@
+#! /usr/bin/env python3
+
+# Playback simulator for compiled lighting programs (.PKT files) for the Isis Pyramid 1.1.
+#
+# This plays packet files the way the hardware would, without the hardware. The master
+# side follows isis_master.ino: packets are read out of the file and sent to the slaves
+# until a META_WAIT holds things up, META_ENDS finishes the program and moves on to the
+# next one in the playlist, and META_RESET_TIME restarts the master's notion of time.
+# The slave side follows isis_slave.ino for each of the 16 slaves: packets are routed by
+# address, one-shot packets execute on arrival, everything else goes into that slave's
+# QUEUE_MAX-slot deferred_queue (or is dropped if the queue is full), and every tick the
+# queue is scanned just like scan_deferred_queue() does it.
+#
+# Each slave keeps its own copy of the RGBD buffer for each entity it handles, exactly as
+# on the pyramid, so a packet dropped by one slave's full queue shows up as a mismatch
+# between the two halves of an entity. All the copies live in one NumPy array, and the
+# pixel operations are done with array slicing rather than pixel by pixel.
+#
+# Nothing changes between packet executions, so the simulator jumps straight from one
+# event to the next and reports frames as spans of identical ticks. That's what lets a
+# ten-minute program run in a small fraction of a second.
+#
+# The bus is treated as infinitely fast here: packets arrive at the slaves in the same
+# tick the master reads them. Dynamics (BLINK, THROB, SPARKLE) are recorded but not
+# applied to the frames, except in the frames --dynamics saves (see lpdynamics.py).
+#
+# Usage: lpsim [--seed N] [--save frames.npy [--dynamics] [--strands]] PLAYLIST.TXT | SHOW.SHW | file.PKT ...
+
+import argparse
+import functools
+import os
+import sys
+import time
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+from lpcolor import WHEEL   # the firmware's Wheel(), as a 256x3 lookup table
+
+MAX_PIXELS = 96             # longest entity buffer (the bottom edges)
+
+
+@functools.lru_cache(maxsize=4096)
+def rainbow(start, incr, count):
+    """The pixels CMD_E_RAINBOW paints. The same few rainbows get painted on every
+    diagonal, tick after tick, so it pays to remember them.
+    """
+    return WHEEL[(start + incr * np.arange(count)) & 0xFF]
+
+
+class SlaveState(object):
+    """The run-time state of one slave: its clock, deferred queue and dynamics settings.
+    """
+    def __init__(self, config, copies):
+        self.config = config
+        self.address = config.address
+        self.copies = copies            # entity address -> row in Simulator.buffers
+        self.entity_buffers = []        # (address bit, buffer view, pixel count) per entity
+        self.origin = 0                 # absolute tick at which this slave's current_tick was 0
+        self.queue = [bytearray(PACKET_MAX) for i in range(QUEUE_MAX)]
+        self.next_due = None            # absolute tick of the next queue entry to come due
+
+        # dynamics parameters, with the firmware's power-up defaults
+        self.blink_period = 100
+        self.blink_ontime = 50
+        self.blink_dimming = 255
+        self.throb_period = 100
+        self.throb_ramptime = 10
+        self.throb_bright = 10
+        self.throb_dim = 10
+        self.sparkle_probability = 0
+
+    def current_tick(self, tick):
+        return (tick - self.origin) & 0xFFFF
+
+    def occupancy(self):
+        return sum(1 for slot in self.queue if slot[PKT_REPEAT_COUNT_OFFSET] != 0)
+
+    def update_next_due(self, tick):
+        """Work out when scan_deferred_queue() will next find something to execute.
+        """
+        now = self.current_tick(tick)
+        due = None
+        for slot in self.queue:
+            if slot[PKT_REPEAT_COUNT_OFFSET] != 0:
+                effective_time = u16(slot, PKT_EFFECTIVE_TIME_OFFSET)
+                when = tick if effective_time <= now else tick + (effective_time - now)
+                if due is None or when < due:
+                    due = when
+        self.next_due = due
+
+
+class ProgramStats(object):
+    """What happened while one lighting program played.
+    """
+    def __init__(self, name, start_tick):
+        self.name = name
+        self.start_tick = start_tick
+        self.end_tick = start_tick
+        self.packets = 0                # packets sent to the slaves
+        self.meta = 0                   # META packets handled by the master
+        self.immediate = 0              # (packet, slave) deliveries executed on arrival
+        self.deferred = 0               # (packet, slave) deliveries put on a queue
+        self.executions = 0             # queue entries executed by scan_deferred_queue
+        self.dropped = []               # (tick, slave address, packet) lost to a full queue
+        self.late = []                  # (tick, slave address, packet) arriving after their effective time
+        self.console = []               # (tick, value) shown on the user console
+        self.peak_queue = 0
+
+    @property
+    def ticks(self):
+        return self.end_tick - self.start_tick
+
+
+class Simulator(object):
+    """Whole-pyramid model: one master, 16 slaves, and all their entity buffers.
+    """
+    def __init__(self, slaves=None, seed=0):
+        if slaves is None:
+            slaves = isis_config.load_config()
+        self.pixel_counts = isis_config.entity_pixel_counts(slaves)
+
+        # One row of the buffers array per (slave, entity) copy, plus a final row
+        # that always stays black, for padding out the frames.
+        self.slaves = []
+        rows = 0
+        for config in slaves:
+            copies = {}
+            for addr in config.entities:
+                copies[addr] = rows
+                rows += 1
+            self.slaves.append(SlaveState(config, copies))
+        self.buffers = np.zeros((rows + 1, MAX_PIXELS, 4), dtype=np.uint8)
+        for slave in self.slaves:
+            slave.entity_buffers = [(1 << addr, self.buffers[slave.copies[addr]], slave.config.entity_pixels[addr])
+                                    for addr in slave.config.entities]
+        self.black_row = rows
+        self.gather = self._frame_gather()
+        self.strand_index = isis_config.strand_gather([slave.config for slave in self.slaves], MAX_PIXELS,
+                                                      [slave.copies for slave in self.slaves])
+
+        self.rng = np.random.default_rng(seed)
+        self.rcv_buffer = bytearray(PACKET_MAX)
+        self.tick = 0                   # absolute ticks since the simulation started
+        self.base = 0                   # tick at which play() started
+        self.stats = []
+        self.current = None
+        self._dirty = True
+        self._frame = None
+
+    def _frame_gather(self):
+        """Index array that picks each entity pixel out of the copy on the slave that
+        actually displays it. Pixels that no slave displays (the doorway) come from the
+        first copy of the entity, and padding beyond the end of an entity is black.
+        """
+        gather = np.full((isis_config.NUM_ENTITIES, MAX_PIXELS), self.black_row * MAX_PIXELS, dtype=np.intp)
+        for slave in self.slaves:
+            for seg in slave.config.segments:
+                row = slave.copies[seg.address]
+                first = seg.first_entity_index
+                pixels = np.arange(first, first + seg.pixels_in_segment)
+                gather[seg.address, pixels] = row * MAX_PIXELS + pixels
+        for entity in range(isis_config.NUM_ENTITIES):
+            for slave in self.slaves:
+                if entity in slave.copies:
+                    row = slave.copies[entity]
+                    for pixel in range(self.pixel_counts[entity]):
+                        if gather[entity, pixel] == self.black_row * MAX_PIXELS:
+                            gather[entity, pixel] = row * MAX_PIXELS + pixel
+                    break
+        return gather
+
+    def frame(self):
+        """The RGB contents of all 12 entities as they are being displayed, shape (12, 96, 3).
+        """
+        if self._dirty:
+            self._frame = self.buffers.reshape(-1, 4)[self.gather, :3]
+            self._dirty = False
+        return self._frame
+
+    def strands(self):
+        """Every slave's strand buffer as its refresh_segments() fills it, from its own
+        copies of the entity buffers: RGBD, shape (16, longest strand + 1, 4), shorter
+        strands padded with black.
+        """
+        return isis_config.gather_strands(self.buffers, self.strand_index)
+
+    # ---- slave side ----
+
+    def deliver(self, packet):
+        """A packet arrives on the bus. Every slave sees it; handle_packet() decides who cares.
+        """
+        count = len(packet)
+        self.rcv_buffer[:count] = packet
+        buf = self.rcv_buffer           # short packets pick up stale bytes, as in the firmware
+        address = u16(buf, PKT_ADDRESS_OFFSET)
+        entity_addressed = buf[PKT_COMMAND_OFFSET] & ENTITY_ADDRESSED
+        for slave in self.slaves:
+            if not entity_addressed and (address & slave.config.slave_address_bitmap):
+                self._handle_slave_packet(slave, buf)
+            if entity_addressed and (address & slave.config.entity_address_bitmap):
+                self._handle_entity_packet(slave, buf, packet)
+
+    def _handle_slave_packet(self, slave, buf):
+        command = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        p = PKT_S_DATA_OFFSET
+        if command == CMD_S_RESET_CLOCK:
+            slave.origin = self.tick
+            for slot in slave.queue:
+                slot[PKT_REPEAT_COUNT_OFFSET] = 0
+            slave.next_due = None
+        elif command == CMD_S_DYN_BLINK:
+            slave.blink_period = u16(buf, p)
+            slave.blink_ontime = u16(buf, p+2)
+            slave.blink_dimming = buf[p+4]
+            if slave.blink_period < 2 or slave.blink_ontime >= slave.blink_period:
+                slave.blink_period = 100
+                slave.blink_ontime = 50
+        elif command == CMD_S_DYN_THROB:
+            slave.throb_period = u16(buf, p)
+            slave.throb_ramptime = u16(buf, p+2)
+            slave.throb_bright = buf[p+4]
+            slave.throb_dim = buf[p+5]
+            if slave.throb_period < 5 or (4*slave.throb_ramptime) & 0xFFFF >= slave.throb_period:
+                slave.throb_period = 100
+                slave.throb_ramptime = 10
+        elif command == CMD_S_DYN_SPARKLE:
+            slave.sparkle_probability = u16(buf, p)
+
+    def _handle_entity_packet(self, slave, buf, packet):
+        repeat_count = buf[PKT_REPEAT_COUNT_OFFSET]
+        effective_time = u16(buf, PKT_EFFECTIVE_TIME_OFFSET)
+        stats = self.current
+
+        if repeat_count == 1 and effective_time == 0:
+            stats.immediate += 1
+            if buf[PKT_COMMAND_OFFSET] & COMMAND_MASK == CMD_E_RAINBOW:
+                buf = bytearray(buf)        # each slave's own buffer takes the wrapup, not the next slave's
+            self._execute(slave, buf)
+            return
+
+        now = slave.current_tick(self.tick)
+        if effective_time != 0 and effective_time < now:
+            stats.late.append((self.tick, slave.address, packet))
+        for slot in slave.queue:
+            if slot[PKT_REPEAT_COUNT_OFFSET] == 0:
+                slot[:len(packet)] = packet
+                if repeat_count == 0:       # lands in an empty slot and leaves it empty
+                    return
+                stats.deferred += 1
+                slave.update_next_due(self.tick)
+                stats.peak_queue = max(stats.peak_queue, slave.occupancy())
+                return
+        stats.dropped.append((self.tick, slave.address, packet))
+
+    def _scan(self, slave):
+        """scan_deferred_queue() for one slave, at the current tick. Works out when the
+        queue will next need attention while it's at it.
+        """
+        tick = self.tick
+        now = (tick - slave.origin) & 0xFFFF
+        after = (now + 1) & 0xFFFF
+        due = None
+        for slot in slave.queue:
+            repeat_count = slot[3]                          # PKT_REPEAT_COUNT_OFFSET
+            if repeat_count != 0:
+                effective_time = slot[4] | (slot[5] << 8)   # PKT_EFFECTIVE_TIME_OFFSET
+                if effective_time <= now:
+                    self._execute(slave, slot)
+                    self.current.executions += 1
+                    repeat_count -= 1
+                    slot[3] = repeat_count
+                    if repeat_count == 0:
+                        continue
+                    interval = slot[6] | (slot[7] << 8)     # PKT_REPEAT_INTERVAL_OFFSET
+                    if effective_time == 0:
+                        effective_time = now + interval
+                    else:
+                        effective_time += interval
+                    effective_time &= 0xFFFF
+                    slot[4] = effective_time & 0xFF
+                    slot[5] = effective_time >> 8
+                when = tick + 1 if effective_time <= after else tick + 1 + (effective_time - after)
+                if due is None or when < due:
+                    due = when
+        slave.next_due = due
+
+    def _execute(self, slave, buf):
+        """execute_entity_packet(): run the packet on each of this slave's entities it
+        addresses, then do the per-packet wrapup.
+        """
+        command = buf[PKT_COMMAND_OFFSET] & COMMAND_MASK
+        address = buf[PKT_ADDRESS_OFFSET] | (buf[PKT_ADDRESS_OFFSET+1] << 8)
+        for bit, pixels, count in slave.entity_buffers:
+            if address & bit:
+                self._execute_for_entity(command, buf, pixels, count)
+
+        if command == CMD_E_RAINBOW:        # execute_packet_wrapup()
+            data = PKT_E_DATA_OFFSET
+            if buf[data+2]:
+                buf[data] = (buf[data] - buf[data+1]) & 0xFF
+            else:
+                buf[data] = (buf[data] + buf[data+1]) & 0xFF
+
+    def _execute_for_entity(self, command, buf, pixels, count):
+        """execute_packet_for_entity() on one entity buffer (a view into self.buffers).
+        """
+        data = PKT_E_DATA_OFFSET
+        if command == CMD_E_FILL_RGB:
+            pixels[:count, :3] = buf[data:data+3]
+        elif command == CMD_E_FILL_D:
+            pixels[:count, 3] = buf[data]
+        elif command in (CMD_E_SHIFT_UP, CMD_E_SHIFT_DOWN):
+            n = buf[data]
+            if n > count or n == 0:         # sanity check
+                return
+            if command == CMD_E_SHIFT_UP:
+                pixels[n:count] = pixels[:count-n].copy()
+                pixels[:n] = buf[data+1:data+5]
+            else:
+                pixels[:count-n] = pixels[n:count].copy()
+                pixels[count-n:count] = buf[data+1:data+5]
+        elif command == CMD_E_ROTATE:
+            n = buf[data]
+            if n > count or n == 0:         # sanity check
+                return
+            shift = -n if buf[data+1] else n
+            pixels[:count] = np.roll(pixels[:count], shift, axis=0)
+        elif command == CMD_E_RANDOMIZE:
+            pixels[:count, :3] = WHEEL[self.rng.integers(0, 256, size=count)]
+        elif command == CMD_E_LOADONE:
+            n = buf[data]
+            if n < count:                   # the firmware doesn't check; we won't scribble
+                pixels[n] = buf[data+1:data+5]
+        elif command == CMD_E_RAINBOW:
+            pixels[:count, :3] = rainbow(buf[data], buf[data+1], count)
+        else:
+            return
+        self._dirty = True
+
+    # ---- time ----
+
+    def run_until(self, stop):
+        """Run slave ticks up to (not including) absolute tick stop.
+        Yields (first_tick, tick_count, frame) spans; each frame is a fresh array.
+        """
+        span_start = self.tick
+        frame = self.frame()
+        while self.tick < stop:
+            due = [s.next_due for s in self.slaves if s.next_due is not None]
+            nxt = min(due) if due else stop
+            if nxt > self.tick:
+                self.tick = min(nxt, stop)
+                continue
+
+            # this tick: the strands show the buffers, then the queues are scanned
+            for slave in self.slaves:
+                if slave.next_due is not None and slave.next_due <= self.tick:
+                    self._scan(slave)
+            self.tick += 1
+            if self._dirty:
+                yield (span_start, self.tick - span_start, frame)
+                span_start = self.tick
+                frame = self.frame()
+        if self.tick > span_start:
+            yield (span_start, self.tick - span_start, frame)
+
+    # ---- master side ----
+
+    def play(self, programs, skip=0, every=None, checkpoint=None):
+        """Play a sequence of (name, file contents) lighting programs, as the master
+        would work through the playlist. Yields frame spans as run_until() does.
+
+        With every and checkpoint, the simulation stops at the start of every tick that's
+        a multiple of every (counting from the start of the playout) to call checkpoint(n),
+        n being the number of playout() events handled so far. A Simulator restore()d from
+        a snapshot() taken then carries on from there with play(programs, skip=n).
+        """
+        if skip:
+            base = self.base
+        else:
+            base = self.base = self.tick
+            self.current = ProgramStats('(setup)', self.tick)
+        if every:
+            stop = base + -(-(self.tick - base) // every) * every
+            if skip and stop == self.tick:
+                stop += every
+        for events, (tick, name, index, packet) in enumerate(playout(programs)):
+            if events < skip:
+                continue
+            while every and stop <= base + tick:
+                yield from self.run_until(stop)
+                checkpoint(events)
+                stop += every
+            yield from self.run_until(base + tick)
+            if packet is None:
+                self.current.end_tick = self.tick
+                self.current = None
+                continue
+            if self.current is None:
+                self.current = ProgramStats(name, self.tick)
+                self.stats.append(self.current)
+            if is_meta(packet):
+                self.current.meta += 1
+                if len(packet) > 1 and packet[PKT_META_CMD_OFFSET] == META_CONSOLE:
+                    self.current.console.append((self.tick, u16(packet + bytes(4), PKT_META_DATA_OFFSET)))
+            else:
+                self.current.packets += 1
+                self.deliver(packet)
+
+    # ---- saving and restoring ----
+
+    DYNAMICS = ['blink_period', 'blink_ontime', 'blink_dimming', 'throb_period', 'throb_ramptime',
+                'throb_bright', 'throb_dim', 'sparkle_probability']
+
+    def snapshot(self):
+        """Everything needed to carry on from the current tick: the entity buffers, each
+        slave's clock, deferred queue and dynamics settings, and the RANDOMIZE generator.
+        All of it but the buffers array is plain numbers, strings and bytes.
+        """
+        return {
+            'tick': self.tick,
+            'base': self.base,
+            'program': None if self.current is None else self.current.name,
+            'buffers': self.buffers.copy(),
+            'rcv_buffer': bytes(self.rcv_buffer),
+            'rng': self.rng.bit_generator.state,
+            'slaves': [dict([('origin', slave.origin), ('next_due', slave.next_due),
+                             ('queue', [bytes(slot) for slot in slave.queue])] +
+                            [(name, getattr(slave, name)) for name in self.DYNAMICS])
+                       for slave in self.slaves],
+        }
+
+    def restore(self, state):
+        """Put the simulator back the way it was when snapshot() made state.
+        """
+        self.tick = state['tick']
+        self.base = state['base']
+        self.current = None
+        if state['program'] is not None:
+            self.current = ProgramStats(state['program'], self.tick)
+            self.stats.append(self.current)
+        self.buffers[...] = state['buffers']
+        self.rcv_buffer[:] = state['rcv_buffer']
+        self.rng.bit_generator.state = state['rng']
+        for slave, saved in zip(self.slaves, state['slaves']):
+            slave.origin = saved['origin']
+            slave.next_due = saved['next_due']
+            for slot, contents in zip(slave.queue, saved['queue']):
+                slot[:] = contents
+            for name in self.DYNAMICS:
+                setattr(slave, name, saved[name])
+        self._dirty = True
+
+
+def playout(programs):
+    """The master's side of playing a sequence of (name, file contents) lighting programs,
+    following handle_file_packet() and ready_next_file(), with a bus that takes no time.
+
+    Yields (tick, name, index, packet) for each packet the master reads, META or not, where
+    tick counts from the start of the playout and index counts packets within the file.
+    The end of each program is marked by (tick, name, None, None). The very first packet
+    is the RESET_CLOCK that reset_time_origin() sends at powerup, under the name '(setup)'.
+    """
+    origin = 0                  # tick at which the master's current_tick was 0
+    waitfor_tick = 0
+    tick = 0
+
+    def wait():
+        now = (tick - origin) & 0xFFFF
+        return tick + waitfor_tick - now if waitfor_tick > now else tick
+
+    yield (tick, '(setup)', 0, bytes([CMD_S_RESET_CLOCK, 0xFF, 0xFF]))
+    yield (tick, '(setup)', None, None)
+    for name, data in programs:
+        for index, packet in enumerate(read_packets(data)):
+            tick = wait()
+            yield (tick, name, index, packet)
+            if not is_meta(packet) or len(packet) < 2:
+                continue
+            command = packet[PKT_META_CMD_OFFSET]
+            value = u16(packet + bytes(4), PKT_META_DATA_OFFSET)
+            if command == META_WAIT:
+                waitfor_tick = value
+            elif command == META_ENDS:
+                waitfor_tick = value
+                break                   # ready_next_file() abandons the rest of this file
+            elif command == META_RESET_TIME:
+                origin = tick
+                waitfor_tick = 0
+        tick = wait()
+        yield (tick, name, None, None)
+
+
+def read_playlist(path):
+    """The filenames in a PLAYLIST.TXT, read the way file_get_filename() reads them:
+    one per line, with all whitespace ignored and blank lines skipped. A last line with
+    no newline never reaches the slaves, so it is dropped with a warning.
+    """
+    names = []
+    with open(path) as f:
+        for line in f:
+            name = ''.join(line.split())
+            if name and not line.endswith('\n'):
+                print('%s: %s has no newline after it, so it is never played' % (path, name), file=sys.stderr)
+            elif name:
+                names.append(name)
+    return names
+
+
+def load_programs(args):
+    """Turn command line arguments (PKT files, playlists and/or lpshow show files) into
+    (name, contents) pairs.
+    """
+    programs = []
+    for arg in args:
+        if arg.upper().endswith('.TXT'):
+            folder = os.path.dirname(arg)
+            for name in read_playlist(arg):
+                with open(os.path.join(folder, name), 'rb') as f:
+                    programs.append((name, f.read()))
+        elif arg.upper().endswith('.SHW'):
+            import lpshow
+            with lpshow.Show(arg) as show:
+                programs += show.programs()
+        else:
+            with open(arg, 'rb') as f:
+                programs.append((os.path.basename(arg), f.read()))
+    return programs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid lighting program simulator')
+    parser.add_argument('files', nargs='+', help='.PKT files, PLAYLIST.TXT files and/or show files, played in order')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for RANDOMIZE')
+    parser.add_argument('--show', type=int, default=5, metavar='N', help='list at most N dropped packets per program')
+    parser.add_argument('--save', metavar='NPY', help='save every tick\'s frame, shape (ticks, 12, 96, 3)')
+    parser.add_argument('--dynamics', action='store_true', help='apply BLINK, THROB and SPARKLE to the saved frames')
+    parser.add_argument('--strands', action='store_true',
+                        help='save each slave\'s strand instead, shape (ticks, 16, longest strand + 1, 3)')
+    parser.add_argument('--sparkle-seed', type=int, default=1, metavar='N',
+                        help='randomSeed() for SPARKLE on slave 0, with --dynamics; slave N gets N more (default 1)')
+    args = parser.parse_args(argv)
+
+    programs = load_programs(args.files)
+    sim = Simulator(seed=args.seed)
+    renderer = None
+    if args.save and args.dynamics:
+        import lpdynamics
+        renderer = lpdynamics.Renderer(sim, args.sparkle_seed)
+    spans = []
+    changes = 0
+    started = time.time()
+    for first, count, frame in sim.play(programs):
+        changes += 1
+        if renderer:
+            spans.append((first, count, renderer.render(first, count, frame)))
+        elif args.save:
+            spans.append((first, count, frame))
+    elapsed = time.time() - started
+
+    print('%-12s %7s %8s %7s %8s %8s %5s %5s %5s' % ('program', 'ticks', 'seconds', 'packets',
+                                                 'deferred', 'executed', 'peakq', 'drops', 'late'))
+    for st in sim.stats:
+        print('%-12s %7d %8.2f %7d %8d %8d %5d %5d %5d' % (st.name, st.ticks, st.ticks * TICK_LENGTH / 1000.0,
+                                                       st.packets, st.deferred, st.executions,
+                                                       st.peak_queue, len(st.dropped), len(st.late)))
+        for tick, slave, packet in st.dropped[:args.show]:
+            print('    dropped at tick %d by slave %d: %s start %d' % (
+                tick - st.start_tick, slave, command_name(packet), u16(packet + bytes(6), PKT_EFFECTIVE_TIME_OFFSET)))
+        if len(st.dropped) > args.show:
+            print('    ... and %d more dropped' % (len(st.dropped) - args.show))
+    show_seconds = sim.tick * TICK_LENGTH / 1000.0
+    print('%d ticks (%.1f s of show) simulated in %.3f s, %d frame changes, %.0fx real time' % (
+        sim.tick, show_seconds, elapsed, changes, show_seconds / max(elapsed, 1e-9)))
+
+    if args.save:
+        if args.strands:
+            index = isis_config.strand_gather([slave.config for slave in sim.slaves], MAX_PIXELS)
+            frames = np.empty((sim.tick,) + index.shape + (3,), dtype=np.uint8)
+            for first, count, frame in spans:
+                frames[first:first+count] = isis_config.gather_strands(frame, index)
+        else:
+            frames = np.empty((sim.tick, isis_config.NUM_ENTITIES, MAX_PIXELS, 3), dtype=np.uint8)
+            for first, count, frame in spans:
+                frames[first:first+count] = frame
+        np.save(args.save, frames)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
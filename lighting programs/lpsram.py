@@ -0,0 +1,305 @@
+#! /usr/bin/env python3
+
+# SRAM planner for the Isis Pyramid 1.1 slaves.
+#
+# A slave is an ATmega328 with 2048 bytes of RAM, and it has to hold four things:
+#
+#   static   the sketch's globals (deferred_queue, rcv_buffer, the segment and entity
+#            tables and the rest), its string literals, which avr-gcc copies into RAM
+#            unless they're in PROGMEM, and what the Arduino core and libraries keep:
+#            Serial's 64-byte receive and transmit buffers, SoftwareSerial's receive
+#            buffer, millis() and malloc() bookkeeping;
+#   heap     what init_entities() and setup() calloc(): a buffer of pixels_in_entity
+#            pixels for every entity the slave has a segment of, and the strand buffer
+#            of pixels_in_strand+1 pixels, BYTES_PER_PIXEL (4) bytes a pixel, each
+#            chunk with malloc()'s two-byte size in front of it;
+#   stack    whatever the deepest calls and interrupts need, at the top of RAM. Nothing
+#            here measures it; --stack sets the allowance (256 bytes by default).
+#
+# The globals are read from isis_slave.ino itself, with the #defines it and
+# isis_packets.h give them, and sized as avr-gcc lays them out (no padding, two-byte
+# ints and pointers). The heap comes from the isis_config.ino tables (see isis_config.py).
+# What's left over is the headroom; divided by PACKET_MAX it says how much longer the
+# deferred queue could be.
+#
+# Other layouts can be tried the same way: --bytes-per-pixel 3 (dropping the D byte, or
+# packing it elsewhere), --queue, --packet-max, --no-strand-buffer (refresh_segments()
+# and update_strand() reading the entity buffers directly), and --layouts compares a set
+# of them for the worst-off slave.
+#
+# Usage: lpsram [--stack BYTES] [--bytes-per-pixel N] [--queue N] [--packet-max N]
+#               [--no-strand-buffer] [--layouts]
+
+import argparse
+import os
+import re
+import sys
+
+import isis_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SLAVE_INO = os.path.join(HERE, os.pardir, 'isis_slave', 'isis_slave.ino')
+SLAVE_HEADER = os.path.join(HERE, os.pardir, 'isis_slave', 'isis_packets.h')
+
+RAM = 2048                  # ATmega328
+STACK = 256                 # default allowance for the stack
+MALLOC_HEADER = 2           # avr-libc keeps each chunk's size in front of it
+
+# Sizes of the types the sketch uses, on the AVR.
+TYPE_SIZES = {
+    'bool': 1, 'boolean': 1, 'byte': 1, 'char': 1, 'unsigned char': 1,
+    'int8_t': 1, 'uint8_t': 1,
+    'int': 2, 'unsigned': 2, 'unsigned int': 2, 'word': 2, 'short': 2,
+    'int16_t': 2, 'uint16_t': 2,
+    'long': 4, 'unsigned long': 4, 'float': 4, 'double': 4,
+    'int32_t': 4, 'uint32_t': 4,
+}
+POINTER = 2
+
+# Library objects the sketch declares, as laid out by the Arduino 1.0 AVR core.
+OBJECT_SIZES = {
+    'SoftwareSerial': 31,
+}
+
+# What the core and libraries keep in RAM whatever the sketch does.
+CORE = [
+    ('Serial', 157, 'HardwareSerial, with its 64-byte receive and transmit buffers'),
+    ('SoftwareSerial statics', 68, 'the 64-byte receive buffer, its head and tail, the active object'),
+    ('SPI', 4, "SPIClass's transaction state"),
+    ('millis()', 9, 'timer0 overflow count, millis and fraction'),
+    ('malloc()', 10, '__brkval, the free list, heap limits and __malloc_margin'),
+]
+
+
+class SramError(Exception):
+    pass
+
+
+def _strip_comments(text):
+    return re.sub(r'//[^\n]*|/\*.*?\*/', '', text, flags=re.S)     # left to right: //*** isn't /*
+
+
+def _defines(text, defines):
+    for name, expr in re.findall(r'^\s*#define\s+(\w+)\s+(.+?)\s*$', text, flags=re.M):
+        try:
+            defines[name] = _evaluate(expr, defines)
+        except SramError:
+            pass                    # not a number (pin modes and the like): not needed here
+    return defines
+
+
+def _evaluate(expr, defines):
+    """Evaluate a C constant expression of integers, #defined names and arithmetic.
+    """
+    expr = re.sub(r'\b(0[xX][0-9a-fA-F]+|\d+)[uUlL]*\b', r'\1', expr)
+    if not re.match(r'^[\w\s+\-*/()|&<>~]*$', expr):
+        raise SramError('unexpected expression %r' % expr)
+    for name in re.findall(r'\b[A-Za-z_]\w*', expr):
+        if name not in defines and not re.match(r'^0[xX]', name):
+            raise SramError('unknown name %s in %r' % (name, expr))
+    expr = re.sub(r'\b(?!0[xX])[A-Za-z_]\w*', lambda m: '(%d)' % defines[m.group(0)], expr)
+    return int(eval(expr.replace('/', '//'), {'__builtins__': {}}, {}))
+
+
+class Global(object):
+    """One variable in RAM: its name, the size of one element, and its array dimensions
+    (as expressions, so a layout can change QUEUE_MAX or PACKET_MAX).
+    """
+    def __init__(self, name, element, dims=()):
+        self.name = name
+        self.element = element
+        self.dims = dims
+
+    def size(self, defines):
+        size = self.element
+        for dim in self.dims:
+            size *= _evaluate(dim, defines)
+        return size
+
+
+class Sketch(object):
+    """The RAM-relevant parts of isis_slave.ino: its #defines, globals and string literals.
+    """
+    def __init__(self, path=SLAVE_INO, header=SLAVE_HEADER):
+        with open(path) as f:
+            text = _strip_comments(f.read())
+        defines = {}
+        with open(header) as f:
+            _defines(_strip_comments(f.read()), defines)
+        self.defines = _defines(text, defines)
+        text = re.sub(r'^\s*#[^\n]*', '', text, flags=re.M)
+
+        self.structs = {}
+        for name, body in re.findall(r'\bstruct\s+(\w+)\s*\{(.*?)\}\s*;', text, flags=re.S):
+            self.structs[name] = sum(g.size(self.defines) for g in self._declarations(body))
+
+        # Split the file into what's at the top level and what's inside functions.
+        outside, inside = [], []
+        depth = 0
+        for c in text:
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    outside.append(';')         # ends a function or struct definition
+            elif depth == 0:
+                outside.append(c)
+            else:
+                inside.append(c)
+        self.globals = self._declarations(''.join(outside))
+        self.globals += [g for statement in re.findall(r'\bstatic\s+([^;]*);', ''.join(inside))
+                         for g in self._declarations(statement)]
+        literals = set(re.findall(r'"((?:[^"\\]|\\.)*)"', ''.join(inside)))
+        self.strings = sum(len(bytes(s, 'ascii').decode('unicode_escape')) + 1 for s in literals)
+
+    def _declarations(self, text):
+        found = []
+        for statement in text.split(';'):
+            statement = ' '.join(statement.split())
+            statement = re.sub(r'^(static|volatile|const)\s+', '', statement)
+            if not statement:
+                continue
+            obj = re.match(r'^(\w+)\s+(\w+)\s*\(.*\)$', statement)
+            if obj and obj.group(1) in OBJECT_SIZES:
+                found.append(Global(obj.group(2), OBJECT_SIZES[obj.group(1)]))
+                continue
+            if '(' in statement:
+                continue                                # a function
+            m = re.match(r'^(struct\s+\w+|unsigned\s+(?:long|int|char)|\w+)\s+(.*)$', statement)
+            if m is None or m.group(1) == 'struct':
+                continue                                # what's left of a struct definition
+            kind, declarators = m.groups()
+            if kind.startswith('struct'):
+                element = self.structs.get(kind.split()[1])
+            else:
+                element = TYPE_SIZES.get(kind)
+            for declarator in declarators.split(','):
+                d = re.match(r'^\s*(\*?)\s*(\w+)\s*((?:\[[^\]]*\])*)\s*(?:=.*)?$', declarator)
+                if d is None:
+                    continue
+                if d.group(1):
+                    found.append(Global(d.group(2), POINTER, tuple(re.findall(r'\[([^\]]*)\]', d.group(3)))))
+                elif element is None:
+                    raise SramError('no size known for %s %s' % (kind, d.group(2)))
+                else:
+                    found.append(Global(d.group(2), element, tuple(re.findall(r'\[([^\]]*)\]', d.group(3)))))
+        return found
+
+
+class Layout(object):
+    """A way of laying out a slave's RAM: the firmware as it is, or a variation on it.
+    """
+    def __init__(self, name, bytes_per_pixel=None, queue_max=None, packet_max=None, strand_buffer=True):
+        self.name = name
+        self.bytes_per_pixel = bytes_per_pixel
+        self.queue_max = queue_max
+        self.packet_max = packet_max
+        self.strand_buffer = strand_buffer
+
+    def defines(self, sketch):
+        defines = dict(sketch.defines)
+        for name, value in (('BYTES_PER_PIXEL', self.bytes_per_pixel), ('QUEUE_MAX', self.queue_max),
+                            ('PACKET_MAX', self.packet_max)):
+            if value is not None:
+                defines[name] = value
+        return defines
+
+
+LAYOUTS = [
+    Layout('as built'),
+    Layout('3-byte pixels', bytes_per_pixel=3),
+    Layout('no strand buffer', strand_buffer=False),
+    Layout('3-byte, no strand', bytes_per_pixel=3, strand_buffer=False),
+]
+
+
+class Plan(object):
+    """One slave's RAM under one layout.
+    """
+    def __init__(self, slave, sketch, layout, stack=STACK):
+        defines = layout.defines(sketch)
+        self.slave = slave
+        self.layout = layout
+        self.packet_max = defines['PACKET_MAX']
+        self.queue_max = defines['QUEUE_MAX']
+        self.bytes_per_pixel = bpp = defines['BYTES_PER_PIXEL']
+
+        self.globals = sum(g.size(defines) for g in sketch.globals)
+        self.queue = self.queue_max * self.packet_max
+        self.strings = sketch.strings
+        self.core = sum(size for name, size, doc in CORE)
+        self.static = self.globals + self.strings + self.core
+
+        self.entity_heap = sum(slave.entity_pixels[addr] * bpp + MALLOC_HEADER for addr in slave.entities)
+        self.strand_heap = (slave.pixels_in_strand + 1) * bpp + MALLOC_HEADER if layout.strand_buffer else 0
+        self.heap = self.entity_heap + self.strand_heap
+        self.stack = stack
+        self.free = RAM - self.static - self.heap - self.stack
+
+    def largest_queue(self):
+        """The largest QUEUE_MAX that still fits, or None if even an empty queue doesn't.
+        """
+        slots = self.queue_max + self.free // self.packet_max
+        return slots if slots >= 0 else None
+
+
+def plan(slaves, sketch, layout, stack=STACK):
+    return [Plan(slave, sketch, layout, stack) for slave in slaves]
+
+
+def report(plans):
+    first = plans[0]
+    print('%s: QUEUE_MAX %d x PACKET_MAX %d, %d-byte pixels%s; %d bytes of RAM, %d for the stack'
+          % (first.layout.name, first.queue_max, first.packet_max, first.bytes_per_pixel,
+             '' if first.layout.strand_buffer else ', no strand buffer', RAM, first.stack))
+    print('slave strand entities          globals queue strings core  heap: entities strand   free  QUEUE_MAX')
+    for p in plans:
+        slave = p.slave
+        entities = ' '.join('%s(%d)' % (isis_config.ENTITY_NAMES[a][2:], slave.entity_pixels[a])
+                            for a in slave.entities)
+        largest = p.largest_queue()
+        print('%5d %6d %-20s %7d %5d %7d %4d  %14d %6d %6d  %9s%s' % (
+            slave.address, slave.pixels_in_strand, entities, p.globals - p.queue, p.queue, p.strings, p.core,
+            p.entity_heap, p.strand_heap, p.free, '-' if largest is None else largest,
+            '  OUT OF RAM' if p.free < 0 else ''))
+    worst = min(plans, key=lambda p: p.free)
+    print('tightest: slave %d, %d bytes free' % (worst.slave.address, worst.free))
+
+
+def compare(slaves, sketch, layouts, stack=STACK):
+    print('%-20s %6s %6s %8s %10s  %s' % ('layout', 'static', 'heap', 'free', 'QUEUE_MAX', '(worst slave)'))
+    for layout in layouts:
+        plans = plan(slaves, sketch, layout, stack)
+        worst = min(plans, key=lambda p: p.free)
+        queues = [p.largest_queue() for p in plans]
+        largest = None if None in queues else min(queues)
+        print('%-20s %6d %6d %8d %10s  slave %d' % (layout.name, worst.static, worst.heap, worst.free,
+                                                  '-' if largest is None else largest, worst.slave.address))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid slave SRAM planner')
+    parser.add_argument('--stack', type=int, default=STACK, metavar='BYTES', help='allowance for the stack')
+    parser.add_argument('--bytes-per-pixel', type=int, metavar='N', help='bytes per pixel in the buffers')
+    parser.add_argument('--queue', type=int, metavar='N', help='QUEUE_MAX')
+    parser.add_argument('--packet-max', type=int, metavar='N', help='PACKET_MAX')
+    parser.add_argument('--no-strand-buffer', action='store_true', help='without the strand buffer')
+    parser.add_argument('--layouts', action='store_true', help='compare the standard alternative layouts')
+    args = parser.parse_args(argv)
+
+    slaves = isis_config.load_config()
+    sketch = Sketch()
+    if args.layouts:
+        compare(slaves, sketch, LAYOUTS, args.stack)
+        return 0
+    custom = (args.bytes_per_pixel, args.queue, args.packet_max) != (None, None, None) or args.no_strand_buffer
+    layout = Layout('custom' if custom else 'as built', args.bytes_per_pixel, args.queue, args.packet_max,
+                    not args.no_strand_buffer)
+    plans = plan(slaves, sketch, layout, args.stack)
+    report(plans)
+    return 1 if any(p.free < 0 for p in plans) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,353 @@
+#! /usr/bin/env python3
+
+# Frame-to-packet synthesizer for Isis Pyramid 1.1 lighting programs.
+#
+# Lighting programs are written in terms of slave opcodes: fill this entity, shift that
+# one up by a pixel, paint a rainbow. An effect that's easy to describe as array math
+# (a gradient sliding down the diagonals, a sine wave in brightness) is hard to write
+# that way. This goes the other way: given what the pyramid should show on every tick,
+# as a NumPy array of RGB colors, it works out a short stream of immediate entity packets
+# that shows it.
+#
+# Frame by frame, each entity that changes is painted with the cheapest of:
+#   - nothing, if it hasn't changed;
+#   - CMD_E_FILL_RGB of its most common color;
+#   - CMD_E_RAINBOW, if it's a stretch of the firmware's color wheel;
+#   - CMD_E_SHIFT_UP or CMD_E_SHIFT_DOWN of what it showed before, by the best count,
+#     filling in with the color at the end it came in from;
+#   - CMD_E_ROTATE of what it showed before, by the best count;
+#   - nothing at all but CMD_E_LOADONE;
+# each followed by a CMD_E_LOADONE for every pixel still wrong. Cheapest means fewest
+# bytes on the wire, SLIP escapes included. Entities given the same packet in the same
+# tick share it, with their bits ORed into the bitmap.
+#
+# At 9600 baud the bus carries fewer than ten bytes a tick, which isn't enough to repaint
+# much of the pyramid every tick. The synthesizer keeps track of when the wire will be
+# free, and a frame that comes due while the packets of an earlier one are still going
+# out is skipped; the next frame it does send is worked out from what's actually on the
+# pyramid, so nothing is lost but frames. The stream is checked by playing it in lpsim
+# and comparing every frame that was sent.
+#
+# The first frame can't assume anything about what the last program left, so every
+# entity is painted outright. A synthesized program starts with RESET_CLOCK, RESET_TIME
+# and a FILL_D clearing the dynamics bytes, and ends with ENDS_AT_TICK after its last
+# frame.
+#
+# Frames are arrays of shape (ticks, 12, 96, 3), laid out the way lpsim --save writes
+# them, with only the first entity_pixel_counts() pixels of each row used; lpframes'
+# packed (ticks, 928, 3) layout works too. Lighting programs can call play_frames() to
+# put synthesized frames in the middle of a hand-written program.
+#
+# Usage: lpsynth [--baud RATE] [--no-check] [-o OUT.PKT] frames.npy
+
+import argparse
+import collections
+import functools
+import os
+import sys
+
+import numpy as np
+
+from isis_packets import *
+import isis_config
+import lpcolor
+import lpsim
+
+BITS_PER_BYTE = 10          # 8N1, as lpbus counts it
+
+# Bytes of packet before the command-specific arguments, for an immediate entity packet.
+_IMMEDIATE = (1, 0, 0, 0, 0)    # repeat count 1, effective time 0, interval 0
+
+
+def entity_packet(command, bitmap, args):
+    """An immediate entity packet, as bytes.
+    """
+    return bytes((command | ENTITY_ADDRESSED, bitmap & 0xFF, bitmap >> 8) + _IMMEDIATE + tuple(args))
+
+
+def _wheel_positions():
+    """Where each color of the firmware's color wheel appears on it. Every color is at
+    one position except pure green, which is at both 0 and 255.
+    """
+    positions = collections.defaultdict(list)
+    for pos, color in enumerate(lpcolor.WHEEL):
+        positions[tuple(int(c) for c in color)].append(pos)
+    return dict(positions)
+
+WHEEL_POSITIONS = _wheel_positions()
+
+
+def _escaped(values):
+    """How many of the byte values need a SLIP escape.
+    """
+    return np.count_nonzero((values == FEND) | (values == FESC))
+
+
+@functools.lru_cache(maxsize=4096)
+def _packet_cost(command, bit, args):
+    return len(slip_encode(entity_packet(command, bit, args)))
+
+
+def _pack(colors):
+    """RGB colors, shape (..., 3), as single integers, for comparing whole pixels at once.
+    """
+    colors = np.asarray(colors, dtype=np.int32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+PACKED_WHEEL = _pack(lpcolor.WHEEL)
+
+
+class _Plan(object):
+    """How to paint one entity: a base packet (command and arguments, or None) and then a
+    LOADONE for every pixel of what that leaves (painted, packed) that isn't as in target,
+    with the cost of it all in wire bytes.
+    """
+    def __init__(self, bit, base, target, packed, painted):
+        self.base = base
+        self.target = target
+        self.wrong = np.flatnonzero(packed != painted)
+        self.cost = 0
+        if base:
+            self.cost = _packet_cost(base[0], bit, base[1])
+        if len(self.wrong):
+            self.cost += (len(self.wrong) * (_packet_cost(CMD_E_LOADONE, bit, ()) + 5) +
+                          _escaped(self.wrong) + _escaped(target[self.wrong]))
+
+    @property
+    def fixes(self):
+        return [(CMD_E_LOADONE, (int(i),) + tuple(int(c) for c in self.target[i]) + (0,)) for i in self.wrong]
+
+
+def _rainbows(target):
+    """(start, incr) of the rainbows that best fit target, judging by pairs of
+    neighboring pixels that are both on the color wheel.
+    """
+    count = len(target)
+    guesses = set()
+    for i in sorted(set([0, 1, count // 2, count - 2])):
+        if i < 0 or i + 1 >= count:
+            continue
+        for first in WHEEL_POSITIONS.get(tuple(int(c) for c in target[i]), []):
+            for second in WHEEL_POSITIONS.get(tuple(int(c) for c in target[i+1]), []):
+                incr = (second - first) & 0xFF
+                guesses.add(((first - i * incr) & 0xFF, incr))
+    return guesses
+
+
+def _color(packed):
+    return ((int(packed) >> 16) & 0xFF, (int(packed) >> 8) & 0xFF, int(packed) & 0xFF)
+
+
+def plan_entity(bit, target, shown):
+    """The cheapest way to paint one entity's count pixels (target, shape (count, 3))
+    over what it's showing (shown, or None if that isn't known). Returns a _Plan.
+    """
+    count = len(target)
+    packed = _pack(target)
+    plans = []
+    if shown is not None:
+        before = _pack(shown)
+        plans.append(_Plan(bit, None, target, packed, before))
+        if not len(plans[0].wrong):
+            return plans[0]
+
+    # fill with the most common color
+    colors, counts = np.unique(packed, return_counts=True)
+    color = colors[np.argmax(counts)]
+    plans.append(_Plan(bit, (CMD_E_FILL_RGB, _color(color)), target, packed, color))
+
+    pixel = np.arange(count)
+    for start, incr in _rainbows(target):
+        painted = PACKED_WHEEL[(start + incr * pixel) & 0xFF]
+        plans.append(_Plan(bit, (CMD_E_RAINBOW, (start, incr, 0)), target, packed, painted))
+
+    if shown is not None and count > 1:
+        # moved[n, i]: pixel i of the target is pixel (i - n) % count of what's shown,
+        # which is where ROTATE or SHIFT_UP by n would put it
+        moved = packed[np.newaxis, :] == before[(pixel[np.newaxis, :] - pixel[:, np.newaxis]) % count]
+        after = pixel[np.newaxis, :] >= pixel[:, np.newaxis]       # i >= n
+        rotate = moved.sum(axis=1)
+        # SHIFT_UP by n: the first n pixels get the color of target[0]
+        up = (moved & after).sum(axis=1)[1:] + np.cumsum(packed == packed[0])[:-1]
+        # SHIFT_DOWN by n: pixel i < count - n is shown pixel i + n, which is moved[count - n, i],
+        # and the last n pixels get the color of target[-1]
+        down = (moved & ~after).sum(axis=1)[:0:-1] + np.cumsum(packed[::-1] == packed[-1])[:-1]
+
+        n = 1 + int(np.argmax(rotate[1:]))
+        plans.append(_Plan(bit, (CMD_E_ROTATE, (n, 0)), target, packed, np.roll(before, n)))
+        n = 1 + int(np.argmax(up))
+        painted = np.concatenate([np.full(n, packed[0]), before[:count - n]])
+        plans.append(_Plan(bit, (CMD_E_SHIFT_UP, (n,) + _color(packed[0]) + (0,)), target, packed, painted))
+        n = 1 + int(np.argmax(down))
+        painted = np.concatenate([before[n:], np.full(n, packed[-1])])
+        plans.append(_Plan(bit, (CMD_E_SHIFT_DOWN, (n,) + _color(packed[-1]) + (0,)), target, packed, painted))
+
+    return min(plans, key=lambda plan: plan.cost)
+
+
+def _merge(plans):
+    """The packets for a tick's entity plans, {entity: _Plan}, with entities given the same
+    packet sharing it. All the base packets go before all the fixes.
+    """
+    bases = collections.OrderedDict()
+    fixes = collections.OrderedDict()
+    for entity, plan in sorted(plans.items()):
+        if plan.base:
+            bases[plan.base] = bases.get(plan.base, 0) | (1 << entity)
+        for fix in plan.fixes:
+            fixes[fix] = fixes.get(fix, 0) | (1 << entity)
+    return [entity_packet(command, bitmap, args)
+            for (command, args), bitmap in list(bases.items()) + list(fixes.items())]
+
+
+def unpack_frames(frames, counts):
+    """Frames as a list of (ticks, count, 3) arrays, one per entity, from either the
+    (ticks, 12, 96, 3) or the packed (ticks, 928, 3) layout.
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    if frames.ndim == 3 and frames.shape[1] == sum(counts):
+        bounds = np.cumsum([0] + counts)
+        return [frames[:, bounds[e]:bounds[e+1]] for e in range(len(counts))]
+    if frames.ndim != 4 or frames.shape[1] != len(counts) or frames.shape[2] < max(counts) or frames.shape[3] != 3:
+        raise ValueError('frames should be (ticks, %d, %d, 3) or (ticks, %d, 3), not %s' % (
+            len(counts), max(counts), sum(counts), frames.shape))
+    return [frames[:, e, :count] for e, count in enumerate(counts)]
+
+
+class Synthesis(object):
+    """The packets that show a sequence of frames, and what it took.
+    """
+    def __init__(self):
+        self.packets = []               # the packet stream, META_WAITs included
+        self.sent = []                  # ticks whose frames were sent
+        self.skipped = 0                # frames skipped while the wire was busy
+        self.unchanged = 0              # frames the same as the one before
+        self.wire_bytes = 0             # bytes the entity packets take on the wire
+        self.commands = collections.Counter()
+        self.shown = None               # what each entity shows after the last frame sent
+
+
+def synthesize(frames, start_tick=0, baud=BAUD_RATE, slaves=None, shown=None, busy_until=0.0):
+    """Work out the packets that show frames, one frame per tick starting at start_tick.
+    shown is what each entity is showing beforehand, as from unpack_frames(), if known.
+    busy_until is when (in ms from tick 0) the wire is free for the first frame. Returns
+    a Synthesis.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    counts = isis_config.entity_pixel_counts(slaves)
+    entities = unpack_frames(frames, counts)
+    ticks = len(entities[0])
+    byte_ms = 1000.0 * BITS_PER_BYTE / baud
+    if shown is None:
+        shown = [None] * len(counts)
+    else:
+        shown = [np.array(s, dtype=np.uint8) for s in shown]
+
+    # version[e][t] counts the changes to entity e up to tick t, so an entity still shows
+    # frame t if it shows a frame of the same version
+    version = [np.concatenate([[0], np.cumsum((entity[1:] != entity[:-1]).any(axis=(1, 2)))])
+               for entity in entities]
+    showing = [None] * len(counts)              # version each entity shows, if known
+
+    result = Synthesis()
+    line_free = busy_until
+    for t in range(ticks):
+        tick = start_tick + t
+        changed = [e for e, count in enumerate(counts) if count and showing[e] != version[e][t]]
+        if not changed:
+            result.unchanged += 1
+            continue
+        if line_free > tick * TICK_LENGTH and t > 0:
+            result.skipped += 1
+            continue
+        plans = {}
+        for e in changed:
+            plan = plan_entity(1 << e, entities[e][t], shown[e])
+            if plan.base or len(plan.wrong):
+                plans[e] = plan
+            shown[e] = np.array(entities[e][t])
+            showing[e] = version[e][t]
+        if not plans:
+            result.unchanged += 1
+            continue
+        packets = _merge(plans)
+        result.packets.append(bytes((CMD_META, META_WAIT, tick & 0xFF, (tick >> 8) & 0xFF)))
+        result.packets.extend(packets)
+        result.sent.append(tick)
+        wire = sum(len(slip_encode(packet)) for packet in packets)
+        result.wire_bytes += wire
+        line_free = max(line_free, tick * TICK_LENGTH) + wire * byte_ms
+        for packet in packets:
+            result.commands[ENTITY_COMMAND_NAMES[packet[PKT_COMMAND_OFFSET] & COMMAND_MASK]] += 1
+    result.shown = shown
+    return result
+
+
+def program(frames, baud=BAUD_RATE, slaves=None):
+    """A whole lighting program showing frames from its tick 0, as a packet stream,
+    and the Synthesis behind it.
+    """
+    setup = [bytes((CMD_S_RESET_CLOCK, 0xFF, 0xFF)),
+             bytes((CMD_META, META_RESET_TIME)),
+             entity_packet(CMD_E_FILL_D, PKT_ADDRESS_ALL_CALL, (0,))]
+    busy = sum(len(slip_encode(packet)) for packet in setup if not is_meta(packet))
+    result = synthesize(frames, 0, baud, slaves, busy_until=busy * 1000.0 * BITS_PER_BYTE / baud)
+    ticks = len(frames)
+    ends = bytes((CMD_META, META_ENDS, ticks & 0xFF, (ticks >> 8) & 0xFF))
+    return setup + result.packets + [ends], result
+
+
+def check(data, frames, sent, slaves=None):
+    """Play a synthesized PKT file in lpsim and compare the frames on the ticks that were
+    sent with the ones asked for. Returns the ticks that came out wrong.
+    """
+    if slaves is None:
+        slaves = isis_config.load_config()
+    counts = isis_config.entity_pixel_counts(slaves)
+    entities = unpack_frames(frames, counts)
+    sim = lpsim.Simulator(slaves)
+    sent = collections.deque(sent)
+    wrong = []
+    for first, count, frame in sim.play([('', data)]):
+        while sent and sent[0] < first + count:
+            tick = sent.popleft()
+            if any(not np.array_equal(frame[e, :counts[e]], entity[tick]) for e, entity in enumerate(entities)):
+                wrong.append(tick)
+    return wrong
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isis Pyramid frame-to-packet synthesizer')
+    parser.add_argument('frames', help='.npy file of frames, shape (ticks, 12, 96, 3) as lpsim --save writes')
+    parser.add_argument('-o', '--output', metavar='PKT', help='PKT file to write (default: beside the frames)')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE, help='bus speed to stay within')
+    parser.add_argument('--no-check', action='store_true', help='don\'t play the result in lpsim to check it')
+    args = parser.parse_args(argv)
+
+    frames = np.load(args.frames, mmap_mode='r')
+    output = args.output or os.path.splitext(args.frames)[0] + '.PKT'
+    packets, result = program(frames, args.baud)
+    data = b''.join(slip_encode(packet) for packet in packets)
+    with open(output, 'wb') as f:
+        f.write(data)
+
+    ticks = len(frames)
+    seconds = ticks * TICK_LENGTH / 1000.0
+    print('%s: %d ticks, %d frames sent, %d unchanged, %d skipped while the wire was busy' % (
+        output, ticks, len(result.sent), result.unchanged, result.skipped))
+    print('%d bytes in the file, %d on the wire (%.0f%% of %d baud)' % (
+        len(data), result.wire_bytes, 100.0 * result.wire_bytes * BITS_PER_BYTE / max(seconds, 1e-9) / args.baud,
+        args.baud))
+    print('  ' + ', '.join('%s %d' % item for item in result.commands.most_common()))
+    if not args.no_check:
+        wrong = check(data, frames, result.sent)
+        if wrong:
+            print('lpsim disagrees on %d frames, the first at tick %d' % (len(wrong), wrong[0]))
+            return 1
+        print('lpsim shows every frame sent as asked')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -13,19 +13,12 @@ def wait(howlong):
   wait_until += howlong
   wait_for_tick(wait_until)
   
-# a rough attempt at linearizing the subjective brightness 0-9
-table = [1,2,4,8,16,32,64,128,255]
+# a rough attempt at linearizing the subjective brightness 0-9 (lpcolor's exponential())
 def brightening(val):
-  if val == 0:
-  	return 0
-  else:
-    return table[val-1]
+  return exponential(val)
   
 def dimming(val):
-  if val == 9:
-  	return 0
-  else:
-    return table[8-val]
+  return exponential(9 - val)
 
 # starting position: front left diagonal and bottom left of the door are red. Else black.
 cmd_e_fill_d(ALL, 1,0,0, 0)